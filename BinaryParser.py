@@ -1,8 +1,11 @@
+import re
 import sys
 import struct
 import logging
 import datetime
 import binascii
+import functools
+import collections
 import six
 
 g_logger = logging.getLogger("BinaryParser")
@@ -17,23 +20,112 @@ def dosdate(dosdate, dostime):
     try:
         t = ord(dosdate[1]) << 8
         t |= ord(dosdate[0])
-        day = t & 0b0000000000011111
-        month = (t & 0b0000000111100000) >> 5
-        year = (t & 0b1111111000000000) >> 9
-        year += 1980
-
-        t = ord(dostime[1]) << 8
-        t |= ord(dostime[0])
-        sec = t & 0b0000000000011111
-        sec *= 2
-        minute = (t & 0b0000011111100000) >> 5
-        hour = (t & 0b1111100000000000) >> 11
+        t |= ord(dostime[0]) << 16
+        t |= ord(dostime[1]) << 24
+    except IndexError:
+        return datetime.datetime.min
+    return dosdatetime(t)
+
+
+def dosdatetime(value):
+    """
+    `value`: DOSDATE followed by DOSTIME, as a little endian DWORD.
+    returns: datetime.datetime or datetime.datetime.min on error
+    """
+    day = value & 0b0000000000011111
+    month = (value & 0b0000000111100000) >> 5
+    year = (value & 0b1111111000000000) >> 9
+    year += 1980
 
+    t = value >> 16
+    sec = t & 0b0000000000011111
+    sec *= 2
+    minute = (t & 0b0000011111100000) >> 5
+    hour = (t & 0b1111100000000000) >> 11
+
+    try:
         return datetime.datetime(year, month, day, hour, minute, sec)
-    except:
+    except ValueError:
         return datetime.datetime.min
 
 
+def guid(raw):
+    """
+    `raw`: 16 bytes, a GUID in its little endian binary form.
+    returns: the GUID as a lowercase string, without braces
+    """
+    # Yeah, this is ugly
+    h = map(ord, raw)
+    return "%02x%02x%02x%02x-%02x%02x-%02x%02x-%02x%02x-%02x%02x%02x%02x%02x%02x" % \
+        (h[3], h[2], h[1], h[0],
+         h[5], h[4],
+         h[7], h[6],
+         h[8], h[9],
+         h[10], h[11], h[12], h[13], h[14], h[15])
+
+
+# compiled patterns of the byte strings searched for in buffers
+#  without a find method
+FIND_PATTERNS = {}
+
+
+def slice_bytes(buf, start, end):
+    """
+    Return `buf[start:end]` as a byte string.
+    Arguments:
+    - `buf`: A byte string, bytearray, mmap, memoryview, or buffer.
+    - `start`: An integer
+    - `end`: An integer
+    """
+    chunk = buf[start:end]
+    if isinstance(chunk, memoryview):
+        return chunk.tobytes()
+    if not isinstance(chunk, bytes):
+        return bytes(chunk)
+    return chunk
+
+
+def buffer_view(buf, start, end):
+    """
+    Return a read-only view of `buf[start:end]` that shares the memory
+      of `buf`, rather than copying it out. Under Python 2 this is a
+      `buffer`, since mmaps don't support memoryview there.
+    Arguments:
+    - `buf`: A byte string, bytearray, or mmap.
+    - `start`: An integer
+    - `end`: An integer
+    """
+    if six.PY2:
+        return buffer(buf, start, end - start)
+    return memoryview(buf)[start:end]
+
+
+def find(buf, sub, start, end=None):
+    """
+    Like `str.find`, but also supports buffers without a find method,
+      such as memoryview and buffer. These are searched in place with a
+      regular expression, so nothing is copied out of the buffer.
+    Arguments:
+    - `buf`: A byte string, bytearray, mmap, memoryview, or buffer.
+    - `sub`: The byte string to search for.
+    - `start`: An integer
+    - `end`: (Optional) An integer
+    """
+    if end is None:
+        end = len(buf)
+    if hasattr(buf, "find"):
+        return buf.find(sub, start, end)
+
+    try:
+        pattern = FIND_PATTERNS[sub]
+    except KeyError:
+        pattern = FIND_PATTERNS[sub] = re.compile(re.escape(sub))
+    match = pattern.search(buf, start, end)
+    if match is None:
+        return -1
+    return match.start()
+
+
 def align(offset, alignment):
     """
     Return the offset aligned to the nearest greater given alignment
@@ -46,6 +138,159 @@ def align(offset, alignment):
     return offset + (alignment - (offset % alignment))
 
 
+class LRUCache(object):
+    """
+    A mapping of bounded size that evicts the least recently used entries.
+    Counts the hits and misses of lookups.
+    """
+    def __init__(self, maxsize):
+        """
+        Constructor.
+        Arguments:
+        - `maxsize`: The maximum number of entries. Zero disables the cache.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key`, marking it as recently used,
+          or `default` if it is not cached.
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Cache the value for `key`, evicting the least recently used
+          entry if the cache is full.
+        """
+        if self.maxsize <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def resize(self, maxsize):
+        """
+        Change the maximum number of entries, evicting entries as necessary.
+        """
+        self.maxsize = maxsize
+        while len(self._entries) > max(maxsize, 0):
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries and reset the counters.
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class GenerationCache(object):
+    """
+    An approximation of `LRUCache` for small, hot values, in which a hit
+      is a plain dict lookup. Entries are kept in a young and an old
+      generation of up to `maxsize` entries each. When the young generation
+      fills, it becomes the old one, and the old entries are evicted unless
+      they are used again in the meantime.
+    It is bounded like `LRUCache`, to at most 2 * `maxsize` entries, but
+      a hit in `LRUCache` moves the entry within a collections.OrderedDict,
+      which is written in Python on Python 2. That makes a lookup cost more
+      than what is cached here: decoding a DOSDATE/DOSTIME is cheaper.
+    """
+    def __init__(self, maxsize):
+        """
+        Constructor.
+        Arguments:
+        - `maxsize`: The maximum number of entries per generation.
+            Zero disables the cache.
+        """
+        self.maxsize = maxsize
+        self._young = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._young) + len(self._old)
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key`, or `default` if it is not cached.
+        """
+        try:
+            return self._young[key]
+        except KeyError:
+            pass
+        try:
+            value = self._old.pop(key)
+        except KeyError:
+            return default
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Cache the value for `key`, starting a new generation if necessary.
+        """
+        if self.maxsize <= 0:
+            return
+        if len(self._young) >= self.maxsize:
+            self._old = self._young
+            self._young = {}
+        self._young[key] = value
+
+    def resize(self, maxsize):
+        """
+        Change the maximum number of entries per generation.
+        """
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        self._young = {}
+        self._old = {}
+
+
+# number of decoded DOSDATE/DOSTIME values to keep per cache generation
+DEFAULT_DOSDATE_CACHE_SIZE = 0x1000
+
+# decoded DOSDATE/DOSTIME values, keyed by the raw DWORD.
+#  dates repeat heavily within a hive, while decoding allocates a datetime.
+DOSDATE_CACHE = GenerationCache(DEFAULT_DOSDATE_CACHE_SIZE)
+
+
+def cached_dosdatetime(value):
+    """
+    Like `dosdatetime`, but memoized in `DOSDATE_CACHE`.
+    `value`: DOSDATE followed by DOSTIME, as a little endian DWORD.
+    returns: datetime.datetime or datetime.datetime.min on error
+    """
+    if value == 0:
+        # the common unset date, which is invalid
+        return datetime.datetime.min
+    d = DOSDATE_CACHE.get(value)
+    if d is None:
+        d = dosdatetime(value)
+        DOSDATE_CACHE.put(value, d)
+    return d
+
+
 class ParseException(Exception):
     """
     An exception to be thrown during parsing, such as
@@ -82,16 +327,211 @@ class OverrunBufferException(ParseException):
         return u"Tried to parse beyond the end of the file (%s)" % (self._value)
 
 
-class Block(object):
+class Field(object):
+    """
+    A field declared once per Block subclass in its `_fields` schema.
+    The field is exposed as a method of the block, just like fields added
+      with `Block.declare_field`, but it is only decoded when accessed.
+    """
+    def __init__(self, type, name, offset, *args):
+        """
+        Constructor.
+        Arguments:
+        - `type`: A string. Should be one of the unpack_* types.
+        - `name`: A string.
+        - `offset`: A number.
+        - `args`: (Optional) Additional arguments to the unpacker, such as a length.
+        """
+        self.type = type
+        self.name = name
+        self.offset = offset
+        self.args = (offset,) + args
+
+    def __get__(self, block, cls=None):
+        if block is None:
+            return self
+        handler = functools.partial(getattr(block, "unpack_" + self.type),
+                                    *self.args)
+        if g_logger.isEnabledFor(logging.DEBUG):
+            block._log_field(self.type, self.name, self.offset, handler())
+        # shadow the descriptor, so later accesses are plain attribute lookups
+        block.__dict__[self.name] = handler
+        return handler
+
+
+# struct formats of the unpack_* types that have a fixed width
+FIXED_FIELD_FORMATS = {
+    "byte": "B",
+    "word": "H",
+    "dword": "I",
+    "int": "i",
+    "qword": "Q",
+    "dosdate": "I",
+    "rawdosdate": "I",
+    "guid": "16s",
+    "rawguid": "16s",
+}
+
+# conversions from the raw struct value to what the unpack_* method returns
+FIXED_FIELD_CONVERTERS = {
+    "dosdate": cached_dosdatetime,
+    "guid": guid,
+}
+
+# largest gap of unused bytes that may be skipped within a single run
+MAX_RUN_GAP = 0x8
+
+
+class StructRun(object):
+    """
+    A run of adjacent fixed-width fields from a `_fields` schema that is
+      decoded with a single precompiled `struct.Struct`. The resulting tuple
+      is cached on the block.
+    """
+    def __init__(self, offset, fields):
+        """
+        Constructor.
+        Arguments:
+        - `offset`: The relative offset at which the run starts.
+        - `fields`: A list of field tuples, sorted by offset.
+        """
+        self.offset = offset
+        self.key = "_run_%x" % (offset)
+        fmt = "<"
+        end = offset
+        for field in fields:
+            if field[2] > end:
+                fmt += "%dx" % (field[2] - end)
+            fmt += FIXED_FIELD_FORMATS[field[0]]
+            end = offset + struct.calcsize(fmt)
+        self.struct = struct.Struct(fmt)
+
+    def unpack(self, block):
+        """
+        Returns the tuple of raw values of this run in the given block.
+        Throws:
+        - `OverrunBufferException`
+        """
+        try:
+            return block.__dict__[self.key]
+        except KeyError:
+            pass
+        o = block._offset + self.offset
+        try:
+            values = self.struct.unpack_from(block._buf, o)
+        except struct.error:
+            raise OverrunBufferException(o, len(block._buf))
+        block.__dict__[self.key] = values
+        return values
+
+
+class StructField(Field):
+    """
+    A fixed-width field declared in a `_fields` schema, decoded together
+      with the rest of its `StructRun`.
+    """
+    def __init__(self, type, name, offset, run, index):
+        """
+        Constructor.
+        Arguments:
+        - `type`: A string. Should be one of FIXED_FIELD_FORMATS.
+        - `name`: A string.
+        - `offset`: A number.
+        - `run`: The `StructRun` that contains this field.
+        - `index`: The index of this field in the values of the run.
+        """
+        super(StructField, self).__init__(type, name, offset)
+        self.run = run
+        self.index = index
+        self.convert = FIXED_FIELD_CONVERTERS.get(type)
+
+    def __get__(self, block, cls=None):
+        if block is None:
+            return self
+        try:
+            value = self.run.unpack(block)[self.index]
+        except OverrunBufferException:
+            # the buffer ends within the run, so only fail
+            # if this field itself is out of bounds.
+            value = getattr(block, "unpack_" + self.type)(*self.args)
+        else:
+            if self.convert is not None:
+                value = self.convert(value)
+        if g_logger.isEnabledFor(logging.DEBUG):
+            block._log_field(self.type, self.name, self.offset, value)
+        handler = lambda: value
+        block.__dict__[self.name] = handler
+        return handler
+
+
+def compile_fields(fields):
+    """
+    Compile a `_fields` schema into descriptors.
+    Runs of adjacent fixed-width fields share a `StructRun`,
+      and all other fields are decoded individually.
+    Arguments:
+    - `fields`: A sequence of tuples ("type", "name", offset[, length]).
+    Returns a list of descriptors.
+    """
+    descriptors = []
+    run = []
+    run_end = None
+
+    def flush():
+        if run:
+            struct_run = StructRun(run[0][2], run)
+            for index, field in enumerate(run):
+                descriptors.append(StructField(field[0], field[1], field[2],
+                                               struct_run, index))
+            del run[:]
+
+    for field in sorted(fields, key=lambda f: f[2]):
+        if field[0] not in FIXED_FIELD_FORMATS or len(field) > 3:
+            descriptors.append(Field(*field))
+            continue
+        if run and not run_end <= field[2] <= run_end + MAX_RUN_GAP:
+            flush()
+        run.append(field)
+        run_end = field[2] + struct.calcsize("<" + FIXED_FIELD_FORMATS[field[0]])
+    flush()
+    return descriptors
+
+
+class BlockMeta(type):
+    """
+    Metaclass that compiles the `_fields` schemas of a Block subclass
+      and its bases into descriptors and `_off_` offset attributes.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(BlockMeta, cls).__init__(name, bases, attrs)
+        if "_fields" not in attrs:
+            return
+        schema = {}
+        for klass in reversed(cls.__mro__):
+            for field in klass.__dict__.get("_fields", ()):
+                schema[field[1]] = field
+        for descriptor in compile_fields(schema.values()):
+            setattr(cls, descriptor.name, descriptor)
+            setattr(cls, "_off_" + descriptor.name, descriptor.offset)
+
+
+class Block(six.with_metaclass(BlockMeta, object)):
     """
     Base class for structured blocks used in parsing.
     A block is associated with a offset into a byte-string.
+    The byte-string may also be any buffer that supports slicing and
+      `struct.unpack_from`, such as a bytearray, mmap, or memoryview,
+      which is shared by all the blocks parsed from it without copies.
+    Subclasses may declare fields at fixed offsets in the class-level
+      `_fields` schema, a sequence of tuples ("type", "name", offset[, length]).
     """
+    _fields = ()
+
     def __init__(self, buf, offset, parent):
         """
         Constructor.
         Arguments:
-        - `buf`: Byte string containing binary data.
+        - `buf`: Byte string or buffer containing binary data.
         - `offset`: The offset into the buffer at which the block starts.
         - `parent`: The parent block, which links to this block.
         """
@@ -105,32 +545,43 @@ class Block(object):
     def __str__(self):
         return str(unicode(self))
 
+    def _log_field(self, type, name, offset, value):
+        """
+        Emit the hexlified debug payload for a decoded field.
+        Callers should only do so if debug logging is enabled, since
+          the payload requires the field to be decoded.
+        Arguments:
+        - `type`: A string. Should be one of the unpack_* types.
+        - `name`: A string.
+        - `offset`: A number.
+        - `value`: The decoded field.
+        """
+        if isinstance(value, six.text_type):
+            value = value.encode('utf8')
+        else:
+            value = str(value)
+        g_logger.debug("(%s) %s\t@ %s\t: %s" % (type.upper(),
+                                     name,
+                                     hex(self.absolute_offset(offset)),
+                                     binascii.hexlify(value)))
+
     def _prepare_fields(self, fields=False):
         """
         Declaratively add fields to this block.
-        self._fields should contain a list of tuples ("type", "name", offset).
+        Fields at fixed offsets should be declared once per class in the
+          class-level `_fields` schema instead (see `Field`).
         This method will dynamically add corresponding offset and unpacker methods
-          to this block.
+          to this block. Nothing is decoded unless debug logging is enabled.
         Arguments:
-        - `fields`: (Optional) A list of tuples to add. Otherwise,
-            self._fields is used.
+        - `fields`: A list of tuples ("type", "name", offset[, length]) to add.
         """
         for field in fields:
-            def handler():
-                f = getattr(self, "unpack_" + field[0])
-                return f(*(field[2:]))
+            handler = functools.partial(getattr(self, "unpack_" + field[0]),
+                                        *field[2:])
             setattr(self, field[1], handler)
-            debug_payload = handler()
-            if isinstance(debug_payload, six.text_type):
-                debug_payload = debug_payload.encode('utf8')
-            else:
-                debug_payload = str(debug_payload)
-            debug_payload = binascii.hexlify(debug_payload)
-            g_logger.debug("(%s) %s\t@ %s\t: %s" % (field[0].upper(),
-                                         field[1],
-                                         hex(self.absolute_offset(field[2])),
-                                         debug_payload))
             setattr(self, "_off_" + field[1], field[2])
+            if g_logger.isEnabledFor(logging.DEBUG):
+                self._log_field(field[0], field[1], field[2], handler())
 
     def declare_field(self, type, name, offset, length=False):
         """
@@ -146,6 +597,21 @@ class Block(object):
         else:
             self._prepare_fields([(type, name, offset)])
 
+    def validate_fields(self, *names):
+        """
+        Decode the given fields now, rather than when they are first
+          accessed, so that a field that is out of bounds or cannot be
+          decoded raises while the block is constructed, and the caller
+          can fall back to another structure.
+        Arguments:
+        - `names`: The names of declared fields.
+        Throws:
+        - `OverrunBufferException`
+        - `UnicodeDecodeError`
+        """
+        for name in names:
+            getattr(self, name)()
+
     def unpack_byte(self, offset):
         """
         Returns a little-endian unsigned byte from the relative offset.
@@ -236,19 +702,21 @@ class Block(object):
                        the string runs until a NULL.
         Throws:
         - `OverrunBufferException`
-        - `IndexError`
         """
         o = self._offset + offset
 
         if not length:
-            end = self._buf.find("\x00", o)
+            end = find(self._buf, "\x00", o)
             length = end - o
 
-        try:
-            return struct.unpack_from("<%ds" % (length), self._buf, o)[0].partition("\x00")[0]
-        except struct.error:
+        if length < 0 or o + length > len(self._buf):
             raise OverrunBufferException(o, len(self._buf))
 
+        end = find(self._buf, "\x00", o, o + length)
+        if end == -1:
+            end = o + length
+        return slice_bytes(self._buf, o, end)
+
     def unpack_wstring(self, offset, ilength=False):
         """
         Returns a UTF-16 decoded string from the relative offset with
@@ -257,43 +725,58 @@ class Block(object):
         NULL character.
         Arguments:
         - `offset`: The relative offset from the start of the block.
-        - `length`: (Optional) The length of the string. If no length is provided,
-                       the string runs until a double NULL.
+        - `ilength`: (Optional) The maximum length of the string in bytes.
+                       The string runs until a double NULL aligned to a wchar.
         Throws:
         - `UnicodeDecodeError`
-        - `IndexError`
         """
+        buf = self._buf
+        start = self._offset + offset
+        end = len(buf)
 
-        raw_bytes = self._buf[self._offset + offset:]
+        # Trim to specified length before scanning
+        if ilength > 0:
+            end = min(end, start + ilength)
+        elif ilength < 0:
+            end += ilength
+        end = max(start, end)
 
-        # Trim to specified length
-        if ilength:
-            raw_bytes = raw_bytes[:ilength]
+        # Ensure the range is even-length
+        end -= (end - start) % 2
 
-        # Ensure raw_bytes is even-length
-        if len(raw_bytes) % 2:
-            raw_bytes = raw_bytes[:-1]
-        try:
-            index = [raw_bytes[i:i + 2] for i in range(0, len(raw_bytes), 2)].index('\x00\x00')
-            raw_bytes = raw_bytes[:index * 2]
-        except ValueError:
-            pass
-        return raw_bytes.decode("utf-16-le")
+        # Find the first double NULL that is aligned to a wchar
+        index = find(buf, "\x00\x00", start, end)
+        while index != -1 and (index - start) % 2:
+            index = find(buf, "\x00\x00", index + 1, end)
+        if index != -1:
+            end = index
+        return slice_bytes(buf, start, end).decode("utf-16-le")
 
     def unpack_dosdate(self, offset):
         """
         Returns a datetime from the DOSDATE and DOSTIME starting at
-        the relative offset.
+        the relative offset, or datetime.datetime.min if it is invalid.
         Arguments:
         - `offset`: The relative offset from the start of the block.
         Throws:
-        - `OverrunBufferException`
         """
+        return cached_dosdatetime(self.unpack_rawdosdate(offset))
+
+    def unpack_rawdosdate(self, offset):
+        """
+        Returns the DOSDATE and DOSTIME starting at the relative offset,
+        as a little endian DWORD, or 0 if it is truncated. Decode it with
+        `cached_dosdatetime`.
+        Arguments:
+        - `offset`: The relative offset from the start of the block.
+        Throws:
+        """
+        o = self._offset + offset
         try:
-            o = self._offset + offset
-            return dosdate(self._buf[o:o + 2], self._buf[o + 2:o + 4])
+            return struct.unpack_from("<I", self._buf, o)[0]
         except struct.error:
-            raise OverrunBufferException(o, len(self._buf))
+            # a truncated date is invalid, not an error
+            return 0
 
     def unpack_guid(self, offset):
         """
@@ -306,18 +789,26 @@ class Block(object):
         o = self._offset + offset
 
         try:
-            _bin = self._buf[o:o + 16]
+            _bin = slice_bytes(self._buf, o, o + 16)
         except IndexError:
             raise OverrunBufferException(o, len(self._buf))
 
-        # Yeah, this is ugly
-        h = map(ord, _bin)
-        return "%02x%02x%02x%02x-%02x%02x-%02x%02x-%02x%02x-%02x%02x%02x%02x%02x%02x" % \
-            (h[3], h[2], h[1], h[0],
-             h[5], h[4],
-             h[7], h[6],
-             h[8], h[9],
-             h[10], h[11], h[12], h[13], h[14], h[15])
+        return guid(_bin)
+
+    def unpack_rawguid(self, offset):
+        """
+        Returns the 16 bytes of a GUID starting at the relative offset,
+          in its little endian binary form. See `guid` for the string form.
+        Arguments:
+        - `offset`: The relative offset from the start of the block.
+        Throws:
+        - `OverrunBufferException`
+        """
+        o = self._offset + offset
+        _bin = slice_bytes(self._buf, o, o + 16)
+        if len(_bin) != 16:
+            raise OverrunBufferException(o, len(self._buf))
+        return _bin
 
     def absolute_offset(self, offset):
         """
@@ -1,10 +1,15 @@
-import datetime
+import timeit
+import hashlib
 import logging
+import collections
 
+from BinaryParser import guid
 from BinaryParser import Block
 from BinaryParser import align
+from BinaryParser import LRUCache
 from BinaryParser import OverrunBufferException
-from known_guids import known_guids
+from BinaryParser import cached_dosdatetime
+from known_guids import known_guids_raw
 
 
 g_logger = logging.getLogger("ShellItems")
@@ -28,11 +33,13 @@ class SHITEMTYPE:
 
 
 class SHITEM(Block):
+    _fields = (
+        ("word", "size", 0x0),
+        ("byte", "type", 0x2),
+    )
+
     def __init__(self, buf, offset, parent):
         super(SHITEM, self).__init__(buf, offset, parent)
-
-        self.declare_field("word", "size", 0x0)
-        self.declare_field("byte", "type", 0x2)
         g_logger.debug("SHITEM @ %s of type %s.", hex(offset), hex(self.type()))
 
     def __unicode__(self):
@@ -41,30 +48,64 @@ class SHITEM(Block):
     def name(self):
         return "??"
 
+    # The raw_*_date accessors return the DOSDATE and DOSTIME of a date
+    #  as a DWORD, or 0 if the item has no such date.
+
+    def raw_m_date(self):
+        return 0
+
+    def raw_a_date(self):
+        return 0
+
+    def raw_cr_date(self):
+        return 0
+
     def m_date(self):
-        return datetime.datetime.min
+        return cached_dosdatetime(self.raw_m_date())
 
     def a_date(self):
-        return datetime.datetime.min
+        return cached_dosdatetime(self.raw_a_date())
 
     def cr_date(self):
-        return datetime.datetime.min
+        return cached_dosdatetime(self.raw_cr_date())
 
 
-class SHITEM_FOLDERENTRY(SHITEM):
+class SHITEM_WITH_GUID(SHITEM):
+    """
+    A shell item identified by a GUID, declared as the "rawguid" field
+      `raw_guid`. The GUID is looked up in its binary form, and only
+      formatted as a string when it is not known.
+    """
+    def guid(self):
+        return guid(self.raw_guid())
+
+    def guid_name(self):
+        """
+        Returns the name of the GUID if it is known, or the GUID string.
+        """
+        raw = self.raw_guid()
+        try:
+            return known_guids_raw[raw]
+        except KeyError:
+            return guid(raw)
+
+
+class SHITEM_FOLDERENTRY(SHITEM_WITH_GUID):
+    _fields = (
+        ("byte", "folderid", 0x3),
+        ("rawguid", "raw_guid", 0x4),
+    )
+
     def __init__(self, buf, offset, parent):
         g_logger.debug("SHITEM_FOLDERENTRY @ %s.", hex(offset))
         super(SHITEM_FOLDERENTRY, self).__init__(buf, offset, parent)
 
-        self._off_folderid = 0x3      # UINT8
-        self.declare_field("guid", "guid", 0x4)
-
     def __unicode__(self):
         return u"SHITEM_FOLDERENTRY @ %s: %s." % \
           (hex(self.offset()), self.name())
 
     def folder_id(self):
-        _id = self.unpack_byte(self._off_folderid)
+        _id = self.folderid()
 
         if _id == 0x00:
             return "INTERNET_EXPLORER"
@@ -90,19 +131,20 @@ class SHITEM_FOLDERENTRY(SHITEM):
             return ""
 
     def name(self):
-        if self.guid() in known_guids:
-            return "{%s}" % known_guids[self.guid()]
-        return "{%s: %s}" % (self.folder_id(), self.guid())
+        try:
+            return "{%s}" % known_guids_raw[self.raw_guid()]
+        except KeyError:
+            return "{%s: %s}" % (self.folder_id(), self.guid())
 
 
-class SHITEM_UNKNOWNENTRY0(SHITEM):
+class SHITEM_UNKNOWNENTRY0(SHITEM_WITH_GUID):
+    _fields = (
+        ("rawguid", "raw_guid", 0xE),  # only present if size == 0x20
+    )
+
     def __init__(self, buf, offset, parent):
         g_logger.debug("SHITEM_UNKNOWNENTRY0 @ %s.", hex(offset))
         super(SHITEM_UNKNOWNENTRY0, self).__init__(buf, offset, parent)
-
-        self.declare_field("word", "size", 0x0)
-        if self.size() == 0x20:
-            self.declare_field("guid", "guid", 0xE)
         # pretty much completely unknown
         # TODO, if you have time for research
 
@@ -112,19 +154,21 @@ class SHITEM_UNKNOWNENTRY0(SHITEM):
 
     def name(self):
         if self.size() == 0x20:
-            return "{%s}" % known_guids.get(self.guid(), self.guid())
+            return "{%s}" % self.guid_name()
         else:
             return "??"
 
 
-class SHITEM_UNKNOWNENTRY2(SHITEM):
+class SHITEM_UNKNOWNENTRY2(SHITEM_WITH_GUID):
+    _fields = (
+        ("byte", "flags", 0x3),
+        ("rawguid", "raw_guid", 0x4),
+    )
+
     def __init__(self, buf, offset, parent):
         g_logger.debug("SHITEM_UNKNOWNENTRY2 @ %s.", hex(offset))
         super(SHITEM_UNKNOWNENTRY2, self).__init__(buf, offset, parent)
 
-        self.declare_field("byte", "flags", 0x3)
-        self.declare_field("guid", "guid", 0x4)
-
     def __unicode__(self):
         return u"SHITEM_UNKNOWNENTRY2 @ %s: %s." % \
           (hex(self.offset()), self.name())
@@ -134,17 +178,19 @@ class SHITEM_UNKNOWNENTRY2(SHITEM):
           (hex(self.offset()), self.name())
 
     def name(self):
-        return "{%s}" % known_guids.get(self.guid(), self.guid())
+        return "{%s}" % self.guid_name()
 
 
 class SHITEM_URIENTRY(SHITEM):
+    _fields = (
+        ("dword", "flags", 0x3),
+        ("wstring", "uri", 0x8),
+    )
+
     def __init__(self, buf, offset, parent):
         g_logger.debug("SHITEM_URIENTRY @ %s.", hex(offset))
         super(SHITEM_URIENTRY, self).__init__(buf, offset, parent)
 
-        self.declare_field("dword", "flags", 0x3)
-        self.declare_field("wstring", "uri", 0x8)
-
     def __unicode__(self):
         return u"SHITEM_URIENTRY @ %s: %s." % \
           (hex(self.offset()), self.name())
@@ -153,20 +199,22 @@ class SHITEM_URIENTRY(SHITEM):
         return self.uri()
 
 
-class SHITEM_CONTROLPANELENTRY(SHITEM):
+class SHITEM_CONTROLPANELENTRY(SHITEM_WITH_GUID):
+    _fields = (
+        ("byte", "flags", 0x3),
+        ("rawguid", "raw_guid", 0xE),
+    )
+
     def __init__(self, buf, offset, parent):
         g_logger.debug("SHITEM_CONTROLPANELENTRY @ %s.", hex(offset))
         super(SHITEM_CONTROLPANELENTRY, self).__init__(buf, offset, parent)
 
-        self.declare_field("byte", "flags", 0x3)
-        self.declare_field("guid", "guid", 0xE)
-
     def __unicode__(self):
         return u"SHITEM_CONTROLPANELENTRY @ %s: %s." % \
           (hex(self.offset()), self.name())
 
     def name(self):
-        return "{CONTROL PANEL: %s}" % known_guids.get(self.guid(), self.guid())
+        return "{CONTROL PANEL: %s}" % self.guid_name()
 
 
 class SHITEM_VOLUMEENTRY(SHITEM):
@@ -182,13 +230,13 @@ class SHITEM_VOLUMEENTRY(SHITEM):
           (hex(self.offset()), self.name())
 
 
-class SHITEM_NETWORKLOCATIONENTRY(SHITEM):
+class SHITEM_NETWORKLOCATIONENTRY(SHITEM_WITH_GUID):
     def __init__(self, buf, offset, parent):
         g_logger.debug("SHITEM_NETWORKVOLUMEENTRY @ %s.", hex(offset))
         super(SHITEM_NETWORKLOCATIONENTRY, self).__init__(buf, offset, parent)
 
         if self.type() & 0xF == 0xD:
-            self.declare_field("guid", "guid", 0x4)
+            self.declare_field("rawguid", "raw_guid", 0x4)
             return
         self.declare_field("byte", "flags", 0x4)
         off = 0x5
@@ -206,8 +254,8 @@ class SHITEM_NETWORKLOCATIONENTRY(SHITEM):
           (hex(self.offset()), self.name())
 
     def name(self):
-        if hasattr(self, 'guid'):
-            return "{%s}" % known_guids.get(self.guid(), self.guid())
+        if hasattr(self, 'raw_guid'):
+            return "{%s}" % self.guid_name()
         return self.location()
 
 
@@ -215,25 +263,29 @@ class ExtensionBlock_BEEF0004(Block):
     """
     Extension block found in Fileentry, delegate shell item
     """
+    _fields = (
+        ("word", "ext_size", 0x0),
+        ("word", "ext_version", 0x2),
+        ("dword", "ext_signature", 0x4),  # 0xbeef0004
+        ("rawdosdate", "raw_cr_date", 0x8),  # version >= 0x03
+        ("rawdosdate", "raw_a_date", 0xC),   # version >= 0x03
+    )
+
     def __init__(self, buf, offset, parent):
         super(ExtensionBlock_BEEF0004, self).__init__(buf, offset, parent)
         # Initialize name functors:
         self.localized_name = lambda: u''
         self.long_name = lambda: u''
-        off = 0
-        self.declare_field("word", "ext_size", off); off += 2
-        self.declare_field("word", "ext_version", off); off += 2
+        off = 4
 
         if self.ext_version() >= 0x03:
             off += 4 # 0xbeef0004
-
-            self.declare_field("dosdate", "cr_date", off); off += 4
-            self.declare_field("dosdate", "a_date", off); off += 4
-
+            off += 4 # cr_date
+            off += 4 # a_date
             off += 2 # unknown
         else:
-            self.cr_date = lambda: datetime.datetime.min
-            self.a_date = lambda: datetime.datetime.min
+            self.raw_cr_date = lambda: 0
+            self.raw_a_date = lambda: 0
 
         if self.ext_version() >= 0x0007:
             off += 2
@@ -256,6 +308,14 @@ class ExtensionBlock_BEEF0004(Block):
         elif self.ext_version() >= 0x0007 and self.long_name_size() > 0:
             self.declare_field("wstring", "localized_name", off)
             off += 2 * self.long_name_size() + 2
+        # a truncated or corrupt block must fail here, for the fragment fallback
+        self.validate_fields("ext_size", "localized_name")
+
+    def cr_date(self):
+        return cached_dosdatetime(self.raw_cr_date())
+
+    def a_date(self):
+        return cached_dosdatetime(self.raw_a_date())
 
 
 class SHITEM_WITH_EXTENSION(SHITEM):
@@ -274,22 +334,35 @@ class Fileentry(SHITEM_WITH_EXTENSION):
     The Fileentry structure is used both in the BagMRU and Bags keys with
     minor differences (eg. sizeof and location of size field).
     """
+    # the common layout, with the filesize at offset 0x4
+    _fields = (
+        ("dword", "filesize", 0x4),
+        ("rawdosdate", "raw_m_date", 0x8),
+        ("word", "fileattrs", 0xC),
+    )
+
     def __init__(self, buf, offset, parent, filesize_offset):
         g_logger.debug("Fileentry @ %s.", hex(offset))
         super(Fileentry, self).__init__(buf, offset, parent)
 
         off = filesize_offset
-        self.declare_field("dword", "filesize", off); off += 4
-        self.declare_field("dosdate", "m_date", off); off += 4
-        self.declare_field("word", "fileattrs", off); off += 2
+        if off != self._off_filesize:
+            self.declare_field("dword", "filesize", off)
+            self.declare_field("rawdosdate", "raw_m_date", off + 4)
+            self.declare_field("word", "fileattrs", off + 8)
+        off += 10
         self.declare_field("word", "ext_offset", self.size() - 2)
         if self.ext_offset() > self.size():
             raise OverrunBufferException(self.ext_offset(), self.size())
+        if self.ext_offset() < off and not self.type() & 0x4:
+            # the short name would have a negative length
+            raise OverrunBufferException(self.ext_offset(), off)
 
         if self.type() & 0x4:
             self.declare_field("wstring", "short_name", off, length=self.ext_offset() - off)
         else:
             self.declare_field("string", "short_name", off, length=self.ext_offset() - off)
+        self.validate_fields("filesize", "fileattrs", "short_name")
         self.extension_block = ExtensionBlock_BEEF0004(buf, self.ext_offset() + offset, self)
 
     def __unicode__(self):
@@ -302,27 +375,39 @@ class Fileentry(SHITEM_WITH_EXTENSION):
 
 
 class SHITEM_FILEENTRY(Fileentry):
+    _fields = (
+        ("byte", "flags", 0x3),
+    )
+
     def __init__(self, buf, offset, parent):
         g_logger.debug("SHITEM_FILEENTRY @ %s.", hex(offset))
         super(SHITEM_FILEENTRY, self).__init__(buf, offset, parent, 0x4)
 
-        self.declare_field("byte", "flags", 0x3)
-
     def __unicode__(self):
         return u"SHITEM_FILEENTRY @ %s: %s." % (hex(self.offset()),
                                                 self.name())
 
 
 class FILEENTRY_FRAGMENT(SHITEM):
+    # the common layout, with the filesize at offset 0x4
+    _fields = (
+        ("dword", "filesize", 0x4),
+        ("rawdosdate", "raw_m_date", 0x8),
+        ("word", "fileattrs", 0xC),
+        ("string", "short_name", 0xE),
+    )
+
     def __init__(self, buf, offset, parent, filesize_offset):
         g_logger.debug("FILEENTRY_FRAGMENT @ %s.", hex(offset))
         super(FILEENTRY_FRAGMENT, self).__init__(buf, offset, parent)
 
         off = filesize_offset
-        self.declare_field("dword", "filesize", off); off += 4
-        self.declare_field("dosdate", "m_date", off); off += 4
-        self.declare_field("word", "fileattrs", off); off += 2
-        self.declare_field("string", "short_name", off)
+        if off != self._off_filesize:
+            self.declare_field("dword", "filesize", off)
+            self.declare_field("rawdosdate", "raw_m_date", off + 4)
+            self.declare_field("word", "fileattrs", off + 8)
+            self.declare_field("string", "short_name", off + 10)
+        off += 10
 
         off += len(self.short_name()) + 1
         off = align(off, 2)
@@ -335,14 +420,17 @@ class FILEENTRY_FRAGMENT(SHITEM):
 
 
 class SHITEM_DELEGATE(SHITEM_WITH_EXTENSION):
+    # Unknown - Empty ( 1 byte)
+    # Unknown - size? - 2 bytes
+    # CFSF - 4 bytes
+    # sub shell item data size - 2 bytes
+    _fields = (
+        ("dword", "signature", 0x6),  # CFSF 0x46534643
+    )
+
     def __init__(self, buf, offset, parent):
         g_logger.debug("SHITEM_UNKNOWNENTRY3 @ %s.", hex(offset))
         super(SHITEM_DELEGATE, self).__init__(buf, offset, parent)
-        # Unknown - Empty ( 1 byte)
-        # Unknown - size? - 2 bytes
-        # CFSF - 4 bytes
-        # sub shell item data size - 2 bytes
-        self.declare_field("dword", "signature", 0x6)  # CFSF 0x46534643
 
         off = 0xA
         self.sub_item = FILEENTRY_FRAGMENT(buf, offset + off, self, 0x4)
@@ -363,56 +451,112 @@ class SHITEM_DELEGATE(SHITEM_WITH_EXTENSION):
             return self.long_name()
         return self.sub_item.short_name()
 
-    def m_date(self):
-        return self.sub_item.m_date()
+    def raw_m_date(self):
+        return self.sub_item.raw_m_date()
 
 
-class SHITEMLIST(Block):
-    def __init__(self, buf, offset, parent):
-        g_logger.debug("SHITEMLIST @ %s.", hex(offset))
-        super(SHITEMLIST, self).__init__(buf, offset, parent)
+def parse_fileentry(buf, offset, parent):
+    """
+    Parse a FILE_ENTRY shell item. Items whose extension offset does not
+      fit within the item are fragments without an extension block.
+    Arguments:
+    - `buf`: Byte string or buffer containing binary data.
+    - `offset`: The offset into the buffer at which the item starts.
+    - `parent`: The parent block, which links to this item.
+    """
+    header = Block(buf, offset, parent)
+    try:
+        size = header.unpack_word(0x0)
+        ext_offset = header.unpack_word(size - 2)
+        short_name_type = header.unpack_byte(0x2) & 0x4
+    except OverrunBufferException:
+        return FILEENTRY_FRAGMENT(buf, offset, parent, 0x4)
 
-    def get_item(self, off):
-        # UNKNOWN1
+    if ext_offset > size or (ext_offset < 0xE and not short_name_type):
+        return FILEENTRY_FRAGMENT(buf, offset, parent, 0x4)
 
-        _type = self.unpack_byte(off + 2)
-        if _type & 0x70 == SHITEMTYPE.FILE_ENTRY:
-            try:
-                item = SHITEM_FILEENTRY(self._buf, off, self)
-            except OverrunBufferException:
-                item = FILEENTRY_FRAGMENT(self._buf, off, self, 0x4)
+    try:
+        return SHITEM_FILEENTRY(buf, offset, parent)
+    except OverrunBufferException:
+        # the extension block is truncated
+        return FILEENTRY_FRAGMENT(buf, offset, parent, 0x4)
 
-        elif _type == SHITEMTYPE.FOLDER_ENTRY:
-            item = SHITEM_FOLDERENTRY(self._buf, off, self)
 
-        elif _type == SHITEMTYPE.UNKNOWN2:
-            item = SHITEM_UNKNOWNENTRY2(self._buf, off, self)
+# Constructors of shell items, indexed by type byte.
+# Use `register_item_type` to add new item types.
+SHITEM_CONSTRUCTORS = [SHITEM] * 0x100
 
-        elif _type & 0x70 == SHITEMTYPE.VOLUME_NAME:
-            item = SHITEM_VOLUMEENTRY(self._buf, off, self)
 
-        elif _type & 0x70 == SHITEMTYPE.NETWORK_LOCATION:
-            item = SHITEM_NETWORKLOCATIONENTRY(self._buf, off, self)
+def register_item_type(constructor, _type, mask=0xFF):
+    """
+    Register the constructor for the shell items whose type byte,
+      masked with `mask`, equals `_type`.
+    Later registrations take precedence over earlier ones.
+    Arguments:
+    - `constructor`: A callable (buf, offset, parent) that returns a SHITEM.
+    - `_type`: An integer, such as a SHITEMTYPE.
+    - `mask`: (Optional) An integer.
+    """
+    for t in range(0x100):
+        if t & mask == _type:
+            SHITEM_CONSTRUCTORS[t] = constructor
 
-        elif _type == SHITEMTYPE.URI:
-            item = SHITEM_URIENTRY(self._buf, off, self)
 
-        elif _type == SHITEMTYPE.CONTROL_PANEL:
-            item = SHITEM_CONTROLPANELENTRY(self._buf, off, self)
+register_item_type(parse_fileentry, SHITEMTYPE.FILE_ENTRY, 0x70)
+register_item_type(SHITEM_VOLUMEENTRY, SHITEMTYPE.VOLUME_NAME, 0x70)
+register_item_type(SHITEM_NETWORKLOCATIONENTRY, SHITEMTYPE.NETWORK_LOCATION, 0x70)
+register_item_type(SHITEM_FOLDERENTRY, SHITEMTYPE.FOLDER_ENTRY)
+register_item_type(SHITEM_UNKNOWNENTRY2, SHITEMTYPE.UNKNOWN2)
+register_item_type(SHITEM_URIENTRY, SHITEMTYPE.URI)
+register_item_type(SHITEM_CONTROLPANELENTRY, SHITEMTYPE.CONTROL_PANEL)
+register_item_type(SHITEM_UNKNOWNENTRY0, SHITEMTYPE.UNKNOWN0)
+register_item_type(SHITEM_DELEGATE, SHITEMTYPE.DELEGATE_ITEM)
 
-        elif _type == SHITEMTYPE.UNKNOWN0:
-            item = SHITEM_UNKNOWNENTRY0(self._buf, off, self)
 
-        elif _type == SHITEMTYPE.DELEGATE_ITEM:
-            item = SHITEM_DELEGATE(self._buf, off, self)
+class SHITEMLIST(Block):
+    def __init__(self, buf, offset, parent):
+        g_logger.debug("SHITEMLIST @ %s.", hex(offset))
+        super(SHITEMLIST, self).__init__(buf, offset, parent)
 
-        else:
+    def get_item(self, off):
+        """
+        Parse the shell item at the relative offset `off` of this list.
+        The item shares the buffer of this list.
+        """
+        # UNKNOWN1
+
+        _type = self.unpack_byte(off + 2)
+        constructor = SHITEM_CONSTRUCTORS[_type]
+        if constructor is SHITEM:
             g_logger.debug("Unknown type: %s", hex(_type))
-            item = SHITEM(self._buf, off, self)
+        if g_item_observer is None:
+            return constructor(self._buf, self.absolute_offset(off), self)
+        start = timeit.default_timer()
+        item = constructor(self._buf, self.absolute_offset(off), self)
+        g_item_observer.add_item(item.__class__, _type, timeit.default_timer() - start)
         return item
 
+    def itempos_items(self):
+        """
+        Generator of the shell items in an ItemPos value of a 'Bags' key.
+        The items follow a 0x10 byte header, and each is preceded by
+          0x8 bytes of position data.
+        """
+        off = 0x10
+
+        while True:
+            off += 0x8
+            size = self.unpack_word(off)
+            if size == 0:
+                return
+            elif size < 0x15:
+                pass
+            else:
+                yield self.get_item(off)
+            off += size
+
     def items(self):
-        off = self.offset()
+        off = 0
 
         while True:
             size = self.unpack_word(off)
@@ -432,3 +576,80 @@ class SHITEMLIST(Block):
 
     def __unicode__(self):
         return u"SHITEMLIST @ %s." % (hex(self.offset()))
+
+
+# The observer of shell item parsing, if set with `observe_items`.
+g_item_observer = None
+
+
+def observe_items(observer):
+    """
+    Report shell item parsing to `observer`, or stop reporting if it is None.
+    The observer has the methods:
+    - `add_item(item_class, _type, seconds)`: called for each shell item,
+        with its class, and the time spent in its constructor, or None if
+        its list was found in ITEM_CACHE rather than parsed.
+    - `add_item_cache_lookup(hit)`: called for each list looked up in
+        ITEM_CACHE, with whether it was found.
+    """
+    global g_item_observer
+    g_item_observer = observer
+
+
+# The parsed fields of a shell item that make up a shellbag, and the
+#  class of the item, for the observer of cached items.
+# Dates are kept as raw DOSDATE/DOSTIME DWORDs (see `SHITEM.raw_m_date`),
+#  and decoded by whatever finally displays them.
+ItemSummary = collections.namedtuple("ItemSummary",
+                                     ["offset", "type", "name",
+                                      "raw_m_date", "raw_a_date", "raw_cr_date",
+                                      "item_class"])
+
+DEFAULT_ITEM_CACHE_SIZE = 0x4000
+
+# Summaries of parsed shell item lists, keyed by the digest of the
+# raw value. The same values show up under many keys and hives.
+ITEM_CACHE = LRUCache(DEFAULT_ITEM_CACHE_SIZE)
+
+
+def cached_items(buf, itempos=False):
+    """
+    Generator of the ItemSummary of each shell item in a Registry value.
+    Values that were completely parsed before are not parsed again.
+    Arguments:
+    - `buf`: Byte string containing the Registry value.
+    - `itempos`: (Optional) If True, the value is an ItemPos value of
+        a 'Bags' key, otherwise a shell item list from a 'BagMRU' key.
+    """
+    # when the cache is disabled, don't spend the time hashing the value
+    key = None
+    if ITEM_CACHE.maxsize > 0:
+        key = (itempos, hashlib.sha256(buf).digest())
+        summaries = ITEM_CACHE.get(key)
+        observer = g_item_observer
+        if observer is not None:
+            observer.add_item_cache_lookup(summaries is not None)
+        if summaries is not None:
+            for summary in summaries:
+                if observer is not None:
+                    observer.add_item(summary.item_class, summary.type, None)
+                yield summary
+            return
+
+    l = SHITEMLIST(buf, 0, False)
+    if itempos:
+        items = l.itempos_items()
+    else:
+        items = l.items()
+
+    summaries = []
+    for item in items:
+        summary = ItemSummary(item.offset(), item.type(), item.name(),
+                              item.raw_m_date(), item.raw_a_date(), item.raw_cr_date(),
+                              item.__class__)
+        if key is not None:
+            summaries.append(summary)
+        yield summary
+    # only cache values that parsed without error
+    if key is not None:
+        ITEM_CACHE.put(key, tuple(summaries))
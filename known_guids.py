@@ -1,5 +1,7 @@
+import uuid
+
 known_guids = {
-    "008ca0b1-55b4-4c56-b8a8-4de4b299d3bE": "Account Pictures",
+    "008ca0b1-55b4-4c56-b8a8-4de4b299d3be": "Account Pictures",
     "00bcfc5a-ed94-4e48-96a1-3f6217f21990": "RoamingTiles",
     "00c6d95f-329c-409a-81d7-c46c66ea7f33": "Default Location",
     "00f2886f-cd64-4fc9-8ec5-30ef6cdbe8c3": "Scanners and Cameras",
@@ -377,3 +379,8 @@ known_guids = {
     "fe1290f0-cfbd-11cf-a330-00aa00c16e65": "Directory",
     "ff393560-c2a7-11cf-bff4-444553540000": "History",
 }
+
+# known_guids keyed by the 16 byte little endian binary form of each GUID,
+#   as it appears in shell items, so lookups need not format the GUID.
+known_guids_raw = dict((uuid.UUID(g).bytes_le, name)
+                       for g, name in known_guids.items())
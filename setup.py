@@ -6,7 +6,7 @@ setup(name='shellbags',
     author='Willi Ballenthin',
     version='0.5',
     install_requires=[
-        'python-registry',
+        'python-registry==1.3.1',
     ],
     py_modules=[
         'BinaryParser',
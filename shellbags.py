@@ -17,37 +17,72 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
 import re
 import sys
 import csv
+import json
+import mmap
+import timeit
+import sqlite3
+import hashlib
 import logging
+import multiprocessing
 import datetime
 import argparse
-import calendar
+import functools
+import contextlib
+import collections
+import multiprocessing.pool
+import sre_parse
+import sre_constants
 
 from Registry import Registry
 
+from BinaryParser import buffer_view
+from BinaryParser import cached_dosdatetime
 from BinaryParser import OverrunBufferException
-from ShellItems import SHITEMLIST
+from ShellItems import ITEM_CACHE
+from ShellItems import cached_items
+from ShellItems import observe_items
 
 g_logger = logging.getLogger("shellbags")
 
+# Unix timestamps are counted from here
+EPOCH = datetime.datetime(1970, 1, 1, 0, 0, 0)
+
+
+def date_decode(d):
+    """
+    Return the datetime of a date that may be a raw DOSDATE/DOSTIME
+    DWORD, such as the shell item dates of a ShellbagRecord.
+    Arguments:
+    - `d`: A Python datetime object, or an integer
+    """
+    if isinstance(d, (int, long)):
+        return cached_dosdatetime(d)
+    return d
+
 
 def date_safe(d):
     """
     From a Python datetime object, return a corresponding Unix timestamp
     or the epoch timestamp if the datetime object doesn't make sense
     Arguments:
-    - `d`: A Python datetime object
+    - `d`: A Python datetime object, or a raw DOSDATE/DOSTIME integer
     Throws:
     """
+    d = date_decode(d)
     try:
-        return int(calendar.timegm(d.timetuple()))
+        # same as calendar.timegm(d.timetuple()), without building the tuple
+        delta = d - EPOCH
     except (ValueError, OverflowError):
-        return int(calendar.timegm(datetime.datetime(1970, 1, 1, 0, 0, 0).timetuple()))
+        return 0
+    return delta.days * 86400 + delta.seconds
 
 
 def date_safe_str(d):
+    d = date_decode(d)
     try:
         return d.strftime("%m/%d/%Y %H:%M:%S")
     except:
@@ -76,153 +111,1662 @@ class ShellbagException(Exception):
         return u"Shellbag Exception: %s" % (self._value)
 
 
+class PathNode(object):
+    """
+    A node in a parent-pointer trie of shellbag paths.
+    Each node holds just its own path component, and refers to the node
+    of its parent folder, so the records below a folder share the nodes
+    of its path rather than each holding a copy of the whole string.
+    The root node, with no parent, has the empty path.
+    """
+    __slots__ = ("parent", "name", "depth")
+
+    def __init__(self, parent=None, name=None):
+        """
+        Constructor.
+        Arguments:
+        - `parent`: (Optional) The PathNode of the parent folder, or
+             None for the root node.
+        - `name`: (Optional) A unicode string with the path component.
+        """
+        self.parent = parent
+        self.name = name
+        if parent is None:
+            self.depth = 0
+        else:
+            self.depth = parent.depth + 1
+
+    def child(self, name):
+        """
+        Return a new PathNode below this one.
+        Arguments:
+        - `name`: A string with the path component. Byte strings are
+             decoded like `text_field`, so that joining them with the
+             unicode names of other components can't fail.
+        """
+        if not isinstance(name, unicode):
+            name = text_field(name)
+        return PathNode(self, name)
+
+    def names(self):
+        """
+        Return a list of the path components from the root to this node.
+        """
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        names.reverse()
+        return names
+
+    def path(self):
+        """
+        Return the path string, such as "\\My Computer\\C:\\".
+        """
+        names = self.names()
+        if not names:
+            return ""
+        return "\\" + "\\".join(names)
+
+    def is_under(self, ancestor):
+        """
+        Return True if this node is `ancestor`, or below it.
+        This only follows parent pointers, so does not build any strings.
+        """
+        node = self
+        while node.depth > ancestor.depth:
+            node = node.parent
+        return node is ancestor
+
+    def __getstate__(self):
+        # the names, rather than the parent, since pickling the chain
+        #   of parents would recurse once for each of them
+        return (self.names(),)
+
+    def __setstate__(self, state):
+        names = state[0]
+        parent = None
+        if names:
+            parent = PathNode()
+            for name in names[:-1]:
+                parent = PathNode(parent, name)
+        PathNode.__init__(self, parent, names[-1] if names else None)
+
+
+class ShellbagRecord(object):
+    """
+    A shellbag item.
+    The path and registry source strings are only built when they are
+    requested, so each record just refers to its PathNode, and to the key
+    path and value name strings, which are shared by all the records from
+    the same key.
+    Likewise, the dates of the shell item are kept as raw DOSDATE/DOSTIME
+    DWORDs, which the output formats decode with `date_decode`, and
+    which `mtime`, `atime` and `crtime` return decoded.
+    """
+    __slots__ = ("node", "raw_mtime", "raw_atime", "raw_crtime", "klwt",
+                 "key_path", "value_name", "offset")
+
+    def __init__(self, node, raw_mtime, raw_atime, raw_crtime, klwt,
+                 key_path, value_name, offset):
+        """
+        Constructor.
+        Arguments:
+        - `node`: A PathNode for the entry path.
+        - `raw_mtime`: The DOSDATE/DOSTIME DWORD of the modified date.
+        - `raw_atime`: The DOSDATE/DOSTIME DWORD of the accessed date.
+        - `raw_crtime`: The DOSDATE/DOSTIME DWORD of the created date.
+        - `klwt`: A Python datetime object representing the last write
+             time of the BagMRU key.
+        - `key_path`: A string with the path of the key containing the item.
+        - `value_name`: A string with the name of the value containing the item.
+        - `offset`: The offset of the item within the value.
+        """
+        self.node = node
+        self.raw_mtime = raw_mtime
+        self.raw_atime = raw_atime
+        self.raw_crtime = raw_crtime
+        self.klwt = klwt
+        self.key_path = key_path
+        self.value_name = value_name
+        self.offset = offset
+
+    @property
+    def path(self):
+        return self.node.path()
+
+    @property
+    def mtime(self):
+        return cached_dosdatetime(self.raw_mtime)
+
+    @property
+    def atime(self):
+        return cached_dosdatetime(self.raw_atime)
+
+    @property
+    def crtime(self):
+        return cached_dosdatetime(self.raw_crtime)
+
+    @property
+    def source(self):
+        return self.key_path + " @ " + hex(self.offset)
+
+    @property
+    def regsource(self):
+        return self.key_path + "\\" + self.value_name
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        """
+        Support the dict-style access of earlier versions, where a
+        shellbag item was a dict with these attributes as keys.
+        """
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+
+class ShellbagBatch(list):
+    """
+    A list of ShellbagRecords, as sent from a worker process.
+    When pickled, the PathNodes of the records are written once, as a
+    table of (node id, parent node id, name) rows in which parents come
+    before their children, and each record refers to its node by id.
+    The receiving side rebuilds the nodes in one pass over the table, so
+    the records still share the nodes of their common path prefixes,
+    and no chain of parents is pickled recursively.
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        node_ids = {}
+        rows = []
+        records = []
+        for record in self:
+            node = record.node
+            new_nodes = []
+            while node is not None and id(node) not in node_ids:
+                new_nodes.append(node)
+                node = node.parent
+            for node in reversed(new_nodes):
+                parent_id = None
+                if node.parent is not None:
+                    parent_id = node_ids[id(node.parent)]
+                node_ids[id(node)] = len(rows)
+                rows.append((len(rows), parent_id, node.name))
+            state = record.__getstate__()
+            records.append((node_ids[id(record.node)],) + state[1:])
+        return (load_shellbag_batch, (rows, records))
+
+
+def load_shellbag_batch(rows, records):
+    """
+    Rebuild a pickled ShellbagBatch.
+    Arguments:
+    - `rows`: A list of tuples (node id, parent node id or None, name),
+         with each parent before its children.
+    - `records`: A list of the ShellbagRecord states, with the node id
+         in place of the PathNode.
+    """
+    nodes = {}
+    for node_id, parent_id, name in rows:
+        if parent_id is None:
+            nodes[node_id] = PathNode(None, name)
+        else:
+            nodes[node_id] = PathNode(nodes[parent_id], name)
+    batch = ShellbagBatch()
+    for state in records:
+        record = ShellbagRecord.__new__(ShellbagRecord)
+        record.__setstate__((nodes[state[0]],) + state[1:])
+        batch.append(record)
+    return batch
+
+
+class MappedHive(object):
+    """
+    A hive file mapped read-only into memory. python-registry reads its
+    buffer from a file-like object with `read()`, so when it is given a
+    MappedHive, its structures and the value data are all parsed from the
+    one mapping, and only the pages that are touched are read from disk.
+    """
+    def __init__(self, path):
+        """
+        Constructor.
+        Arguments:
+        - `path`: The path of a hive file.
+        Throws:
+        - `EnvironmentError`, `ValueError`: If the file can't be mapped.
+        """
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self):
+        return self._mmap
+
+    def close(self):
+        """
+        Unmap the hive. Nothing parsed from it may be used afterwards.
+        """
+        self._mmap.close()
+
+
+class ParseStats(object):
+    """
+    Counts and timings collected while parsing, to find the item types,
+      keys and hives that are slow to parse, or fail.
+    Times are in seconds.
+    """
+    def __init__(self):
+        # shell item class name -> count, count of those from ITEM_CACHE,
+        #   and total and maximum constructor time of the others
+        self.items = collections.Counter()
+        self.cached_items = collections.Counter()
+        self.item_time = collections.Counter()
+        self.item_max_time = {}
+        # shell item type byte -> count
+        self.item_types = collections.Counter()
+        # lookups of shell item lists in ITEM_CACHE
+        self.item_cache_hits = 0
+        self.item_cache_misses = 0
+        self.itempos_values = 0
+        self.itempos_items = 0
+        self.itempos_time = 0.0
+        # BagMRU depth -> number of keys, values, shell items in the values,
+        #   and time parsing values
+        self.bagmru_keys = collections.Counter()
+        self.bagmru_values = collections.Counter()
+        self.bagmru_items = collections.Counter()
+        self.bagmru_time = collections.Counter()
+        # (exception class name, key path) -> count
+        self.exceptions = collections.Counter()
+        self._last_exception = None
+        # paths of the Bags slot keys that no NodeSlot refers to
+        self.orphan_slots = []
+        # hive path -> number of shellbags, and time parsing them
+        self.hive_shellbags = collections.Counter()
+        self.hive_time = collections.Counter()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_last_exception"] = None
+        return state
+
+    def add_item(self, item_class, _type, seconds):
+        """
+        Count a shell item by its class, and the time spent in its constructor,
+          or None if it came from ITEM_CACHE (see `ShellItems.observe_items`).
+        """
+        name = item_class.__name__
+        self.items[name] += 1
+        self.item_types[_type] += 1
+        if seconds is None:
+            self.cached_items[name] += 1
+            return
+        self.item_time[name] += seconds
+        if seconds > self.item_max_time.get(name, 0.0):
+            self.item_max_time[name] = seconds
+
+    def add_item_cache_lookup(self, hit):
+        if hit:
+            self.item_cache_hits += 1
+        else:
+            self.item_cache_misses += 1
+
+    def add_itempos_value(self, items, seconds):
+        self.itempos_values += 1
+        self.itempos_items += items
+        self.itempos_time += seconds
+
+    def add_bagmru_key(self, depth):
+        self.bagmru_keys[depth] += 1
+
+    def add_bagmru_value(self, depth, items, seconds):
+        self.bagmru_values[depth] += 1
+        self.bagmru_items[depth] += items
+        self.bagmru_time[depth] += seconds
+
+    def add_hive(self, hive, shellbags, seconds):
+        self.hive_shellbags[hive] += shellbags
+        self.hive_time[hive] += seconds
+
+    def add_exception(self, exception, key_path):
+        """
+        Count an exception raised while parsing the given key.
+        An exception is only counted once, by the innermost handler, even
+          if it is re-raised to outer handlers.
+        """
+        if exception is self._last_exception:
+            return
+        self._last_exception = exception
+        self.exceptions[(exception.__class__.__name__, key_path)] += 1
+
+    def add_orphan_slot(self, key_path):
+        self.orphan_slots.append(key_path)
+
+    def merge(self, other):
+        """
+        Add the counts and timings of another ParseStats to this one.
+        """
+        for name in ("items", "cached_items", "item_time", "item_types", "bagmru_keys",
+                     "bagmru_values", "bagmru_items", "bagmru_time", "exceptions",
+                     "hive_shellbags", "hive_time"):
+            getattr(self, name).update(getattr(other, name))
+        for name, seconds in other.item_max_time.items():
+            if seconds > self.item_max_time.get(name, 0.0):
+                self.item_max_time[name] = seconds
+        self.item_cache_hits += other.item_cache_hits
+        self.item_cache_misses += other.item_cache_misses
+        self.itempos_values += other.itempos_values
+        self.itempos_items += other.itempos_items
+        self.itempos_time += other.itempos_time
+        self.orphan_slots.extend(other.orphan_slots)
+
+    def summary(self):
+        """
+        Return a multi-line, human readable summary.
+        """
+        lines = []
+        lines.append("Shell items (constructor times of the items not cached):")
+        lines.append("  %-28s %10s %10s %12s %10s %10s" % ("class", "count", "cached",
+                                                            "total (ms)", "mean (us)",
+                                                            "max (us)"))
+        for name, count in self.items.most_common():
+            parsed = count - self.cached_items[name]
+            lines.append("  %-28s %10d %10d %12.3f %10.1f %10.1f" %
+                         (name, count, self.cached_items[name],
+                          self.item_time[name] * 1e3,
+                          self.item_time[name] / parsed * 1e6 if parsed else 0.0,
+                          self.item_max_time.get(name, 0.0) * 1e6))
+        lines.append("Shell item types:")
+        for _type, count in sorted(self.item_types.items()):
+            lines.append("  %-28s %10d" % (hex(_type), count))
+        lines.append("Item cache: %d hits, %d misses" % (self.item_cache_hits,
+                                                         self.item_cache_misses))
+        lines.append("ItemPos: %d values, %d items, %.3f ms" %
+                     (self.itempos_values, self.itempos_items, self.itempos_time * 1e3))
+        lines.append("BagMRU levels:")
+        lines.append("  %-8s %10s %10s %10s %12s" % ("depth", "keys", "values", "items",
+                                                     "total (ms)"))
+        for depth in sorted(self.bagmru_keys):
+            lines.append("  %-8d %10d %10d %10d %12.3f" %
+                         (depth, self.bagmru_keys[depth], self.bagmru_values[depth],
+                          self.bagmru_items[depth], self.bagmru_time[depth] * 1e3))
+        lines.append("Exceptions:")
+        for (name, key_path), count in self.exceptions.most_common():
+            lines.append("  %6d %s at %s" % (count, name, key_path))
+        lines.append("Orphaned Bags slots: %d" % (len(self.orphan_slots)))
+        for key_path in self.orphan_slots:
+            lines.append("  %s" % (key_path))
+        lines.append("Hives:")
+        lines.append("  %10s %12s  %s" % ("shellbags", "total (ms)", "hive"))
+        for hive, seconds in self.hive_time.most_common():
+            lines.append("  %10d %12.3f  %s" % (self.hive_shellbags[hive], seconds * 1e3, hive))
+        return "\n".join(lines)
+
+
 ################ PROGRAM FUNCTIONS #############
 
-def get_shellbags(shell_key):
+# The ParseStats being collected, if enabled with `enable_stats`.
+g_stats = None
+
+
+def enable_stats(enabled=True):
     """
-    Given a python-registry RegistryKey object, look for and return a
-    list of shellbag items. A shellbag item is a dict with the keys
-    (mtime, atime, crtime, path).
+    Start collecting a new ParseStats, or stop collecting if `enabled`
+      is False. Returns the new ParseStats, or None.
+    """
+    global g_stats
+    g_stats = ParseStats() if enabled else None
+    observe_items(g_stats)
+    return g_stats
+
+
+def get_stats():
+    """
+    Return the ParseStats being collected, or None if it is not enabled.
+    """
+    return g_stats
+
+
+# largest value data stored in a single cell, rather than a "db" record
+MAX_CELL_DATA_LENGTH = 0x3FD8
+
+
+def load_hive(regfile, use_mmap=True):
+    """
+    Return a tuple (python-registry Registry object, MappedHive or None)
+    for the hive at the given path. The hive is memory mapped, unless
+    `use_mmap` is False or the file can't be mapped, in which case it is
+    read into memory, and there is no MappedHive to close.
     Arguments:
-    - `shell_key`: A python-registry Registry object.
+    - `regfile`: The path of a hive file.
+    - `use_mmap`: (Optional) Whether to memory map the hive.
+    """
+    if use_mmap:
+        try:
+            hive = MappedHive(regfile)
+        except (EnvironmentError, ValueError):
+            g_logger.debug("Failed to map %s, reading it instead", regfile)
+        else:
+            return Registry.Registry(hive), hive
+    return Registry.Registry(regfile), None
+
+
+@contextlib.contextmanager
+def open_hive(regfile, use_mmap=True):
+    """
+    Context manager for a python-registry Registry object for the hive
+    at the given path (see `load_hive`). If the hive is memory mapped,
+    it is unmapped on exit, so nothing parsed from it may be used after.
+    Arguments:
+    - `regfile`: The path of a hive file.
+    - `use_mmap`: (Optional) Whether to memory map the hive.
+    """
+    reg, hive = load_hive(regfile, use_mmap=use_mmap)
+    try:
+        yield reg
+    finally:
+        if hive is not None:
+            hive.close()
+
+
+def iter_opened_hives(regfiles, use_mmap=True):
+    """
+    Given paths to Registry hive files, yield a tuple (path, python-registry
+    Registry object) for each hive, in the order given. Each hive is
+    opened with `open_hive`, and closed when the next one is requested.
+    Arguments:
+    - `regfiles`: A list of strings with paths to Registry hive files.
+    - `use_mmap`: (Optional) Whether to memory map the hives.
+    """
+    for regfile in regfiles:
+        with open_hive(regfile, use_mmap=use_mmap) as reg:
+            yield regfile, reg
+
+
+def iter_prefetched_hives(regfiles, prefetch):
+    """
+    Given paths to Registry hive files, yield a tuple (path, python-registry
+    Registry object) for each hive, in the order given, while a pool of
+    threads reads the next hives into memory. This overlaps the reads of
+    slow storage with the parsing of the current hive.
+    At most `prefetch` hives are read ahead of the one being parsed, so
+    no more than `prefetch` + 1 hives are held in memory at once.
+    Arguments:
+    - `regfiles`: A list of strings with paths to Registry hive files.
+    - `prefetch`: The number of hives to read ahead.
     Throws:
+    - `EnvironmentError`: when a hive that could not be read is reached.
+    """
+    pool = multiprocessing.pool.ThreadPool(prefetch)
+    regfiles = iter(regfiles)
+    pending = collections.deque()
+
+    def read_next():
+        for regfile in regfiles:
+            pending.append((regfile, pool.apply_async(Registry.Registry, (regfile,))))
+            return
+
+    try:
+        for _ in range(prefetch):
+            read_next()
+        while pending:
+            regfile, result = pending.popleft()
+            reg = result.get()
+            read_next()
+            yield regfile, reg
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def value_data(value):
+    """
+    Return the data of a python-registry RegistryValue object. For binary
+    data within a single cell of a memory mapped hive, this is a view of
+    the cell, rather than a copy.
+    Arguments:
+    - `value`: A python-registry RegistryValue object.
+    """
+    # python-registry always slices value data out of its buffer,
+    #   so locate the cell in the mapping directly. This relies on the
+    #   internals of the python-registry version in requirements.txt,
+    #   which test_value_data checks.
+    vk = value._vkrecord
+    length = vk.raw_data_length()
+    if isinstance(vk._buf, mmap.mmap) and 5 <= length <= MAX_CELL_DATA_LENGTH and \
+            vk.data_type() in (Registry.RegBin, Registry.RegNone):
+        start = vk.data_offset() + 4
+        return buffer_view(vk._buf, start, start + length)
+    return value.value()
+
+
+def timed(iterable, record):
+    """
+    Generator of the elements of `iterable`. Once it is exhausted, or
+    fails, calls `record(count, seconds)` with the number of elements,
+    and the time spent producing them, excluding the consumer's time.
+    Arguments:
+    - `iterable`: An iterable.
+    - `record`: A function (number of elements, seconds).
+    """
+    iterator = iter(iterable)
+    count = 0
+    elapsed = 0.0
+    try:
+        while True:
+            start = timeit.default_timer()
+            try:
+                element = next(iterator)
+            finally:
+                elapsed += timeit.default_timer() - start
+            count += 1
+            yield element
+    except StopIteration:
+        return
+    finally:
+        record(count, elapsed)
+
+
+# BagMRU values that refer to subkeys have numeric names
+NUMERIC_NAME = re.compile("\d+")
+
+# Extraction scopes: the folder paths from the BagMRU values, the items
+# in the ItemPos values of the corresponding Bags keys, or both
+SCOPE_BAGMRU = "bagmru"
+SCOPE_ITEMPOS = "itempos"
+SCOPE_ALL = "all"
+SCOPES = (SCOPE_BAGMRU, SCOPE_ITEMPOS, SCOPE_ALL)
+
+# Paths of the keys with BagMRU and Bags subkeys
+SHELL_KEY_PATHS = [
+    # xp
+    "Software\\Microsoft\\Windows\\Shell",
+    "Software\\Microsoft\\Windows\\ShellNoRoam",
+    # win7
+    "Local Settings\\Software\\Microsoft\\Windows\\ShellNoRoam",
+    "Local Settings\\Software\\Microsoft\\Windows\\Shell",
+]
+
+# The partition of a BagMRU key structure with the ItemPos items of the
+# BagMRU key itself; the other partitions are named by its numbered values
+ROOT_PARTITION = ""
+
+
+class BagsIndex(object):
+    """
+    An index of the slot subkeys of a 'Bags' key by name, built by
+      enumerating the 'Bags' key once, rather than searching its subkey
+      list for each NodeSlot. The ItemPos values of the bags of a slot
+      are indexed the first time the slot is resolved.
+    The index also tracks which slots are referred to, so that orphaned
+      slots, which no BagMRU key refers to, can be reported.
+    """
+    def __init__(self, bags_key):
+        """
+        Arguments:
+        - `bags_key`: A python-registry RegistryKey object for the 'Bags' key.
+        """
+        self._path = bags_key.path()
+        self._slots = {}
+        for slot_key in bags_key.subkeys():
+            self._slots[slot_key.name().lower()] = slot_key
+        # slot name -> list of (bag key path, list of ItemPos values)
+        self._itempos = {}
+        self._referenced = set()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def itempos_values(self, slot):
+        """
+        Return a list of tuples (bag key path, list of ItemPos values), one
+          for each bag subkey of the given slot, in Registry order.
+        The slot is marked as referred to.
+        Arguments:
+        - `slot`: The NodeSlot number, or name of the slot subkey.
+        Throws:
+        - `Registry.RegistryKeyNotFoundException`: if the slot does not exist.
+        """
+        name = str(slot).lower()
+        self._referenced.add(name)
+        try:
+            return self._itempos[name]
+        except KeyError:
+            pass
+        try:
+            slot_key = self._slots[name]
+        except KeyError:
+            raise Registry.RegistryKeyNotFoundException(self._path + "\\" + str(slot))
+        bags = []
+        slot_path = self._path + "\\" + slot_key.name()
+        for bag in slot_key.subkeys():
+            bags.append((slot_path + "\\" + bag.name(),
+                         [value for value in bag.values() if "ItemPos" in value.name()]))
+        self._itempos[name] = bags
+        return bags
+
+    def timestamp(self, slot):
+        """
+        Return the latest last write time of the slot subkey and its bag
+          subkeys, or None if the slot does not exist.
+        This does not mark the slot as referred to.
+        Arguments:
+        - `slot`: The NodeSlot number, or name of the slot subkey.
+        """
+        try:
+            slot_key = self._slots[str(slot).lower()]
+        except KeyError:
+            return None
+        return max([slot_key.timestamp()] + [bag.timestamp() for bag in slot_key.subkeys()])
+
+    def referenced_slots(self):
+        """
+        Return a set of the names of the slots that have been referred to.
+        """
+        return set(self._referenced)
+
+    def refer(self, slots):
+        """
+        Mark slots as referred to, such as those found by the walks of the
+          other partitions of the same BagMRU key structure.
+        Arguments:
+        - `slots`: An iterable of slot names, as from `referenced_slots`.
+        """
+        self._referenced.update(slots)
+
+    def orphan_slots(self):
+        """
+        Return a list of the numbered slot subkeys that have not been
+          referred to, in numeric order. Other subkeys, such as
+          'AllFolders', are templates rather than slots.
+        """
+        orphans = [slot_key for name, slot_key in self._slots.items()
+                   if name.isdigit() and name not in self._referenced]
+        orphans.sort(key=lambda slot_key: (len(slot_key.name()), slot_key.name()))
+        return orphans
+
+
+def literal_prefix(pattern):
     """
-    shellbags = []
+    Return the literal string that every match of a compiled regular
+    expression begins with, if it is anchored to the start of the string
+    with '^' or '\\A', or None.
+    Arguments:
+    - `pattern`: A compiled regular expression.
+    Throws:
+    """
+    parsed = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    if not parsed or parsed[0] not in ((sre_constants.AT, sre_constants.AT_BEGINNING),
+                                       (sre_constants.AT, sre_constants.AT_BEGINNING_STRING)):
+        return None
+    chars = []
+    for op, av in parsed[1:]:
+        if op != sre_constants.LITERAL:
+            break
+        chars.append(unichr(av))
+    return u"".join(chars)
+
+
+class ShellbagFilter(object):
+    """
+    Selects shellbag records by a time window and a path pattern, while
+      the BagMRU keys are walked, so that the values and subtrees that
+      cannot contain a selected record are neither parsed nor yielded.
+    A record is in the time window if any of its timestamps (mtime,
+      atime, crtime, or the BagMRU key last write time) is. Item dates
+      that are missing or invalid, which decode to datetime.min, are
+      in no window, so such records are selected by the key last write
+      time alone.
+    The timestamps of a shell item are taken when its value is written,
+      so they are no later than the last write time of the key holding
+      the value, give or take `slack` for DOS dates in local time.
+      Values and subtrees whose keys were all last written before
+      `since`, less the slack, are skipped.
+    A pattern anchored with '^' or '\\A' prunes the keys whose paths
+      do not share its literal prefix.
+    """
+    slack = datetime.timedelta(days=1)
+
+    def __init__(self, since=None, until=None, path_regex=None):
+        """
+        Constructor.
+        Arguments:
+        - `since`: (Optional) A Python datetime object, in UTC, for the
+             start of the time window.
+        - `until`: (Optional) A Python datetime object, in UTC, for the
+             end of the time window.
+        - `path_regex`: (Optional) A compiled regular expression to search
+             the paths for.
+        """
+        self.since = since
+        self.until = until
+        self.path_regex = path_regex
+        self._prefix = None
+        if path_regex is not None:
+            self._prefix = literal_prefix(path_regex)
+            if self._prefix is not None and path_regex.flags & re.IGNORECASE:
+                self._prefix = self._prefix.lower()
+
+    def is_stale(self, timestamp):
+        """
+        Return True if no record from a key last written at `timestamp`
+        can be in the time window.
+        Arguments:
+        - `timestamp`: A Python datetime object, or None for no key.
+        """
+        if self.since is None:
+            return False
+        return timestamp is None or timestamp < self.since - self.slack
+
+    def excludes_path(self, node):
+        """
+        Return True if no record below a BagMRU key can match the path pattern.
+        Arguments:
+        - `node`: The PathNode of the path of the key.
+        """
+        if self._prefix:
+            # both are unicode, so non-ASCII characters compare without
+            #   being implicitly decoded
+            path = text_field(node.path()) + u"\\"
+            if self.path_regex.flags & re.IGNORECASE:
+                path = path.lower()
+            if not (path.startswith(self._prefix) or self._prefix.startswith(path)):
+                return True
+        return False
+
+    def in_window(self, d):
+        """
+        Return True if a timestamp is valid and in the time window.
+        Arguments:
+        - `d`: A Python datetime object, or a raw DOSDATE/DOSTIME integer.
+        """
+        d = date_decode(d)
+        if d == datetime.datetime.min:
+            return False
+        if self.since is not None and d < self.since:
+            return False
+        if self.until is not None and d > self.until:
+            return False
+        return True
+
+    def matches(self, shellbag):
+        """
+        Return True if the given ShellbagRecord is selected.
+        """
+        if self.since is not None or self.until is not None:
+            if not (self.in_window(shellbag.klwt) or
+                    self.in_window(shellbag.raw_mtime) or
+                    self.in_window(shellbag.raw_atime) or
+                    self.in_window(shellbag.raw_crtime)):
+                return False
+        if self.path_regex is not None and not self.path_regex.search(shellbag.path):
+            return False
+        return True
+
+
+def bagmru_timestamps(bagmru_key, bags_index=None, max_depth=None):
+    """
+    Walk the BagMRU key structure without parsing any values, and
+    return a tuple of two dicts, from the lowercase path of each BagMRU
+    key to the latest last write time of the key itself and the bags of
+    its NodeSlot, and to the latest of those in its whole subtree.
+    Arguments:
+    - `bagmru_key`: A python-registry RegistryKey object for the 'BagMRU' key.
+    - `bags_index`: (Optional) A BagsIndex for the 'Bags' key, to include
+         the last write times of the bags.
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into, where the BagMRU key itself has depth 0.
+         By default, there is no limit.
+    Throws:
+    """
+    # the paths are built from the parent paths, as RegistryKey.path()
+    #   walks up to the root key for each key
+    keys = []
+    stack = [(bagmru_key, bagmru_key.path().lower(), 0)]
+    while stack:
+        key, path, depth = stack.pop()
+        if max_depth is not None and depth >= max_depth:
+            subkeys = []
+        else:
+            subkeys = [(subkey, path + "\\" + subkey.name().lower()) for subkey in key.subkeys()]
+        keys.append((key, path, subkeys))
+        stack.extend((subkey, subkey_path, depth + 1) for subkey, subkey_path in subkeys)
+
+    own = {}
+    subtree = {}
+    # each key comes after its parent, so in reverse, before it
+    for key, path, subkeys in reversed(keys):
+        latest = key.timestamp()
+        if bags_index is not None:
+            try:
+                latest = max(latest, bags_index.timestamp(key.value("NodeSlot").value()))
+            except Registry.RegistryValueNotFoundException:
+                pass
+        own[path] = latest
+        for _, subkey_path in subkeys:
+            latest = max(latest, subtree[subkey_path])
+        subtree[path] = latest
+    return own, subtree
+
+
+def bagmru_partitions(shell_key, scope=SCOPE_ALL):
+    """
+    Return a list of the partitions of the BagMRU key structure of a Shell
+    key, in the order they are walked: ROOT_PARTITION, for the ItemPos
+    items of the BagMRU key, then the name of each numbered value of the
+    BagMRU key, for its items and everything below the subkey of the same
+    name. The partitions can be parsed independently, and their items
+    concatenated in this order are the items of the whole structure.
+    Arguments:
+    - `shell_key`: A python-registry RegistryKey object.
+    - `scope`: (Optional) One of SCOPES.
+    Throws:
+    - `Registry.RegistryKeyNotFoundException`: if the BagMRU key, or the
+        Bags key unless the scope is SCOPE_BAGMRU, does not exist.
+    """
+    bagmru_key = shell_key.subkey("BagMRU")
+    if scope != SCOPE_BAGMRU:
+        shell_key.subkey("Bags")
+    return [ROOT_PARTITION] + [value.name() for value in bagmru_key.values()
+                               if NUMERIC_NAME.match(value.name())]
+
+
+def iter_key_shellbags(shell_key, max_depth=None, scope=SCOPE_ALL,
+                       shellbag_filter=None, partition=None, index_cache=None):
+    """
+    Given a python-registry RegistryKey object, look for and yield
+    shellbag items as they are discovered. A shellbag item is a
+    ShellbagRecord with the attributes (mtime, atime, crtime, path).
+    Arguments:
+    - `shell_key`: A python-registry RegistryKey object.
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into, where the BagMRU key itself has depth 0.
+         By default, there is no limit.
+    - `scope`: (Optional) One of SCOPES. SCOPE_BAGMRU yields only the
+         items of the BagMRU values, and never opens the Bags key.
+         SCOPE_ITEMPOS yields only the items of the ItemPos values,
+         though the BagMRU values are still parsed for their paths.
+         By default, SCOPE_ALL yields both.
+    - `shellbag_filter`: (Optional) A ShellbagFilter that selects the
+         items to yield, and prunes the BagMRU keys that cannot have any.
+    - `partition`: (Optional) Only yield the items of this partition of
+         the BagMRU key structure (see `bagmru_partitions`). By default,
+         the items of the whole structure.
+    - `index_cache`: (Optional) A dict in which to keep the BagsIndex and
+         the BagMRU timestamps of the Shell key, so that the calls for
+         each partition of the same key, with the same `max_depth` and
+         `scope`, build them only once.
+    Throws:
+    - `Registry.RegistryKeyNotFoundException`: if the BagMRU or Bags
+        keys do not exist.
+    - `ValueError`: if `scope` is not one of SCOPES.
+    """
+    if scope not in SCOPES:
+        raise ValueError("Unknown shellbag scope: %s" % scope)
     bagmru_key = shell_key.subkey("BagMRU")
-    bags_key = shell_key.subkey("Bags")
+    if index_cache is None:
+        index_cache = {}
+    bags_index = None
+    if scope != SCOPE_BAGMRU:
+        if "bags_index" not in index_cache:
+            index_cache["bags_index"] = BagsIndex(shell_key.subkey("Bags"))
+        bags_index = index_cache["bags_index"]
+    stats = get_stats()
 
-    def shellbag_rec(key, bag_prefix, path_prefix):
+    def itempos_shellbags(key, key_path, klwt, parent_node):
         """
-        Function to recursively parse the BagMRU Registry key structure.
+        Generator of the shellbag items in the ItemPos values of the
+        'Bags' key that corresponds to a 'BagMRU' key.
         Arguments:
-        `key`: The current 'BagsMRU' key to recurse into.
-        `bag_prefix`: A string containing the current subkey path of
-            the relevant 'Bags' key. It will look something like '1\\2\\3\\4'.
-        `path_prefix` A string containing the current human-readable,
+        `key`: The current 'BagsMRU' key.
+        `key_path`: The path of the current 'BagMRU' key.
+        `klwt`: The last write time of the current 'BagMRU' key.
+        `parent_node` The PathNode of the current human-readable,
             file system path so far constructed.
         Throws:
         """
+        bag_path = key_path
         try:
-            # First, consider the current key, and extract shellbag items
             slot = key.value("NodeSlot").value()
-            for bag in bags_key.subkey(str(slot)).subkeys():
-                for value in [value for value in bag.values() if
-                              "ItemPos" in value.name()]:
-                    buf = value.value()
-
-                    block = SHITEMLIST(buf, 0x0, False)
-                    offset = 0x10
-
-                    while True:
-                        offset += 0x8
-                        size = block.unpack_word(offset)
-                        if size == 0:
-                            break
-                        elif size < 0x15:
-                            pass
-                        else:
-                            item = block.get_item(offset)
-                            shellbags.append({
-                                "path": path_prefix + "\\" + item.name(),
-                                "mtime": item.m_date(),
-                                "atime": item.a_date(),
-                                "crtime": item.cr_date(),
-                                "source":  bag.path() + " @ " + hex(item.offset()),
-                                "regsource": bag.path() + "\\" + value.name(),
-                                "klwt": key.timestamp()
-                            })
-                        offset += size
-        except Registry.RegistryValueNotFoundException:
+            for bag_path, values in bags_index.itempos_values(slot):
+                for value in values:
+                    items = cached_items(value_data(value), itempos=True)
+                    if stats is not None:
+                        items = timed(items, stats.add_itempos_value)
+                    for item in items:
+                        yield ShellbagRecord(parent_node.child(item.name),
+                                             item.raw_m_date,
+                                             item.raw_a_date,
+                                             item.raw_cr_date,
+                                             klwt,
+                                             bag_path,
+                                             value.name(),
+                                             item.offset)
+        except Registry.RegistryValueNotFoundException as e:
             g_logger.warning("Registry.RegistryValueNotFoundException")
-            pass
-        except Registry.RegistryKeyNotFoundException:
+            if stats is not None:
+                stats.add_exception(e, bag_path)
+        except Registry.RegistryKeyNotFoundException as e:
             g_logger.warning("Registry.RegistryKeyNotFoundException")
-            pass
-        except:
+            if stats is not None:
+                stats.add_exception(e, bag_path)
+        except Exception as e:
             g_logger.warning("Unexpected error %s" % sys.exc_info()[0])
+            if stats is not None:
+                stats.add_exception(e, bag_path)
 
-        # Next, recurse into each BagMRU key
-        for value in [value for value in key.values()
-                      if re.match("\d+", value.name())]:
-            path = ""
-            try:  # TODO(wb): removeme
-                l = SHITEMLIST(value.value(), 0, False)
-                for item in l.items():
+    def walk():
+        """
+        Generator to parse the BagMRU Registry key structure depth-first,
+        using an explicit stack rather than recursion. For each key, the
+        ItemPos items come first, then each numeric value's items followed
+        by everything below the subkey with the same name.
+        Each stack frame is a tuple (key, key path, key last write time,
+        pending values, PathNode of the path prefix, depth).
+        Throws:
+        """
+        stack = []
+        root = PathNode()
+        pruned = 0
+        own_latest = subtree_latest = None
+        if shellbag_filter is not None and shellbag_filter.since is not None:
+            if "timestamps" not in index_cache:
+                index_cache["timestamps"] = bagmru_timestamps(bagmru_key, bags_index,
+                                                              max_depth=max_depth)
+            own_latest, subtree_latest = index_cache["timestamps"]
+        key, key_path, parent_node, depth = bagmru_key, bagmru_key.path(), root, 0
+        while True:
+            if key is not None:
+                # First, consider the new key, and extract shellbag items
+                klwt = key.timestamp()
+                if shellbag_filter is not None and \
+                   (shellbag_filter.excludes_path(parent_node) or
+                    (subtree_latest is not None and
+                     shellbag_filter.is_stale(subtree_latest[key_path.lower()]))):
+                    g_logger.debug("Pruning %s: no shellbags can match", key_path)
+                    pruned += 1
+                    key = None
+                    continue
+                # with a partition of the key structure, the BagMRU key
+                # itself only belongs to ROOT_PARTITION
+                in_partition = partition is None or depth > 0 or partition == ROOT_PARTITION
+                if stats is not None and in_partition:
+                    stats.add_bagmru_key(depth)
+                if own_latest is not None and bags_index is not None and \
+                   shellbag_filter.is_stale(own_latest[key_path.lower()]):
+                    pruned += 1
+                elif bags_index is not None and in_partition:
+                    for shellbag in itempos_shellbags(key, key_path, klwt, parent_node):
+                        yield shellbag
+                values = [value for value in key.values()
+                          if NUMERIC_NAME.match(value.name())]
+                if partition is not None and depth == 0:
+                    values = [value for value in values if value.name() == partition]
+                stack.append((key, key_path, klwt, iter(values),
+                              parent_node, depth))
+                key = None
+
+            if not stack:
+                if pruned:
+                    index_cache["pruned"] = True
+                # Orphans are only known once every BagMRU key is visited,
+                # which a single partition does not do, so the referenced
+                # slots of the partitions are merged instead (see
+                # `iter_split_hive_shellbags`)
+                if bags_index is not None and partition is None and \
+                   max_depth is None and not pruned:
+                    report_orphan_slots(bags_index)
+                return
+
+            # Next, continue with the next value of the innermost key
+            parent, key_path, klwt, values, parent_node, depth = stack[-1]
+            value = next(values, None)
+            if value is None:
+                stack.pop()
+                continue
+
+            if subtree_latest is not None and shellbag_filter.is_stale(klwt) and \
+               shellbag_filter.is_stale(subtree_latest.get(key_path.lower() + "\\" +
+                                                            value.name().lower())):
+                # neither this value nor anything below its subkey can match
+                pruned += 1
+                continue
+
+            node = root
+            try:
+                items = cached_items(value_data(value))
+                if stats is not None:
+                    items = timed(items, functools.partial(stats.add_bagmru_value, depth))
+                for item in items:
                     # assume there is only one entry in the value, or take the last
                     # as the path component
-                    path = path_prefix + "\\" + item.name()
-                    shellbags.append({
-                        "path":  path,
-                        "mtime": item.m_date(),
-                        "atime": item.a_date(),
-                        "crtime": item.cr_date(),
-                        "source": key.path() + " @ " + hex(item.offset()),
-                        "regsource": key.path() + "\\" + value.name(),
-                        "klwt":  key.timestamp()
-                    })
-            except OverrunBufferException:
-                print key.path()
-                print value.name()
+                    node = parent_node.child(item.name)
+                    if scope == SCOPE_ITEMPOS:
+                        continue
+                    yield ShellbagRecord(node,
+                                         item.raw_m_date,
+                                         item.raw_a_date,
+                                         item.raw_cr_date,
+                                         klwt,
+                                         key_path,
+                                         value.name(),
+                                         item.offset)
+            except OverrunBufferException as e:
+                g_logger.warning("Overrun parsing shellbag value %s\\%s: %s",
+                                 key_path, value.name(), e)
+                if stats is not None:
+                    stats.add_exception(e, key_path + "\\" + value.name())
+                raise
+            except Exception as e:
+                if stats is not None:
+                    stats.add_exception(e, key_path + "\\" + value.name())
                 raise
 
-            shellbag_rec(key.subkey(value.name()),
-                         bag_prefix + "\\" + value.name(),
-                         path)
+            if max_depth is not None and depth >= max_depth:
+                g_logger.debug("Not descending below %s\\%s: maximum depth reached",
+                               key_path, value.name())
+                continue
+            key, parent_node, depth = parent.subkey(value.name()), node, depth + 1
+            key_path = key_path + "\\" + key.name()
 
-    shellbag_rec(bagmru_key, "", "")
-    return shellbags
+    if shellbag_filter is None:
+        return walk()
+    return (shellbag for shellbag in walk() if shellbag_filter.matches(shellbag))
 
 
-def get_all_shellbags(reg):
+def report_orphan_slots(bags_index):
     """
-    Given a python-registry Registry object, look for and return a
-    list of shellbag items. A shellbag item is a dict with the keys
-    (mtime, atime, crtime, path).
+    Log, and count in the ParseStats being collected, the slots of a
+    BagsIndex that no BagMRU key referred to.
+    Arguments:
+    - `bags_index`: A BagsIndex, after the BagMRU walk.
+    Throws:
+    """
+    stats = get_stats()
+    for slot_key in bags_index.orphan_slots():
+        g_logger.info("Orphaned Bags slot: %s", slot_key.path())
+        if stats is not None:
+            stats.add_orphan_slot(slot_key.path())
+
+
+def get_shellbags(shell_key, max_depth=None, scope=SCOPE_ALL, shellbag_filter=None):
+    """
+    Given a python-registry RegistryKey object, look for and return a
+    list of shellbag items. A shellbag item is a ShellbagRecord with the
+    attributes (mtime, atime, crtime, path).
+    Arguments:
+    - `shell_key`: A python-registry Registry object.
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into. By default, there is no limit.
+    - `scope`: (Optional) One of SCOPES. With SCOPE_BAGMRU, the Bags
+         key is never opened. By default, SCOPE_ALL.
+    - `shellbag_filter`: (Optional) A ShellbagFilter that selects the
+         items, and prunes the BagMRU keys that cannot have any.
+    Throws:
+    """
+    return list(iter_key_shellbags(shell_key, max_depth=max_depth, scope=scope,
+                                   shellbag_filter=shellbag_filter))
+
+
+def iter_shellbags(reg, max_depth=None, scope=SCOPE_ALL, shellbag_filter=None):
+    """
+    Given a python-registry Registry object, look for and yield
+    shellbag items as they are discovered. A shellbag item is a
+    ShellbagRecord with the attributes (mtime, atime, crtime, path).
     Arguments:
     - `reg`: A python-registry Registry object.
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into. By default, there is no limit.
+    - `scope`: (Optional) One of SCOPES. With SCOPE_BAGMRU, the Bags
+         key is never opened. By default, SCOPE_ALL.
+    - `shellbag_filter`: (Optional) A ShellbagFilter that selects the
+         items, and prunes the BagMRU keys that cannot have any.
     Throws:
     """
-    shellbags = []
-    paths = [
-        # xp
-        "Software\\Microsoft\\Windows\\Shell",
-        "Software\\Microsoft\\Windows\\ShellNoRoam",
-        # win7
-        "Local Settings\\Software\\Microsoft\\Windows\\ShellNoRoam",
-        "Local Settings\\Software\\Microsoft\\Windows\\Shell",
-    ]
-
-    for path in paths:
+    for path in SHELL_KEY_PATHS:
         try:
             shell_key = reg.open(path)
-            new = get_shellbags(shell_key)
-            shellbags.extend(new)
+            for shellbag in iter_key_shellbags(shell_key, max_depth=max_depth,
+                                               scope=scope,
+                                               shellbag_filter=shellbag_filter):
+                yield shellbag
         except Registry.RegistryKeyNotFoundException:
             pass
-        except Exception:
+        except Exception as e:
             g_logger.exception("Unhandled exception while parsing %s" % path)
+            stats = get_stats()
+            if stats is not None:
+                stats.add_exception(e, path)
 
-    return shellbags
 
+def get_all_shellbags(reg, max_depth=None, scope=SCOPE_ALL, shellbag_filter=None):
+    """
+    Given a python-registry Registry object, look for and return a
+    list of shellbag items. A shellbag item is a ShellbagRecord with the
+    attributes (mtime, atime, crtime, path).
+    Arguments:
+    - `reg`: A python-registry Registry object.
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into. By default, there is no limit.
+    - `scope`: (Optional) One of SCOPES. With SCOPE_BAGMRU, the Bags
+         key is never opened. By default, SCOPE_ALL.
+    - `shellbag_filter`: (Optional) A ShellbagFilter that selects the
+         items, and prunes the BagMRU keys that cannot have any.
+    Throws:
+    """
+    return list(iter_shellbags(reg, max_depth=max_depth, scope=scope,
+                               shellbag_filter=shellbag_filter))
 
-def print_shellbag_csv(shellbags, regfile):
-    stdoutWriter = csv.writer(sys.stdout)
-    stdoutWriter.writerow(["Key Last Write Time", "Hive",
-                           "Modification Date", "Accessed Date",
-                           "Creation Date", "Path", "Key"])
-    for shellbag in shellbags:
-        modified = date_safe_str(shellbag["mtime"])
-        accessed = date_safe_str(shellbag["atime"])
-        created = date_safe_str(shellbag["crtime"])
-        keymod = date_safe_str(shellbag["klwt"])
+
+def get_hive_shellbags(regfile, max_depth=None, use_mmap=True, scope=SCOPE_ALL,
+                       shellbag_filter=None):
+    """
+    Given the path to a Registry hive file, parse it and return a
+    tuple (path, list of shellbag items).
+    This is the unit of work when processing hives in worker processes.
+    Arguments:
+    - `regfile`: A string with the path to a Registry hive file.
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into. By default, there is no limit.
+    - `scope`: (Optional) One of SCOPES. With SCOPE_BAGMRU, the Bags
+         key is never opened. By default, SCOPE_ALL.
+    - `shellbag_filter`: (Optional) A ShellbagFilter that selects the
+         items, and prunes the BagMRU keys that cannot have any.
+    - `use_mmap`: (Optional) Whether to memory map the hive.
+    Throws:
+    """
+    with open_hive(regfile, use_mmap=use_mmap) as reg:
+        return regfile, get_all_shellbags(reg, max_depth=max_depth, scope=scope,
+                                          shellbag_filter=shellbag_filter)
+
+
+# number of shellbag items that a worker process sends back at once
+SHELLBAG_CHUNK_SIZE = 0x400
+
+# The queue that this worker process sends chunks of shellbag items to
+g_worker_queue = None
+
+
+def set_worker_queue(queue):
+    """
+    Initializer of the worker processes of `iter_hive_shellbags`.
+    Arguments:
+    - `queue`: A multiprocessing Queue.
+    """
+    global g_worker_queue
+    g_worker_queue = queue
+
+
+def put_hive_shellbags(task, max_depth=None, use_mmap=True, scope=SCOPE_ALL,
+                       shellbag_filter=None, collect_stats=False):
+    """
+    Given a tuple (index, path to a Registry hive file), parse the hive,
+    and put a tuple (index, list of shellbag items) on the worker queue
+    for each SHELLBAG_CHUNK_SIZE items, then (index, None) once the hive
+    is done, even if parsing fails. Return the ParseStats, or None.
+    This is the unit of work when processing hives in worker processes,
+    so that no more than a chunk of items is held in a worker at once.
+    Arguments:
+    - `task`: A tuple (index, path to a Registry hive file).
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into. By default, there is no limit.
+    - `use_mmap`: (Optional) Whether to memory map the hive.
+    - `scope`: (Optional) One of SCOPES. By default, SCOPE_ALL.
+    - `shellbag_filter`: (Optional) A ShellbagFilter that selects the
+         items, and prunes the BagMRU keys that cannot have any.
+    - `collect_stats`: (Optional) Whether to collect a new ParseStats.
+    Throws:
+    """
+    index, regfile = task
+    stats = enable_stats(collect_stats)
+    start = timeit.default_timer()
+    count = 0
+    try:
+        with open_hive(regfile, use_mmap=use_mmap) as reg:
+            chunk = ShellbagBatch()
+            for shellbag in iter_shellbags(reg, max_depth=max_depth, scope=scope,
+                                           shellbag_filter=shellbag_filter):
+                chunk.append(shellbag)
+                if len(chunk) >= SHELLBAG_CHUNK_SIZE:
+                    g_worker_queue.put((index, chunk))
+                    count += len(chunk)
+                    chunk = ShellbagBatch()
+            if chunk:
+                g_worker_queue.put((index, chunk))
+                count += len(chunk)
+    finally:
+        g_worker_queue.put((index, None))
+    if stats is not None:
+        stats.add_hive(regfile, count, timeit.default_timer() - start)
+    return stats
+
+
+# The (path, Registry object, MappedHive or None, dict from (Shell key
+# path, max_depth, scope) to the index cache of `iter_key_shellbags`) of
+# the hive last opened by this worker process
+g_worker_hive = None
+
+
+def get_partition_shellbags(task, max_depth=None, use_mmap=True, scope=SCOPE_ALL,
+                            shellbag_filter=None, collect_stats=False):
+    """
+    Given a tuple (path to a Registry hive file, path of a Shell key,
+    partition), parse the partition of the BagMRU key structure, and
+    return a tuple (list of shellbag items, whether parsing failed,
+    ParseStats or None, set of the names of the Bags slots referred to).
+    The set is None if the orphaned slots can't be known, because parsing
+    failed, or keys were pruned or not descended into.
+    This is the unit of work when the BagMRU key structures of a hive are
+    split across worker processes. Each worker opens the hive itself,
+    and keeps it open, with the BagsIndex and BagMRU timestamps of each
+    Shell key, for the next partition.
+    Arguments:
+    - `task`: A tuple (path to a Registry hive file, path of a Shell key,
+         partition).
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into. By default, there is no limit.
+    - `use_mmap`: (Optional) Whether to memory map the hive.
+    - `scope`: (Optional) One of SCOPES. By default, SCOPE_ALL.
+    - `shellbag_filter`: (Optional) A ShellbagFilter that selects the
+         items, and prunes the BagMRU keys that cannot have any.
+    - `collect_stats`: (Optional) Whether to collect a new ParseStats.
+    Throws:
+    """
+    global g_worker_hive
+    regfile, shell_path, partition = task
+    stats = enable_stats(collect_stats)
+    start = timeit.default_timer()
+    if g_worker_hive is None or g_worker_hive[0] != regfile:
+        if g_worker_hive is not None and g_worker_hive[2] is not None:
+            g_worker_hive[2].close()
+        g_worker_hive = None
+        g_worker_hive = (regfile,) + load_hive(regfile, use_mmap=use_mmap) + ({},)
+    index_cache = g_worker_hive[3].setdefault((shell_path, max_depth, scope), {})
+    shellbags = ShellbagBatch()
+    failed = False
+    try:
+        for shellbag in iter_key_shellbags(g_worker_hive[1].open(shell_path),
+                                           max_depth=max_depth, scope=scope,
+                                           shellbag_filter=shellbag_filter,
+                                           partition=partition,
+                                           index_cache=index_cache):
+            shellbags.append(shellbag)
+    except Exception as e:
+        g_logger.exception("Unhandled exception while parsing %s" % shell_path)
+        if stats is not None:
+            stats.add_exception(e, shell_path)
+        failed = True
+    if stats is not None:
+        stats.add_hive(regfile, len(shellbags), timeit.default_timer() - start)
+    referenced = None
+    if not failed and max_depth is None and "bags_index" in index_cache and \
+       not index_cache.get("pruned"):
+        # the slots of the other partitions this worker parsed are
+        # included, which are referred to all the same
+        referenced = index_cache["bags_index"].referenced_slots()
+    return shellbags, failed, stats, referenced
+
+
+def iter_split_hive_shellbags(regfiles, jobs=2, max_depth=None, use_mmap=True,
+                              scope=SCOPE_ALL, shellbag_filter=None):
+    """
+    Given paths to Registry hive files, yield a tuple (path, list of
+    shellbag items) for each hive, in the order given.
+    The BagMRU key structure of each hive is split into partitions (see
+    `bagmru_partitions`), which are parsed in a pool of worker processes.
+    The items of the partitions are put back together in the order of
+    the serial walk, so the output is the same as with one job.
+    Likewise, the Bags slots referred to by the partitions of each Shell
+    key are merged, and the orphaned slots reported once per key.
+    If a ParseStats is being collected, the stats of the workers are merged
+    into it.
+    Arguments:
+    - `regfiles`: A list of strings with paths to Registry hive files.
+    - `jobs`: (Optional) The number of worker processes to use.
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into. By default, there is no limit.
+    - `use_mmap`: (Optional) Whether to memory map the hives.
+    - `scope`: (Optional) One of SCOPES. By default, SCOPE_ALL.
+    - `shellbag_filter`: (Optional) A ShellbagFilter that selects the
+         items, and prunes the BagMRU keys that cannot have any.
+    Throws:
+    """
+    stats = get_stats()
+    hive_tasks = []
+    for regfile, reg in iter_opened_hives(regfiles, use_mmap=use_mmap):
+        tasks = []
+        for shell_path in SHELL_KEY_PATHS:
+            try:
+                partitions = bagmru_partitions(reg.open(shell_path), scope=scope)
+            except Registry.RegistryKeyNotFoundException:
+                continue
+            tasks.extend((regfile, shell_path, partition) for partition in partitions)
+        hive_tasks.append((regfile, tasks))
+
+    pool = multiprocessing.Pool(jobs)
+    worker = functools.partial(get_partition_shellbags, max_depth=max_depth,
+                               use_mmap=use_mmap, scope=scope,
+                               shellbag_filter=shellbag_filter,
+                               collect_stats=stats is not None)
+    try:
+        results = pool.imap(worker, [task for _, tasks in hive_tasks for task in tasks])
+        for regfile, tasks in hive_tasks:
+            shellbags = []
+            failed_paths = set()
+            # Shell key path -> set of referenced slots, or None if unknown
+            referenced = collections.OrderedDict()
+            for _, shell_path, _ in tasks:
+                partition_shellbags, failed, worker_stats, slots = next(results)
+                if stats is not None:
+                    stats.merge(worker_stats)
+                if slots is None or referenced.get(shell_path, set()) is None:
+                    referenced[shell_path] = None
+                else:
+                    referenced.setdefault(shell_path, set()).update(slots)
+                # like the serial walk, stop at the first failure
+                if shell_path in failed_paths:
+                    continue
+                shellbags.extend(partition_shellbags)
+                if failed:
+                    failed_paths.add(shell_path)
+            if any(slots is not None for slots in referenced.values()):
+                with open_hive(regfile, use_mmap=use_mmap) as reg:
+                    for shell_path, slots in referenced.items():
+                        if slots is not None:
+                            bags_index = BagsIndex(reg.open(shell_path).subkey("Bags"))
+                            bags_index.refer(slots)
+                            report_orphan_slots(bags_index)
+            yield regfile, shellbags
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_hive_shellbags(regfiles, jobs=1, max_depth=None, use_mmap=True,
+                        scope=SCOPE_ALL, shellbag_filter=None, split=False,
+                        prefetch=0):
+    """
+    Given paths to Registry hive files, yield a tuple (path, shellbag items)
+    for each hive, in the order given.
+    With more than one job, hives are parsed in a pool of worker processes,
+    and the items of each hive are sent back in chunks as they are parsed.
+    No more hives than jobs are parsed ahead of the one being yielded, and
+    only the chunks of those are held at once.
+    With `split`, the BagMRU key structure of each hive is split across
+    the worker processes instead (see `iter_split_hive_shellbags`).
+    Otherwise, the items of each hive are streamed as they are discovered,
+    and with `prefetch`, the next hives are read into memory by threads
+    while the current one is parsed (see `iter_prefetched_hives`).
+    If a ParseStats is being collected, the stats of the workers are merged
+    into it.
+    Arguments:
+    - `regfiles`: A list of strings with paths to Registry hive files.
+    - `jobs`: (Optional) The number of worker processes to use.
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys to
+         descend into. By default, there is no limit.
+    - `use_mmap`: (Optional) Whether to memory map the hives.
+    - `scope`: (Optional) One of SCOPES. With SCOPE_BAGMRU, the Bags
+         key is never opened. By default, SCOPE_ALL.
+    - `shellbag_filter`: (Optional) A ShellbagFilter that selects the
+         items, and prunes the BagMRU keys that cannot have any.
+    - `split`: (Optional) Whether to split each hive across the worker
+         processes, rather than parse whole hives in parallel.
+    - `prefetch`: (Optional) The number of hives to read ahead when
+         parsing with one job. Prefetched hives are read into memory
+         rather than memory mapped. By default, 0, for no read-ahead.
+    Throws:
+    """
+    if split and jobs > 1:
+        for result in iter_split_hive_shellbags(regfiles, jobs=jobs, max_depth=max_depth,
+                                                use_mmap=use_mmap, scope=scope,
+                                                shellbag_filter=shellbag_filter):
+            yield result
+        return
+
+    stats = get_stats()
+    if jobs <= 1 or len(regfiles) <= 1:
+        if prefetch > 0 and len(regfiles) > 1:
+            hives = iter_prefetched_hives(regfiles, prefetch)
+        else:
+            hives = iter_opened_hives(regfiles, use_mmap=use_mmap)
+        for regfile, reg in hives:
+            start = timeit.default_timer()
+            shellbags = iter_shellbags(reg, max_depth=max_depth, scope=scope,
+                                       shellbag_filter=shellbag_filter)
+            if stats is not None:
+                stats.add_hive(regfile, 0, timeit.default_timer() - start)
+                shellbags = timed(shellbags, functools.partial(stats.add_hive, regfile))
+            yield regfile, shellbags
+        return
+
+    jobs = min(jobs, len(regfiles))
+    queue = multiprocessing.Queue()
+    pool = multiprocessing.Pool(jobs, initializer=set_worker_queue, initargs=(queue,))
+    worker = functools.partial(put_hive_shellbags, max_depth=max_depth, use_mmap=use_mmap,
+                               scope=scope, shellbag_filter=shellbag_filter,
+                               collect_stats=stats is not None)
+    # index -> AsyncResult of the hives being parsed
+    pending = {}
+    # index -> deque of the chunks received, and None once the hive is done
+    chunks = collections.defaultdict(collections.deque)
+
+    def submit(index):
+        if index < len(regfiles):
+            pending[index] = pool.apply_async(worker, ((index, regfiles[index]),))
+
+    def iter_chunks(index):
+        """
+        Generator of the shellbag items of one hive, as its chunks arrive.
+        """
+        while True:
+            while not chunks[index]:
+                other, chunk = queue.get()
+                chunks[other].append(chunk)
+            chunk = chunks[index].popleft()
+            if chunk is None:
+                break
+            for shellbag in chunk:
+                yield shellbag
+        del chunks[index]
+        # raises the exception of the worker, if any
+        worker_stats = pending.pop(index).get()
+        if stats is not None:
+            stats.merge(worker_stats)
+        submit(index + jobs)
+
+    try:
+        for index in range(jobs):
+            submit(index)
+        for index, regfile in enumerate(regfiles):
+            shellbags = iter_chunks(index)
+            yield regfile, shellbags
+            # the chunks of the hive that were not consumed
+            for _ in shellbags:
+                pass
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# number of bytes of encoded output to buffer before writing
+OUTPUT_BUFFER_SIZE = 0x40000
+
+
+class OutputSink(object):
+    """
+    A buffered destination of encoded output, such as STDOUT or a file.
+    Writers render a batch of output as text, and write it encoded at once.
+    """
+    def __init__(self, f=None, encoding=None, buffer_size=OUTPUT_BUFFER_SIZE):
+        """
+        Constructor.
+        Arguments:
+        - `f`: A file-like object opened for writing bytes; default is STDOUT.
+        - `encoding`: The encoding of text written to `f`; default is
+            the encoding of `f`, if it has one, or ASCII.
+        - `buffer_size`: The number of bytes to buffer before writing to `f`.
+        """
+        if f is None:
+            f = sys.stdout
+        self._f = f
+        self.encoding = encoding or getattr(f, "encoding", None) or "ascii"
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._written = 0
+        self.closed = False
+
+    def encodable(self, value):
+        """
+        Return whether a string field may be written as text to this sink.
+        Byte strings must be ASCII, as Python will otherwise fail to
+          implicitly decode them when they are formatted into text.
+        """
         try:
-            stdoutWriter.writerow([keymod, regfile, modified,
-                                   accessed, created,
-                                   shellbag["path"], shellbag["regsource"]])
-        except:
-            stdoutWriter.writerow([keymod, regfile, modified,
-                                   accessed, created, "Unprintable Shellbag",
-                                   shellbag["regsource"]])
+            if isinstance(value, unicode):
+                value.encode(self.encoding)
+            else:
+                value.decode("ascii")
+        except UnicodeError:
+            return False
+        return True
+
+    def encode(self, value, fallback=None, encoding=None):
+        """
+        Return a string field encoded for this sink. If it can't be encoded,
+          return `fallback` instead, or the field with the characters
+          replaced if there is no fallback.
+        Byte strings are passed through as is.
+        Arguments:
+        - `encoding`: (Optional) The encoding to use instead of the sink's.
+        """
+        if not isinstance(value, unicode):
+            return value
+        encoding = encoding or self.encoding
+        try:
+            return value.encode(encoding)
+        except UnicodeEncodeError:
+            if fallback is None:
+                return value.encode(encoding, "replace")
+            return fallback
+
+    def write(self, data):
+        """
+        Buffer encoded bytes, writing the buffer if it is full.
+        """
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def write_text(self, text):
+        """
+        Encode and buffer text.
+        Throws:
+        - `UnicodeEncodeError`
+        """
+        self.write(text.encode(self.encoding))
+
+    def is_stdout(self):
+        return self._f is sys.stdout
+
+    def tell(self):
+        """
+        Return the number of bytes written to this sink, including those
+          still buffered.
+        """
+        return self._written + self._buffered
+
+    def flush(self):
+        if self._buffer:
+            self._written += self._buffered
+            self._f.write("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self._f.flush()
+
+    def close(self):
+        """
+        Write any buffered output, and close the file unless it is STDOUT.
+        """
+        self.flush()
+        if not self.is_stdout():
+            self._f.close()
+        self.closed = True
+
+
+def open_sink(path=None):
+    """
+    Return an OutputSink writing to a new UTF-8 file at the given path,
+      or to STDOUT if there is no path.
+    """
+    if path is None:
+        return OutputSink()
+    return OutputSink(open(path, "wb"), encoding="utf-8")
+
+
+def print_shellbag_csv(shellbags, regfile, sink=None):
+    """
+    Write a CSV row for each of the given ShellbagRecords, preceded by a header.
+    Arguments:
+    - `shellbags`: An iterable of ShellbagRecords.
+    - `regfile`: The path of the hive the shellbags were parsed from.
+    - `sink`: The OutputSink to write to; default is STDOUT.
+    """
+    if sink is None:
+        sink = OutputSink()
+    # the csv module writes its rows straight into the sink's buffer
+    writer = csv.writer(sink)
+    writer.writerow(["Key Last Write Time", "Hive",
+                     "Modification Date", "Accessed Date",
+                     "Creation Date", "Path", "Key"])
+    # Python 2's csv module only writes ASCII text to STDOUT, whatever
+    #   the encoding of the terminal, so keep doing the same there
+    encoding = "ascii" if sink.is_stdout() else sink.encoding
+
+    def encode(value, fallback=None):
+        return sink.encode(value, fallback, encoding)
+
+    hive = encode(regfile)
+    for shellbag in shellbags:
+        writer.writerow([date_safe_str(shellbag.klwt), hive,
+                         date_safe_str(shellbag.raw_mtime),
+                         date_safe_str(shellbag.raw_atime),
+                         date_safe_str(shellbag.raw_crtime),
+                         encode(shellbag.path, "Unprintable Shellbag"),
+                         encode(shellbag.regsource)])
+    sink.flush()
+
+
+# Bodyfile v3 line of a shellbag, given the name and MACB timestamps
+BODYFILE_LINE = u"0|%s|0|0|0|0|0|%s|%s|%s|%s"
+
+# name of a shellbag entry, given the path
+BODYFILE_NAME = u"%s (Shellbag)"
+
+# name of a shellbag entry tagged with its hive, given the path and hive
+BODYFILE_HIVE_NAME = u"%s (Shellbag in %s)"
+
+# shellbags don't have a changed timestamp
+BODYFILE_CHANGED = date_safe(datetime.datetime.min)
+
+# number of lines to render and encode at once
+BODYFILE_BATCH_SIZE = 0x400
+
+# maximum number of converted timestamps to remember while writing
+BODYFILE_EPOCH_CACHE_SIZE = 0x1000
 
 
 def print_shellbag_bodyfile(m, a, cr, path, fail_note=None):
@@ -243,20 +1787,492 @@ def print_shellbag_bodyfile(m, a, cr, path, fail_note=None):
     modified = date_safe(m)
     accessed = date_safe(a)
     created = date_safe(cr)
-    changed = int(calendar.timegm(datetime.datetime.min.timetuple()))
+    changed = BODYFILE_CHANGED
     try:
-        print u"0|%s (Shellbag)|0|0|0|0|0|%s|%s|%s|%s" % \
-            (path, modified, accessed, changed, created)
+        print BODYFILE_LINE % \
+            (BODYFILE_NAME % path, modified, accessed, changed, created)
     except UnicodeDecodeError:
-        print u"0|%s (Shellbag)|0|0|0|0|0|%s|%s|%s|%s" % \
-            (fail_note, modified, accessed, changed, created)
+        print BODYFILE_LINE % \
+            (BODYFILE_NAME % fail_note, modified, accessed, changed, created)
     except UnicodeEncodeError:
-        print u"0|%s (Shellbag)|0|0|0|0|0|%s|%s|%s|%s" % \
-            (fail_note, modified, accessed, changed, created)
+        print BODYFILE_LINE % \
+            (BODYFILE_NAME % fail_note, modified, accessed, changed, created)
+
+
+def print_shellbags_bodyfile(shellbags, regfile, sink=None, tag_hive=False):
+    """
+    Write a Bodyfile v3 string entry for each of the given ShellbagRecords.
+    Like `print_shellbag_bodyfile`, but lines are rendered and encoded a
+    batch at a time, and timestamps are converted once per distinct date.
+    A path that can't be written is replaced with a note of its source.
+    Arguments:
+    - `shellbags`: An iterable of ShellbagRecords.
+    - `regfile`: The path of the hive the shellbags were parsed from.
+    - `sink`: The OutputSink to write to; default is STDOUT.
+    - `tag_hive`: (Optional) Whether to tag the name of each entry with
+         the hive, as in "<path> (Shellbag in <hive>)", rather than
+         "<path> (Shellbag)".
+    Throws:
+    """
+    if sink is None:
+        sink = OutputSink()
+    line = BODYFILE_LINE
+    if tag_hive:
+        # characters of the hive path that can't be written are replaced
+        hive = text_field(regfile).encode(sink.encoding, "replace").decode(sink.encoding)
+        name = lambda path: BODYFILE_HIVE_NAME % (path, hive)
+    else:
+        name = lambda path: BODYFILE_NAME % path
+    changed = BODYFILE_CHANGED
+    epochs = {}
+
+    def epoch(d):
+        try:
+            return epochs[d]
+        except KeyError:
+            if len(epochs) >= BODYFILE_EPOCH_CACHE_SIZE:
+                epochs.clear()
+            t = epochs[d] = date_safe(d)
+            return t
+
+    rows = []
+    batch = []
+
+    def write_batch():
+        try:
+            sink.write_text(u"\n".join([line % row for row in rows]) + u"\n")
+        except UnicodeError:
+            # only the paths are text, so replace the ones that can't be written
+            for index, row in enumerate(rows):
+                if not sink.encodable(row[0]):
+                    rows[index] = (name("Failed to parse entry name from: " +
+                                        batch[index].source),) + row[1:]
+            sink.write_text(u"\n".join([line % row for row in rows]) + u"\n")
+        del rows[:]
+        del batch[:]
+
+    for shellbag in shellbags:
+        rows.append((name(shellbag.path),
+                     epoch(shellbag.raw_mtime),
+                     epoch(shellbag.raw_atime),
+                     changed,
+                     epoch(shellbag.raw_crtime)))
+        batch.append(shellbag)
+        if len(rows) >= BODYFILE_BATCH_SIZE:
+            write_batch()
+    if rows:
+        write_batch()
+    sink.flush()
+
+
+# name and type of each column of the record-oriented output formats
+SHELLBAG_COLUMNS = [
+    ("hive", "string"),
+    ("path", "string"),
+    ("key_path", "string"),
+    ("value_name", "string"),
+    ("offset", "int64"),
+    ("mtime", "timestamp[us]"),
+    ("atime", "timestamp[us]"),
+    ("crtime", "timestamp[us]"),
+    ("klwt", "timestamp[us]"),
+]
+
+# number of records in each row group of columnar output
+COLUMNAR_ROW_GROUP_SIZE = 0x10000
+
+
+def text_field(value):
+    """
+    Return a string field as unicode. Byte strings are decoded as UTF-8,
+      with undecodable bytes replaced.
+    """
+    if isinstance(value, unicode):
+        return value
+    return value.decode("utf-8", "replace")
+
+
+def date_micros(d):
+    """
+    Return the number of microseconds from the Unix epoch to a date,
+      or None if the date is invalid.
+    Arguments:
+    - `d`: A Python datetime object, or a raw DOSDATE/DOSTIME integer
+    """
+    d = date_decode(d)
+    if d == datetime.datetime.min:
+        return None
+    delta = d - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def date_iso(d):
+    """
+    Return a date as an ISO 8601 string, or None if the date is invalid.
+    Arguments:
+    - `d`: A Python datetime object, or a raw DOSDATE/DOSTIME integer
+    """
+    d = date_decode(d)
+    if d == datetime.datetime.min:
+        return None
+    return d.isoformat()
+
+
+def print_shellbags_jsonl(shellbags, regfile, sink=None):
+    """
+    Write a JSON Lines object for each of the given ShellbagRecords,
+      with the keys of SHELLBAG_COLUMNS, and ISO 8601 dates or null.
+    Arguments:
+    - `shellbags`: An iterable of ShellbagRecords.
+    - `regfile`: The path of the hive the shellbags were parsed from.
+    - `sink`: The OutputSink to write to; default is STDOUT.
+    """
+    if sink is None:
+        sink = OutputSink()
+    encode = json.JSONEncoder().encode
+    line = "{" + ", ".join(['"%s": %%s' % (name) for name, _ in SHELLBAG_COLUMNS]) + "}\n"
+    hive = encode(text_field(regfile))
+    # the shellbags of a key share their key path and value name
+    strings = {}
+
+    def string(value):
+        try:
+            return strings[value]
+        except KeyError:
+            if len(strings) >= 0x1000:
+                strings.clear()
+            s = strings[value] = encode(text_field(value))
+            return s
+
+    for shellbag in shellbags:
+        sink.write(line % (hive,
+                           encode(text_field(shellbag.path)),
+                           string(shellbag.key_path),
+                           string(shellbag.value_name),
+                           shellbag.offset,
+                           encode(date_iso(shellbag.raw_mtime)),
+                           encode(date_iso(shellbag.raw_atime)),
+                           encode(date_iso(shellbag.raw_crtime)),
+                           encode(date_iso(shellbag.klwt))))
+    sink.flush()
+
+
+def import_pyarrow():
+    """
+    Return the pyarrow module, with pyarrow.parquet loaded, or None if
+    it is not installed. It is only imported once columnar output is
+    requested, since it is slow to load.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+class ColumnarWriter(object):
+    """
+    Writes ShellbagRecords from any number of hives column-wise, in row
+      groups of a fixed number of records, with the columns of
+      SHELLBAG_COLUMNS. Dates are microseconds from the Unix epoch, or null.
+    If pyarrow is available, the output is a Parquet file. Otherwise, it
+      is columnar JSON: a line with the schema, followed by a line for each
+      row group with an array of values for each column.
+    """
+    def __init__(self, sink, row_group_size=COLUMNAR_ROW_GROUP_SIZE, parquet=None):
+        """
+        Constructor.
+        Arguments:
+        - `sink`: The OutputSink to write to.
+        - `row_group_size`: The number of records in each row group.
+        - `parquet`: Whether to write Parquet; default is if pyarrow is available.
+        """
+        pyarrow = import_pyarrow() if parquet is not False else None
+        if parquet is None:
+            parquet = pyarrow is not None
+        if parquet and pyarrow is None:
+            raise ShellbagException("Writing Parquet requires pyarrow")
+        self._sink = sink
+        self.row_group_size = row_group_size
+        self._columns = [[] for _ in SHELLBAG_COLUMNS]
+        self._rows = 0
+        self._parquet_writer = None
+        self._pyarrow = pyarrow
+        if parquet:
+            self._schema = pyarrow.schema([
+                pyarrow.field(name, pyarrow.timestamp("us")
+                              if _type == "timestamp[us]" else getattr(pyarrow, _type)())
+                for name, _type in SHELLBAG_COLUMNS])
+            self._parquet_writer = pyarrow.parquet.ParquetWriter(
+                pyarrow.PythonFile(sink, mode="w"), self._schema)
+        else:
+            sink.write(json.dumps({"schema": [{"name": name, "type": _type}
+                                              for name, _type in SHELLBAG_COLUMNS],
+                                   "row_group_size": row_group_size}) + "\n")
+
+    def write(self, shellbags, regfile):
+        """
+        Add the given ShellbagRecords to the output, writing row groups as they fill.
+        Arguments:
+        - `shellbags`: An iterable of ShellbagRecords.
+        - `regfile`: The path of the hive the shellbags were parsed from.
+        """
+        (hives, paths, key_paths, value_names, offsets,
+         mtimes, atimes, crtimes, klwts) = self._columns
+        hive = text_field(regfile)
+        for shellbag in shellbags:
+            hives.append(hive)
+            paths.append(text_field(shellbag.path))
+            key_paths.append(text_field(shellbag.key_path))
+            value_names.append(text_field(shellbag.value_name))
+            offsets.append(shellbag.offset)
+            mtimes.append(date_micros(shellbag.raw_mtime))
+            atimes.append(date_micros(shellbag.raw_atime))
+            crtimes.append(date_micros(shellbag.raw_crtime))
+            klwts.append(date_micros(shellbag.klwt))
+            self._rows += 1
+            if self._rows == self.row_group_size:
+                self._write_row_group()
+
+    def _write_row_group(self):
+        if self._parquet_writer is not None:
+            pyarrow = self._pyarrow
+            table = pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type)
+                 for column, field in zip(self._columns, self._schema)],
+                schema=self._schema)
+            self._parquet_writer.write_table(table, row_group_size=self._rows)
+        else:
+            self._sink.write(json.dumps({"num_rows": self._rows,
+                                         "columns": dict(zip([name for name, _ in SHELLBAG_COLUMNS],
+                                                             self._columns))}) + "\n")
+        for column in self._columns:
+            del column[:]
+        self._rows = 0
+
+    def close(self):
+        """
+        Write the last, partial row group, and finish the output.
+        """
+        if self._rows:
+            self._write_row_group()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        self._sink.flush()
+
+
+SHELLBAG_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hives (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL UNIQUE,
+    options TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS shellbags (
+    hive_id INTEGER NOT NULL REFERENCES hives(id),
+    path TEXT,
+    key_path TEXT,
+    value_name TEXT,
+    offset INTEGER,
+    mtime TEXT,
+    atime TEXT,
+    crtime TEXT,
+    klwt TEXT
+);
+CREATE INDEX IF NOT EXISTS hives_path ON hives(path);
+CREATE INDEX IF NOT EXISTS shellbags_hive ON shellbags(hive_id);
+CREATE INDEX IF NOT EXISTS shellbags_path ON shellbags(path);
+CREATE INDEX IF NOT EXISTS shellbags_klwt ON shellbags(klwt);
+"""
+
+# number of shellbags inserted by each statement
+SHELLBAG_STORE_BATCH_SIZE = 0x1000
+
+
+def extraction_options(max_depth=None, scope=SCOPE_ALL, shellbag_filter=None):
+    """
+    Return a string that identifies the options that select which
+      shellbags are extracted from a hive, so that the shellbags stored
+      with some options are not mistaken for those of others.
+    Arguments:
+    - `max_depth`: (Optional) The maximum depth of BagMRU subkeys.
+    - `scope`: (Optional) One of SCOPES.
+    - `shellbag_filter`: (Optional) A ShellbagFilter.
+    """
+    options = {"max_depth": max_depth, "scope": scope}
+    if shellbag_filter is not None:
+        if shellbag_filter.since is not None:
+            options["since"] = shellbag_filter.since.isoformat()
+        if shellbag_filter.until is not None:
+            options["until"] = shellbag_filter.until.isoformat()
+        if shellbag_filter.path_regex is not None:
+            options["path_regex"] = [text_field(shellbag_filter.path_regex.pattern),
+                                     shellbag_filter.path_regex.flags]
+    return json.dumps(options, sort_keys=True)
+
+
+class ShellbagStore(object):
+    """
+    An SQLite database of the shellbags of many hives, which may be
+      updated incrementally. Each hive is identified by its SHA256, and
+      is stored in a single transaction, along with its path, size,
+      modification time and the extraction options (see
+      `extraction_options`), so that unchanged hives can be skipped.
+      A hive stored with other options, such as a narrower scope or a
+      filter, is parsed again and replaced.
+    Dates are stored as ISO 8601 strings, or NULL if they are invalid.
+    """
+    def __init__(self, path, options=None):
+        """
+        Constructor.
+        Arguments:
+        - `path`: The path of the database, which is created if necessary.
+        - `options`: (Optional) The string from `extraction_options` for
+            the shellbags to be stored; default is no limit or filter.
+        """
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SHELLBAG_STORE_SCHEMA)
+        # databases from before the options were stored have the
+        #   options of none of their hives
+        if "options" not in [row[1] for row in self._db.execute("PRAGMA table_info(hives)")]:
+            self._db.execute("ALTER TABLE hives ADD COLUMN options TEXT NOT NULL DEFAULT ''")
+        self._db.commit()
+        if options is None:
+            options = extraction_options()
+        self.options = options
+        # hive path -> (size, mtime, sha256) of the hives not yet stored
+        self._pending = {}
+
+    def is_stored(self, regfile):
+        """
+        Return whether the given hive is already stored with the same
+          options, because a hive with the same path, size and
+          modification time, or the same SHA256, has been stored before,
+          or is about to be.
+        Arguments:
+        - `regfile`: The path of a hive.
+        """
+        if regfile in self._pending:
+            return True
+        path = text_field(os.path.abspath(regfile))
+        st = os.stat(regfile)
+        if self._db.execute("SELECT 1 FROM hives WHERE path = ? AND size = ? AND mtime = ? "
+                            "AND options = ?",
+                            (path, st.st_size, st.st_mtime, self.options)).fetchone():
+            return True
+        sha256 = hashlib.sha256()
+        with open(regfile, "rb") as f:
+            for chunk in iter(lambda: f.read(0x100000), ""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        if digest in [pending[2] for pending in self._pending.values()]:
+            return True
+        if self._db.execute("SELECT 1 FROM hives WHERE sha256 = ? AND options = ?",
+                            (digest, self.options)).fetchone():
+            return True
+        self._pending[regfile] = (st.st_size, st.st_mtime, digest)
+        return False
+
+    def store(self, regfile, shellbags):
+        """
+        Store the shellbags of a hive, replacing those of any earlier
+          version of the hive at the same path, and those of the same
+          hive stored with other options.
+        Arguments:
+        - `regfile`: The path of a hive, which `is_stored` has checked.
+        - `shellbags`: An iterable of the ShellbagRecords of the hive.
+        """
+        size, mtime, digest = self._pending.pop(regfile)
+        path = text_field(os.path.abspath(regfile))
+        with self._db:
+            for (hive_id,) in self._db.execute("SELECT id FROM hives WHERE path = ? OR sha256 = ?",
+                                               (path, digest)).fetchall():
+                self._db.execute("DELETE FROM shellbags WHERE hive_id = ?", (hive_id,))
+                self._db.execute("DELETE FROM hives WHERE id = ?", (hive_id,))
+            hive_id = self._db.execute("INSERT INTO hives (path, size, mtime, sha256, options) "
+                                       "VALUES (?, ?, ?, ?, ?)",
+                                       (path, size, mtime, digest, self.options)).lastrowid
+            rows = []
+            for shellbag in shellbags:
+                rows.append((hive_id,
+                             text_field(shellbag.path),
+                             text_field(shellbag.key_path),
+                             text_field(shellbag.value_name),
+                             shellbag.offset,
+                             date_iso(shellbag.raw_mtime),
+                             date_iso(shellbag.raw_atime),
+                             date_iso(shellbag.raw_crtime),
+                             date_iso(shellbag.klwt)))
+                if len(rows) >= SHELLBAG_STORE_BATCH_SIZE:
+                    self._insert(rows)
+            if rows:
+                self._insert(rows)
+
+    def _insert(self, rows):
+        self._db.executemany("INSERT INTO shellbags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        del rows[:]
+
+    def close(self):
+        self._db.close()
 
 
 ################ MAIN  #############
 
+FILTER_DATE_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+
+
+def parse_filter_date(s):
+    """
+    Parse the date of a --since or --until option into a Python datetime.
+    Arguments:
+    - `s`: A string with a UTC date, such as 2013-04-01 or 2013-04-01T12:00:00
+    Throws:
+    - `argparse.ArgumentTypeError`: if the string is not a date.
+    """
+    for date_format in FILTER_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(s, date_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid date: %s" % s)
+
+
+def non_negative_int(s):
+    """
+    Parse the count of an option that may be zero, but not negative.
+    Arguments:
+    - `s`: A string with a decimal integer.
+    Throws:
+    - `argparse.ArgumentTypeError`: if the count is not a non-negative integer.
+    """
+    try:
+        value = int(s)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise argparse.ArgumentTypeError("invalid non-negative integer: %s" % s)
+    return value
+
+
+def compile_path_regex(s):
+    """
+    Compile the pattern of a --path-regex option.
+    Arguments:
+    - `s`: A string with a regular expression.
+    Throws:
+    - `argparse.ArgumentTypeError`: if the pattern is not valid.
+    """
+    try:
+        # decoded like the paths it is matched against
+        return re.compile(text_field(s))
+    except re.error as e:
+        raise argparse.ArgumentTypeError("invalid regular expression: %s" % e)
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -266,27 +2282,118 @@ def main(argv=None):
                         help="Print debugging information while parsing")
     parser.add_argument("file", nargs="+",
                         help="Windows Registry hive file(s)")
-    parser.add_argument("-o", choices=["csv", "bodyfile"],
+    parser.add_argument("-o", choices=["csv", "bodyfile", "jsonl", "columnar", "sqlite"],
                         dest="fmt", default="bodyfile",
-                        help="Output format: csv or bodyfile; default is bodyfile")
+                        help="Output format: csv, bodyfile, jsonl, columnar (Parquet "
+                        "if pyarrow is installed, otherwise columnar JSON), or sqlite "
+                        "(with --db); default is bodyfile")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of hives to parse in parallel worker processes; default is 1")
+    parser.add_argument("--split", action="store_true",
+                        help="Split the BagMRU keys of each hive across the -j worker "
+                        "processes, rather than parse whole hives in parallel")
+    parser.add_argument("--max-depth", type=int, default=None, dest="max_depth",
+                        help="Maximum depth of BagMRU keys to descend into; default is no limit")
+    parser.add_argument("--scope", choices=SCOPES, default=SCOPE_ALL,
+                        help="Extract the folder paths from BagMRU, the items from "
+                        "the ItemPos values in Bags, or all; default is all")
+    parser.add_argument("--since", type=parse_filter_date, default=None,
+                        help="Only output shellbags with a timestamp at or after this "
+                        "UTC date, as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS; missing or "
+                        "invalid item dates are ignored")
+    parser.add_argument("--until", type=parse_filter_date, default=None,
+                        help="Only output shellbags with a timestamp at or before this "
+                        "UTC date, as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS; missing or "
+                        "invalid item dates are ignored")
+    parser.add_argument("--path-regex", type=compile_path_regex, default=None,
+                        dest="path_regex",
+                        help="Only output shellbags with a path that matches this regular "
+                        "expression; anchor it with ^ to skip the other BagMRU keys")
+    parser.add_argument("--cache-size", type=int, default=ITEM_CACHE.maxsize,
+                        dest="cache_size",
+                        help="Number of parsed Registry values to cache; 0 disables the cache")
+    parser.add_argument("-w", "--output", default=None,
+                        help="Write UTF-8 output to this file, rather than STDOUT")
+    parser.add_argument("--prefetch", type=non_negative_int, default=0,
+                        help="Number of hives to read into memory ahead of the one being "
+                        "parsed, with one job and without --split; default is 0")
+    parser.add_argument("--no-mmap", action="store_false", dest="use_mmap",
+                        help="Read each hive into memory, rather than memory mapping it")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print a summary of parsing counts and timings to STDERR")
+    parser.add_argument("--db", default=None,
+                        help="SQLite database to add the shellbags of new or changed hives to, with -o sqlite")
     args = parser.parse_args(argv[1:])
+    if (args.fmt == "sqlite") != (args.db is not None):
+        parser.error("-o sqlite and --db must be given together")
+    if args.prefetch and (args.jobs > 1 or args.split):
+        parser.error("--prefetch only applies with one job, without --split")
 
-    for f in args.file:
-        registry = Registry.Registry(f)
+    shellbag_filter = None
+    if args.since is not None or args.until is not None or args.path_regex is not None:
+        shellbag_filter = ShellbagFilter(since=args.since, until=args.until,
+                                         path_regex=args.path_regex)
 
-        parsed_shellbags = get_all_shellbags(registry)
+    ITEM_CACHE.resize(args.cache_size)
+    if args.stats:
+        enable_stats()
+
+    if args.fmt == "sqlite":
+        store = ShellbagStore(args.db, extraction_options(max_depth=args.max_depth,
+                                                          scope=args.scope,
+                                                          shellbag_filter=shellbag_filter))
+        try:
+            regfiles = [f for f in args.file if not store.is_stored(f)]
+            for f, parsed_shellbags in iter_hive_shellbags(regfiles, jobs=args.jobs,
+                                                           max_depth=args.max_depth,
+                                                           use_mmap=args.use_mmap,
+                                                           scope=args.scope,
+                                                           shellbag_filter=shellbag_filter,
+                                                           split=args.split,
+                                                           prefetch=args.prefetch):
+                store.store(f, parsed_shellbags)
+        finally:
+            store.close()
+        print_stats()
+        return
+
+    sink = open_sink(args.output)
+    columnar = None
+    try:
+        if args.fmt == "columnar":
+            columnar = ColumnarWriter(sink)
+        for f, parsed_shellbags in iter_hive_shellbags(args.file, jobs=args.jobs,
+                                                       max_depth=args.max_depth,
+                                                       use_mmap=args.use_mmap,
+                                                       scope=args.scope,
+                                                       shellbag_filter=shellbag_filter,
+                                                       split=args.split,
+                                                       prefetch=args.prefetch):
+            if args.fmt == "csv":
+                print_shellbag_csv(parsed_shellbags, f, sink)
+            elif args.fmt == "bodyfile":
+                print_shellbags_bodyfile(parsed_shellbags, f, sink,
+                                         tag_hive=len(args.file) > 1)
+            elif args.fmt == "jsonl":
+                print_shellbags_jsonl(parsed_shellbags, f, sink)
+            elif args.fmt == "columnar":
+                columnar.write(parsed_shellbags, f)
+            else:
+                print "Error: Unsupported output format"
+        if columnar is not None:
+            columnar.close()
+    finally:
+        sink.close()
+    print_stats()
+
+
+def print_stats():
+    """
+    Write the summary of the ParseStats being collected, if any, to STDERR.
+    """
+    stats = get_stats()
+    if stats is not None:
+        sys.stderr.write(stats.summary() + "\n")
 
-        if args.fmt == "csv":
-            print_shellbag_csv(parsed_shellbags, f)
-        elif args.fmt == "bodyfile":
-            for shellbag in parsed_shellbags:
-                print_shellbag_bodyfile(shellbag["mtime"],
-                                        shellbag["atime"],
-                                        shellbag["crtime"],
-                                        shellbag["path"],
-                                        fail_note="Failed to parse entry name from: " + shellbag["source"])
-        else:
-            print "Error: Unsupported output format"
-            
 if __name__ == "__main__":
     main(argv=sys.argv)
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+#    This file is part of shellbags.py
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Report items/sec and peak RSS for SHITEMLIST.items(), the ItemPos loop,
+get_all_shellbags, the partitions of --split, and a run over several
+hives with and without --prefetch over synthetic data from
+synthetic_hive.py. Slow storage is simulated for the --prefetch runs by
+sleeping for --latency seconds before each hive is read.
+
+Each benchmark runs in its own process, so the peak RSS of one does
+not leak into the next.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import datetime
+import tempfile
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from Registry import Registry
+from ShellItems import SHITEMLIST, ITEM_CACHE
+
+import synthetic_hive
+import shellbags
+from shellbags import get_all_shellbags
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process, in KB.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+
+def shitemlist_blobs(count, seed):
+    """
+    Returns `count` shell item lists, each with a single item, cycling
+    through every item factory.
+    """
+    rng = random.Random(seed)
+    factories = synthetic_hive.item_factories()
+    base = datetime.datetime(2013, 1, 1)
+    blobs = []
+    for i in range(count):
+        d = base + datetime.timedelta(seconds=rng.randint(0, 10 ** 8))
+        blobs.append(synthetic_hive.shitemlist([factories[i % len(factories)](i, d)]))
+    return blobs
+
+
+def itempos_blobs(count, items, seed):
+    """
+    Returns `count` ItemPos values, each with `items` file entries.
+    """
+    rng = random.Random(seed)
+    return [synthetic_hive.itempos_value(synthetic_hive.file_items(items, i * items, rng))
+            for i in range(count)]
+
+
+def touch(item):
+    item.name()
+    item.m_date()
+    item.a_date()
+    item.cr_date()
+
+
+def bench_items(args):
+    blobs = shitemlist_blobs(args.values, args.seed)
+    count = 0
+    start = time.time()
+    for _ in range(args.repeat):
+        for blob in blobs:
+            for item in SHITEMLIST(blob, 0, False).items():
+                touch(item)
+                count += 1
+    return count, time.time() - start, peak_rss()
+
+
+def bench_itempos(args):
+    blobs = itempos_blobs(args.values // args.itempos + 1, args.itempos, args.seed)
+    count = 0
+    start = time.time()
+    for _ in range(args.repeat):
+        for blob in blobs:
+            for item in SHITEMLIST(blob, 0, False).itempos_items():
+                touch(item)
+                count += 1
+    return count, time.time() - start, peak_rss()
+
+
+def bench_all_shellbags(args):
+    count = 0
+    start = time.time()
+    for _ in range(args.repeat):
+        ITEM_CACHE.clear()
+        count += len(get_all_shellbags(Registry.Registry(args.hive)))
+    return count, time.time() - start, peak_rss()
+
+
+def bench_split_partitions(args):
+    """
+    Parse every partition of the hive in turn, as a single --split worker
+    with --since would, so that the cost of each partition includes
+    whatever the worker does not keep from the one before.
+    """
+    reg = Registry.Registry(args.hive)
+    tasks = []
+    for shell_path in shellbags.SHELL_KEY_PATHS:
+        try:
+            partitions = shellbags.bagmru_partitions(reg.open(shell_path))
+        except Registry.RegistryKeyNotFoundException:
+            continue
+        tasks.extend((args.hive, shell_path, partition) for partition in partitions)
+    shellbag_filter = shellbags.ShellbagFilter(since=datetime.datetime(2013, 1, 1))
+    count = 0
+    start = time.time()
+    for _ in range(args.repeat):
+        ITEM_CACHE.clear()
+        if shellbags.g_worker_hive is not None and shellbags.g_worker_hive[2] is not None:
+            shellbags.g_worker_hive[2].close()
+        shellbags.g_worker_hive = None
+        for task in tasks:
+            count += len(shellbags.get_partition_shellbags(task, shellbag_filter=shellbag_filter)[0])
+    return count, time.time() - start, peak_rss()
+
+
+def read_with_latency(args, prefetch):
+    """
+    Parse --hives copies of the hive as one job with the given --prefetch,
+    where each read of a hive first waits for --latency seconds.
+    """
+    read = Registry.Registry
+
+    def slow_read(regfile):
+        time.sleep(args.latency)
+        return read(regfile)
+
+    Registry.Registry = slow_read
+    count = 0
+    start = time.time()
+    try:
+        for _, records in shellbags.iter_hive_shellbags([args.hive] * args.hives,
+                                                        use_mmap=False, prefetch=prefetch):
+            count += sum(1 for _ in records)
+    finally:
+        Registry.Registry = read
+    return count, time.time() - start, peak_rss()
+
+
+def bench_latency(args):
+    return read_with_latency(args, 0)
+
+
+def bench_latency_prefetch(args):
+    return read_with_latency(args, args.prefetch)
+
+
+BENCHMARKS = [
+    ("SHITEMLIST.items()", bench_items),
+    ("ItemPos loop", bench_itempos),
+    ("get_all_shellbags", bench_all_shellbags),
+    ("split partitions", bench_split_partitions),
+    ("slow reads", bench_latency),
+    ("slow reads prefetch", bench_latency_prefetch),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the shellbag parsers on synthetic data.")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="Depth of the synthetic BagMRU tree; default is 4")
+    parser.add_argument("--fanout", type=int, default=4,
+                        help="Fan-out of the synthetic BagMRU tree; default is 4")
+    parser.add_argument("--itempos", type=int, default=8,
+                        help="Number of items in each ItemPos value; default is 8")
+    parser.add_argument("--values", type=int, default=2000,
+                        help="Number of shell item lists for the item benchmarks; default is 2000")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of passes over the data; default is 5")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the generated data; default is 0")
+    parser.add_argument("--hives", type=int, default=8,
+                        help="Number of hives for the slow read benchmarks; default is 8")
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="Seconds to wait before each hive is read in the slow read "
+                        "benchmarks; default is 0.5")
+    parser.add_argument("--prefetch", type=int, default=3,
+                        help="Number of hives to read ahead in the slow read benchmark "
+                        "with prefetch; default is 3")
+    parser.add_argument("--hive", default=None,
+                        help="Keep the synthetic hive at this path, rather than a temporary file")
+    args = parser.parse_args()
+
+    keep = args.hive is not None
+    hive = args.hive
+    if not keep:
+        fd, hive = tempfile.mkstemp(suffix=".dat")
+        os.close(fd)
+    try:
+        synthetic_hive.write_hive(hive, depth=args.depth, fanout=args.fanout,
+                                  itempos=args.itempos, seed=args.seed)
+        args.hive = hive
+
+        print "%-20s %10s %10s %12s %14s" % ("benchmark", "items", "seconds", "items/sec", "peak RSS (KB)")
+        for name, benchmark in BENCHMARKS:
+            pool = multiprocessing.Pool(processes=1)
+            try:
+                count, elapsed, rss = pool.apply(benchmark, (args,))
+            finally:
+                pool.terminate()
+                pool.join()
+            print "%-20s %10d %10.3f %12.1f %14d" % (name, count, elapsed,
+                                                     count / elapsed if elapsed else 0.0, rss)
+    finally:
+        if not keep:
+            os.remove(hive)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,485 @@
+#!/usr/bin/python
+
+#    This file is part of shellbags.py
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Synthesize shell item lists and Registry hives with BagMRU/Bags trees,
+for benchmarking and exercising the parsers without real evidence.
+"""
+
+import sys
+import uuid
+import struct
+import random
+import argparse
+import datetime
+
+REG_BINARY = 0x3
+REG_DWORD = 0x4
+
+MY_COMPUTER = "20d04fe0-3aea-1069-a2d8-08002b30309d"
+CONTROL_PANEL = "26ee0668-a00a-44d7-9371-beb064c98683"
+PROGRAMS_AND_FEATURES = "7b81be6a-ce2b-4676-a29e-eb907a5126c5"
+DOCUMENTS = "fdd39ad0-238f-46af-adb4-6c85480369c7"
+UNKNOWN_GUID = "01234567-89ab-cdef-0123-456789abcdef"
+
+# Windows Registry hive layout
+REGF_HEADER_SIZE = 0x1000
+HBIN_HEADER_SIZE = 0x20
+HBIN_ALIGNMENT = 0x1000
+CELL_ALIGNMENT = 0x8
+# larger values are stored in "db" records, which we don't generate
+MAX_VALUE_SIZE = 0x3FD8
+
+
+################ SHELL ITEMS #############
+
+def guid_bytes(guid):
+    """
+    Returns the 16 byte little-endian form of a GUID string.
+    """
+    return uuid.UUID(guid).bytes_le
+
+
+def dosdate_bytes(d):
+    """
+    Returns the 4 byte DOSDATE and DOSTIME form of a datetime.
+    """
+    date = ((d.year - 1980) << 9) | (d.month << 5) | d.day
+    time = (d.hour << 11) | (d.minute << 5) | (d.second // 2)
+    return struct.pack("<HH", date, time)
+
+
+def wstring_bytes(s):
+    """
+    Returns the NULL terminated UTF-16 form of a string.
+    """
+    return s.encode("utf-16-le") + "\x00\x00"
+
+
+def string_bytes(s, alignment=1):
+    """
+    Returns the NULL terminated form of a string, padded to the alignment.
+    """
+    b = s + "\x00"
+    if len(b) % alignment:
+        b += "\x00" * (alignment - len(b) % alignment)
+    return b
+
+
+def shitem(_type, body):
+    """
+    Returns a shell item with the given type and body.
+    """
+    return struct.pack("<HB", 3 + len(body), _type) + body
+
+
+def folder_entry(guid, folder_id=0x50):
+    return shitem(0x1F, chr(folder_id) + guid_bytes(guid))
+
+
+def volume_entry(name):
+    body = string_bytes(name)
+    return shitem(0x2F, body + "\x00" * (0x16 - len(body)))
+
+
+def network_location_entry(location, description=None, comments=None):
+    flags = 0x0
+    body = ""
+    if description is not None:
+        flags |= 0x80
+        body += string_bytes(description)
+    if comments is not None:
+        flags |= 0x40
+        body += string_bytes(comments)
+    return shitem(0x47, "\x00" + chr(flags) + string_bytes(location) + body + "\x00\x00")
+
+
+def network_guid_entry(guid):
+    return shitem(0x4D, "\x00" + guid_bytes(guid))
+
+
+def uri_entry(uri):
+    return shitem(0x61, struct.pack("<IB", 0x0, 0x0) + wstring_bytes(uri))
+
+
+def control_panel_entry(guid):
+    return shitem(0x71, "\x00" + "\x00" * 10 + guid_bytes(guid))
+
+
+def unknown0_entry(guid):
+    return shitem(0x00, "\x00" * 11 + guid_bytes(guid) + "\x00\x00")
+
+
+def unknown1_entry():
+    return shitem(0x01, "\x00" * 0x5)
+
+
+def unknown2_entry(guid):
+    return shitem(0x2E, "\x00" + guid_bytes(guid))
+
+
+def extension_block(version, long_name, cr_date, a_date, localized_name=None, ext_offset=0):
+    """
+    Returns a BEEF0004 extension block of the given version (3 through 9).
+    Arguments:
+    - `ext_offset`: The offset of the block in its shell item, which is
+        stored in the last word of the block.
+    """
+    body = struct.pack("<HI", version, 0xBEEF0004)
+    body += dosdate_bytes(cr_date)
+    body += dosdate_bytes(a_date)
+    body += struct.pack("<H", 0x14)  # unknown
+    if version >= 0x7:
+        body += "\x00" * 2
+        body += "\x00" * 8  # fileref
+        body += "\x00" * 8  # unknown
+    if localized_name is None:
+        body += struct.pack("<H", 0)
+    else:
+        body += struct.pack("<H", len(localized_name))
+    if version >= 0x9:
+        body += "\x00" * 4
+    if version >= 0x8:
+        body += "\x00" * 4
+    body += wstring_bytes(long_name)
+    if localized_name is not None:
+        if version >= 0x7:
+            body += wstring_bytes(localized_name)
+        else:
+            body += string_bytes(localized_name)
+    body += struct.pack("<H", ext_offset)
+    return struct.pack("<H", 2 + len(body)) + body
+
+
+def file_entry(short_name, long_name, version, m_date, cr_date, a_date,
+               unicode_short_name=False, directory=True, localized_name=None):
+    """
+    Returns a FILE_ENTRY shell item with a BEEF0004 extension block.
+    """
+    _type = 0x31 if directory else 0x32
+    if unicode_short_name:
+        _type |= 0x4
+        name = wstring_bytes(short_name)
+    else:
+        name = string_bytes(short_name, alignment=2)
+    header = "\x00" + struct.pack("<I", 0x0) + dosdate_bytes(m_date) + struct.pack("<H", 0x10)
+    ext_offset = 3 + len(header) + len(name)
+    ext = extension_block(version, long_name, cr_date, a_date,
+                          localized_name=localized_name, ext_offset=ext_offset)
+    return shitem(_type, header + name + ext)
+
+
+def fileentry_fragment(short_name, m_date):
+    """
+    Returns a FILE_ENTRY shell item without an extension block.
+    """
+    header = "\x00" + struct.pack("<I", 0x0) + dosdate_bytes(m_date) + struct.pack("<H", 0x10)
+    # an extension offset beyond the item marks it as a fragment
+    return shitem(0x32, header + string_bytes(short_name, alignment=2) + "\xff\xff")
+
+
+def delegate_entry(short_name, long_name, version, m_date, cr_date, a_date):
+    """
+    Returns a DELEGATE_ITEM shell item wrapping a file entry fragment.
+    """
+    sub_header = "\x00" + struct.pack("<I", 0x0) + dosdate_bytes(m_date) + struct.pack("<H", 0x10)
+    sub_item = shitem(0x31, sub_header + string_bytes(short_name, alignment=2))
+    body = "\x00" + struct.pack("<H", len(sub_item)) + "CFSF" + sub_item + "\x00\x00"
+    body += guid_bytes("5e591a74-df96-48d3-8d67-1733bcee28ba")
+    body += guid_bytes(UNKNOWN_GUID)
+    body += extension_block(version, long_name, cr_date, a_date)
+    return shitem(0x74, body)
+
+
+def shitemlist(items):
+    """
+    Returns a shell item list, as found in BagMRU values.
+    """
+    return "".join(items) + "\x00\x00"
+
+
+def itempos_value(items):
+    """
+    Returns an ItemPos value, as found in Bags keys.
+    """
+    value = "\x00" * 0x10
+    for item in items:
+        value += "\x00" * 0x8 + item
+    return value + "\x00" * 0x8 + "\x00\x00"
+
+
+def item_factories():
+    """
+    Returns a list of functions (index, datetime) -> shell item, which
+    together cover every SHITEMTYPE and BEEF0004 versions 3 through 9.
+    """
+    def dated(f):
+        return lambda i, d: f(i, d, d + datetime.timedelta(days=1), d + datetime.timedelta(days=2))
+
+    factories = [
+        lambda i, d: folder_entry(MY_COMPUTER),
+        lambda i, d: folder_entry(DOCUMENTS, folder_id=0x48),
+        lambda i, d: volume_entry("%s:\\" % chr(ord("C") + i % 20)),
+        lambda i, d: network_location_entry("\\\\server%d\\share" % i, "Share %d" % i, "Comment"),
+        lambda i, d: network_guid_entry(UNKNOWN_GUID),
+        lambda i, d: uri_entry(u"ftp://host%d.example.com" % i),
+        lambda i, d: control_panel_entry(PROGRAMS_AND_FEATURES),
+        lambda i, d: unknown0_entry(CONTROL_PANEL),
+        lambda i, d: unknown1_entry(),
+        lambda i, d: unknown2_entry(CONTROL_PANEL),
+        lambda i, d: fileentry_fragment("FRAG%d" % i, d),
+        dated(lambda i, m, cr, a: delegate_entry("DELEG~%d" % i, u"Delegate folder %d" % i, 0x9, m, cr, a)),
+        dated(lambda i, m, cr, a: file_entry("UNICOD~%d" % i, u"Unicode short name %d" % i, 0x8, m, cr, a,
+                                             unicode_short_name=True)),
+        dated(lambda i, m, cr, a: file_entry("LOCAL~%d" % i, u"Localized folder %d" % i, 0x3, m, cr, a,
+                                             localized_name="@shell32.dll,-%d" % i)),
+        dated(lambda i, m, cr, a: file_entry("LOCALW~%d" % i, u"Localized folder %d" % i, 0x7, m, cr, a,
+                                             localized_name=u"@shell32.dll,-%d" % i)),
+    ]
+    for version in range(0x3, 0xA):
+        factories.append(dated(lambda i, m, cr, a, version=version:
+                               file_entry("FOLDER~%d" % i, u"Long folder name %d (v%d)" % (i, version),
+                                          version, m, cr, a)))
+    return factories
+
+
+def file_items(count, start, rng):
+    """
+    Returns a list of `count` file entries of varying extension versions.
+    """
+    items = []
+    for i in range(start, start + count):
+        d = datetime.datetime(2010, 1, 1) + datetime.timedelta(seconds=rng.randint(0, 10 ** 8))
+        items.append(file_entry("FILE~%d.TXT" % i, u"Document number %d.txt" % i,
+                                rng.randint(0x3, 0x9), d, d, d, directory=False))
+    return items
+
+
+################ REGISTRY HIVES #############
+
+class Key(object):
+    """
+    A Registry key to be written to a hive.
+    """
+    def __init__(self, name, timestamp=0):
+        """
+        Constructor.
+        Arguments:
+        - `name`: A string.
+        - `timestamp`: The last write time as a Windows FILETIME.
+        """
+        self.name = name
+        self.timestamp = timestamp
+        self.values = []
+        self.subkeys = []
+
+    def add_value(self, name, _type, data):
+        self.values.append((name, _type, data))
+
+    def add_subkey(self, key):
+        self.subkeys.append(key)
+        return key
+
+    def path_subkey(self, path):
+        """
+        Return the descendant key with the given path, creating it if necessary.
+        """
+        key = self
+        for name in path.split("\\"):
+            for subkey in key.subkeys:
+                if subkey.name.lower() == name.lower():
+                    key = subkey
+                    break
+            else:
+                key = key.add_subkey(Key(name, self.timestamp))
+        return key
+
+
+class HiveWriter(object):
+    """
+    Serializes a tree of Keys as a Windows Registry hive with a single HBIN.
+    """
+    def __init__(self):
+        self._cells = bytearray()
+
+    def _alloc(self, payload):
+        """
+        Append an allocated cell and return its offset relative to the first HBIN.
+        """
+        offset = HBIN_HEADER_SIZE + len(self._cells)
+        size = 4 + len(payload)
+        size += (CELL_ALIGNMENT - size % CELL_ALIGNMENT) % CELL_ALIGNMENT
+        self._cells += struct.pack("<i", -size) + payload
+        self._cells += "\x00" * (size - 4 - len(payload))
+        return offset
+
+    def _patch(self, offset, fmt, *values):
+        """
+        Overwrite fields of a cell, at an offset relative to the first HBIN.
+        """
+        struct.pack_into(fmt, self._cells, offset - HBIN_HEADER_SIZE, *values)
+
+    def _write_value(self, name, _type, data):
+        if _type == REG_DWORD:
+            length, data_offset = 0x80000004, struct.unpack("<I", data)[0]
+        else:
+            if len(data) > MAX_VALUE_SIZE:
+                raise ValueError("value too large: %s" % (name))
+            length, data_offset = len(data), self._alloc(data)
+        return self._alloc(struct.pack("<2sHIIIHH", "vk", len(name), length,
+                                       data_offset, _type, 0x1, 0x0) + name)
+
+    def _write_key(self, key, parent_offset, is_root=False):
+        flags = 0x20
+        if is_root:
+            flags |= 0x2C
+        nk = struct.pack("<2sHQIIIIIIIIIIIIIIIHH", "nk", flags, key.timestamp, 0x0,
+                         parent_offset, len(key.subkeys), 0x0, 0xFFFFFFFF, 0xFFFFFFFF,
+                         len(key.values), 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF,
+                         max([len(k.name) * 2 for k in key.subkeys] + [0]), 0x0,
+                         max([len(v[0]) * 2 for v in key.values] + [0]),
+                         max([len(v[2]) for v in key.values] + [0]),
+                         0x0, len(key.name), 0x0)
+        offset = self._alloc(nk + key.name)
+
+        subkeys = sorted(key.subkeys, key=lambda k: k.name.upper())
+        if subkeys:
+            entries = ""
+            for subkey in subkeys:
+                entries += struct.pack("<I4s", self._write_key(subkey, offset),
+                                       subkey.name[:4].ljust(4, "\x00"))
+            lf = self._alloc(struct.pack("<2sH", "lf", len(subkeys)) + entries)
+            self._patch(offset + 4 + 0x1C, "<I", lf)
+
+        if key.values:
+            vks = [self._write_value(*value) for value in key.values]
+            values_list = self._alloc(struct.pack("<%dI" % len(vks), *vks))
+            self._patch(offset + 4 + 0x28, "<I", values_list)
+        return offset
+
+    def write(self, root, f):
+        """
+        Serialize the tree of Keys at `root` to the file-like object `f`.
+        """
+        self._cells = bytearray()
+        root_offset = self._write_key(root, 0xFFFFFFFF, is_root=True)
+
+        hbin_size = HBIN_HEADER_SIZE + len(self._cells)
+        hbin_size += (HBIN_ALIGNMENT - hbin_size % HBIN_ALIGNMENT) % HBIN_ALIGNMENT
+        free = hbin_size - HBIN_HEADER_SIZE - len(self._cells)
+        if free:
+            self._cells += struct.pack("<i", free) + "\x00" * (free - 4)
+
+        header = bytearray(REGF_HEADER_SIZE)
+        struct.pack_into("<4sIIQIIIIIII", header, 0x0, "regf", 1, 1, root.timestamp,
+                         1, 5, 0, 1, root_offset, hbin_size, 1)
+        name = u"SYNTHETIC.DAT".encode("utf-16-le")
+        header[0x30:0x30 + len(name)] = name
+        checksum = 0
+        for dword in struct.unpack_from("<127I", bytes(header)):
+            checksum ^= dword
+        struct.pack_into("<I", header, 0x1FC, checksum)
+
+        hbin = struct.pack("<4sII", "hbin", 0x0, hbin_size) + "\x00" * (HBIN_HEADER_SIZE - 12)
+        f.write(bytes(header))
+        f.write(hbin)
+        f.write(bytes(self._cells))
+
+
+def filetime(d):
+    """
+    Returns the Windows FILETIME of a datetime.
+    """
+    delta = d - datetime.datetime(1601, 1, 1)
+    return (delta.days * 86400 + delta.seconds) * 10 ** 7 + delta.microseconds * 10
+
+
+def build_hive(depth=3, fanout=4, itempos=8,
+               shell_path="Local Settings\\Software\\Microsoft\\Windows\\Shell",
+               seed=0):
+    """
+    Build the tree of Keys of a hive containing a BagMRU/Bags structure.
+    Arguments:
+    - `depth`: The depth of the BagMRU tree below the BagMRU key.
+    - `fanout`: The number of subkeys of each BagMRU key above `depth`.
+    - `itempos`: The number of items in the ItemPos value of each node's
+        Bags key, or 0 for no ItemPos values.
+    - `shell_path`: The path of the key containing BagMRU and Bags.
+    - `seed`: The seed of the generated timestamps.
+    Returns the root Key.
+    """
+    rng = random.Random(seed)
+    base = datetime.datetime(2013, 1, 1)
+    factories = item_factories()
+    counter = [0, 0]
+
+    def timestamp():
+        return filetime(base + datetime.timedelta(seconds=rng.randint(0, 10 ** 8)))
+
+    root = Key("SYNTHETIC_ROOT", timestamp())
+    shell = root.path_subkey(shell_path)
+    bags = shell.add_subkey(Key("Bags", timestamp()))
+
+    def node(key, level):
+        slot = counter[1]
+        counter[1] += 1
+        key.add_value("NodeSlot", REG_DWORD, struct.pack("<I", slot))
+        bag = bags.add_subkey(Key(str(slot), timestamp())).add_subkey(Key("Shell", timestamp()))
+        bag.add_value("Mode", REG_DWORD, struct.pack("<I", 0x4))
+        if itempos:
+            bag.add_value("ItemPos1920x1080x96(1)", REG_BINARY,
+                          itempos_value(file_items(itempos, slot * itempos, rng)))
+        if level == depth:
+            return
+        for i in range(fanout):
+            d = base + datetime.timedelta(seconds=rng.randint(0, 10 ** 8))
+            item = factories[counter[0] % len(factories)](counter[0], d)
+            counter[0] += 1
+            key.add_value(str(i), REG_BINARY, shitemlist([item]))
+            node(key.add_subkey(Key(str(i), timestamp())), level + 1)
+        key.add_value("MRUListEx", REG_BINARY,
+                      struct.pack("<%dI" % (fanout + 1), *(range(fanout) + [0xFFFFFFFF])))
+
+    node(shell.add_subkey(Key("BagMRU", timestamp())), 0)
+    return root
+
+
+def write_hive(path, **kwargs):
+    """
+    Build a hive with `build_hive` and write it to the given path.
+    """
+    with open(path, "wb") as f:
+        HiveWriter().write(build_hive(**kwargs), f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Registry hive with shellbags.")
+    parser.add_argument("output", help="Path of the hive to write")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="Depth of the BagMRU tree; default is 3")
+    parser.add_argument("--fanout", type=int, default=4,
+                        help="Number of subkeys of each BagMRU key; default is 4")
+    parser.add_argument("--itempos", type=int, default=8,
+                        help="Number of items in each ItemPos value; default is 8")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the generated timestamps; default is 0")
+    args = parser.parse_args()
+
+    write_hive(args.output, depth=args.depth, fanout=args.fanout,
+               itempos=args.itempos, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,621 @@
+#!/usr/bin/python
+
+#    This file is part of shellbags.py
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Tests of the BagMRU walk and the output formats, over synthetic hives
+from synthetic_hive.py.
+"""
+
+import os
+import sys
+import io
+import json
+import random
+import struct
+import datetime
+import pickle
+import sqlite3
+
+import pytest
+
+testsdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(testsdir))
+sys.path.append(os.path.join(testsdir, "benchmark"))
+import shellbags
+import synthetic_hive
+from BinaryParser import slice_bytes
+
+
+@pytest.fixture
+def hive(tmpdir):
+    """
+    The path of a small synthetic hive.
+    """
+    path = str(tmpdir.join("UsrClass.dat"))
+    synthetic_hive.write_hive(path, depth=2, fanout=3, itempos=2)
+    return path
+
+
+def iter_values(key):
+    """
+    Yield every value of a python-registry RegistryKey and its subkeys.
+    """
+    stack = [key]
+    while stack:
+        key = stack.pop()
+        for value in key.values():
+            yield value
+        stack.extend(key.subkeys())
+
+
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_value_data(hive, use_mmap):
+    views = 0
+    for path in [hive, os.path.join(testsdir, "Issue7", "UsrClass.dat")]:
+        with shellbags.open_hive(path, use_mmap=use_mmap) as reg:
+            for value in iter_values(reg.root()):
+                data = shellbags.value_data(value)
+                expected = value.value()
+                if not isinstance(data, type(expected)):
+                    data = slice_bytes(data, 0, len(data))
+                    views += 1
+                assert data == expected, value.name()
+    assert (views > 0) == use_mmap
+
+
+def test_bodyfile_tags_hive(hive):
+    f = io.BytesIO()
+    sink = shellbags.OutputSink(f, encoding="utf-8")
+    records = shellbags.get_hive_shellbags(hive)[1]
+    shellbags.print_shellbags_bodyfile(records, hive, sink, tag_hive=True)
+    lines = f.getvalue().decode("utf-8").splitlines()
+    assert len(lines) == len(records)
+    for line, shellbag in zip(lines, records):
+        assert line.split("|")[1] == u"%s (Shellbag in %s)" % (shellbag.path, hive)
+
+
+def test_bodyfile_untagged(hive, monkeypatch):
+    f = io.BytesIO()
+    records = shellbags.get_hive_shellbags(hive)[1]
+    shellbags.print_shellbags_bodyfile(records, hive, shellbags.OutputSink(f, encoding="utf-8"))
+    # the per-record writer prints the same lines
+    terminal = Terminal()
+    monkeypatch.setattr(sys, "stdout", terminal)
+    for shellbag in records:
+        shellbags.print_shellbag_bodyfile(shellbag.raw_mtime, shellbag.raw_atime,
+                                          shellbag.raw_crtime, shellbag.path)
+    assert terminal.getvalue() == f.getvalue()
+    lines = f.getvalue().decode("utf-8").splitlines()
+    for line, shellbag in zip(lines, records):
+        assert line.split("|")[1] == u"%s (Shellbag)" % shellbag.path
+
+
+def test_bodyfile_tags_hives_cli(hive, tmpdir):
+    output = str(tmpdir.join("out"))
+    for regfiles, name in [([hive], u"%s (Shellbag)"), ([hive, hive], u"%%s (Shellbag in %s)" % hive)]:
+        shellbags.main(["shellbags.py", "-w", output] + regfiles)
+        with open(output, "rb") as f:
+            lines = f.read().decode("utf-8").splitlines()
+        records = shellbags.get_hive_shellbags(hive)[1] * len(regfiles)
+        assert [line.split("|")[1] for line in lines] == [name % shellbag.path for shellbag in records]
+
+
+def test_columnar_fallback(hive, monkeypatch):
+    # as if pyarrow were not installed
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    monkeypatch.setitem(sys.modules, "pyarrow.parquet", None)
+    assert shellbags.import_pyarrow() is None
+    f = io.BytesIO()
+    sink = shellbags.OutputSink(f, encoding="utf-8")
+    with pytest.raises(shellbags.ShellbagException):
+        shellbags.ColumnarWriter(sink, parquet=True)
+    assert f.getvalue() == ""
+
+    records = shellbags.get_hive_shellbags(hive)[1]
+    node = shellbags.PathNode().child(u"My Computer").child(u"caf\xe9")
+    invalid = shellbags.ShellbagRecord(node, 0, 0, 0, datetime.datetime.min,
+                                       u"BagMRU\\0", u"0", 0x14)
+    writer = shellbags.ColumnarWriter(sink, row_group_size=5)
+    writer.write(records, hive)
+    writer.write([invalid], "Other.dat")
+    writer.close()
+    lines = [json.loads(line) for line in f.getvalue().decode("utf-8").splitlines()]
+    assert lines[0] == {"schema": [{"name": name, "type": _type}
+                                   for name, _type in shellbags.SHELLBAG_COLUMNS],
+                        "row_group_size": 5}
+    count = len(records) + 1
+    assert [group["num_rows"] for group in lines[1:]] == \
+        [5] * (count // 5) + [count % 5] * (count % 5 > 0)
+    rows = []
+    for group in lines[1:]:
+        columns = [group["columns"][name] for name, _ in shellbags.SHELLBAG_COLUMNS]
+        assert [len(column) for column in columns] == [group["num_rows"]] * len(columns)
+        rows.extend(zip(*columns))
+
+    def micros(d):
+        if d == datetime.datetime.min:
+            return None
+        return int(round((d - shellbags.EPOCH).total_seconds() * 1000000))
+    assert rows == [(hive, record.path, record.key_path, record.value_name, record.offset,
+                     micros(record.mtime), micros(record.atime), micros(record.crtime),
+                     micros(record.klwt)) for record in records] + \
+        [(u"Other.dat", u"\\My Computer\\caf\xe9", u"BagMRU\\0", u"0", 0x14,
+          None, None, None, None)]
+
+
+class Terminal(io.BytesIO):
+    """
+    A stand-in for STDOUT on a UTF-8 terminal.
+    """
+    encoding = "utf-8"
+
+    def write(self, data):
+        # like a terminal, print encodes text to its encoding
+        if isinstance(data, unicode):
+            data = data.encode(self.encoding)
+        io.BytesIO.write(self, data)
+
+
+def test_csv_stdout_encoding(monkeypatch):
+    node = shellbags.PathNode().child(u"My Computer").child(u"caf\xe9")
+    records = [shellbags.ShellbagRecord(node, 0, 0, 0, shellbags.EPOCH,
+                                        u"BagMRU\\0", u"0", 0)]
+    stdout = Terminal()
+    monkeypatch.setattr(sys, "stdout", stdout)
+    shellbags.print_shellbag_csv(records, "UsrClass.dat")
+    assert stdout.getvalue().splitlines()[1].split(",")[5] == "Unprintable Shellbag"
+
+    f = io.BytesIO()
+    shellbags.print_shellbag_csv(records, "UsrClass.dat", shellbags.OutputSink(f, encoding="utf-8"))
+    assert f.getvalue().splitlines()[1].split(",")[5] == u"\\My Computer\\caf\xe9".encode("utf-8")
+
+
+def stored_rows(db):
+    connection = sqlite3.connect(db)
+    try:
+        return connection.execute("SELECT path, key_path, value_name, offset, mtime, atime, "
+                                  "crtime, klwt FROM shellbags ORDER BY rowid").fetchall()
+    finally:
+        connection.close()
+
+
+def test_store_skips_stored_hives(hive, tmpdir):
+    db = str(tmpdir.join("shellbags.db"))
+    shellbags.main(["shellbags.py", "-o", "sqlite", "--db", db, hive])
+    rows = stored_rows(db)
+    assert len(rows) == len(shellbags.get_hive_shellbags(hive)[1])
+    store = shellbags.ShellbagStore(db)
+    try:
+        assert store.is_stored(hive)
+    finally:
+        store.close()
+    shellbags.main(["shellbags.py", "-o", "sqlite", "--db", db, hive])
+    assert stored_rows(db) == rows
+
+
+def test_store_replaces_partial_runs(hive, tmpdir):
+    db = str(tmpdir.join("shellbags.db"))
+    shellbags.main(["shellbags.py", "-o", "sqlite", "--db", db, "--scope", "bagmru", hive])
+    assert not [row for row in stored_rows(db) if "ItemPos" in row[2]]
+    shellbags.main(["shellbags.py", "-o", "sqlite", "--db", db, hive])
+    full = stored_rows(db)
+    assert [row for row in full if "ItemPos" in row[2]]
+    assert len(full) == len(shellbags.get_hive_shellbags(hive)[1])
+
+
+@pytest.mark.parametrize("options", [{"jobs": 2}, {"jobs": 2, "split": True}])
+def test_stats_merge_workers(hive, options):
+    counts = []
+    for run_options in [{}, options]:
+        stats = shellbags.enable_stats()
+        try:
+            for _, records in shellbags.iter_hive_shellbags([hive, hive], **run_options):
+                list(records)
+        finally:
+            shellbags.enable_stats(False)
+        counts.append((dict(stats.items), dict(stats.item_types),
+                       stats.item_cache_hits + stats.item_cache_misses,
+                       dict(stats.bagmru_items)))
+        # items are counted by their class, rather than the constructor
+        #   they were dispatched to, whether parsed or from ITEM_CACHE
+        assert "parse_fileentry" not in stats.items
+        assert stats.cached_items["SHITEM_FILEENTRY"] > 0
+    assert counts[0] == counts[1]
+    assert sum(counts[0][3].values()) > 0
+
+
+SHELL_PATH = "Local Settings\\Software\\Microsoft\\Windows\\Shell"
+
+
+def write_orphan_hive(path):
+    """
+    Write a hive with a Bags slot that no BagMRU key refers to, and
+    a template that is not a slot.
+    """
+    root = synthetic_hive.build_hive(depth=2, fanout=2, itempos=2)
+    bags = root.path_subkey(SHELL_PATH + "\\Bags")
+    orphan = bags.add_subkey(synthetic_hive.Key("99")).add_subkey(synthetic_hive.Key("Shell"))
+    orphan.add_value("ItemPos1920x1080x96(1)", synthetic_hive.REG_BINARY,
+                     synthetic_hive.itempos_value([]))
+    bags.add_subkey(synthetic_hive.Key("AllFolders"))
+    with open(path, "wb") as f:
+        synthetic_hive.HiveWriter().write(root, f)
+
+
+def test_bags_index(tmpdir):
+    path = str(tmpdir.join("UsrClass.dat"))
+    write_orphan_hive(path)
+
+    with shellbags.open_hive(path) as reg:
+        shell_key = reg.open(SHELL_PATH)
+        bags_key = shell_key.subkey("Bags")
+        index = shellbags.BagsIndex(bags_key)
+        assert len(index) == len(bags_key.subkeys())
+
+        # every NodeSlot resolves to the bags that a subkey search finds
+        stack = [shell_key.subkey("BagMRU")]
+        while stack:
+            key = stack.pop()
+            stack.extend(key.subkeys())
+            slot = key.value("NodeSlot").value()
+            expected = [(bag.path(), [value.name() for value in bag.values()
+                                      if "ItemPos" in value.name()])
+                        for bag in bags_key.subkey(str(slot)).subkeys()]
+            assert [(bag_path, [value.name() for value in values])
+                    for bag_path, values in index.itempos_values(slot)] == expected
+
+        with pytest.raises(shellbags.Registry.RegistryKeyNotFoundException):
+            index.itempos_values(100)
+        assert [slot_key.name() for slot_key in index.orphan_slots()] == ["99"]
+        assert index.timestamp(100) is None
+
+        # the walk reports the orphan once it has visited every BagMRU key
+        stats = shellbags.enable_stats()
+        try:
+            list(shellbags.iter_key_shellbags(shell_key))
+        finally:
+            shellbags.enable_stats(False)
+        assert stats.orphan_slots == [bags_key.subkey("99").path()]
+
+
+def test_path_node_names():
+    node = shellbags.PathNode().child(u"My Computer").child("caf\xe9").child(u"na\xefve")
+    assert node.path() == u"\\My Computer\\caf\ufffd\\na\xefve"
+    assert node.is_under(node.parent.parent)
+    assert not node.parent.is_under(node)
+
+
+def test_path_node_pickle():
+    node = shellbags.PathNode()
+    for depth in range(sys.getrecursionlimit() * 2):
+        node = node.child(u"%d" % depth)
+    record = shellbags.ShellbagRecord(node, 0, 0, 0, shellbags.EPOCH, u"BagMRU", u"0", 0)
+    copy = pickle.loads(pickle.dumps([record, record], pickle.HIGHEST_PROTOCOL))
+    assert copy[0] is copy[1]
+    assert copy[0].path == record.path
+    assert copy[0].node.depth == node.depth
+    root = pickle.loads(pickle.dumps(shellbags.PathNode(), pickle.HIGHEST_PROTOCOL))
+    assert (root.parent, root.depth, root.path()) == (None, 0, "")
+
+
+def test_shellbag_batch_pickle():
+    node = shellbags.PathNode()
+    for depth in range(sys.getrecursionlimit() * 2):
+        node = node.child(u"%d" % depth)
+    batch = shellbags.ShellbagBatch()
+    for name in [u"a", u"b", u"c"]:
+        child = node.child(name)
+        batch.append(shellbags.ShellbagRecord(child, 1, 2, 3, shellbags.EPOCH,
+                                              u"BagMRU", name, 0))
+        batch.append(shellbags.ShellbagRecord(child.child(u"d"), 1, 2, 3, shellbags.EPOCH,
+                                              u"BagMRU\\0", name, 4))
+    data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+    copy = pickle.loads(data)
+    assert isinstance(copy, shellbags.ShellbagBatch)
+    assert [shellbags.ShellbagRecord.__getstate__(record)[1:] for record in copy] == \
+        [shellbags.ShellbagRecord.__getstate__(record)[1:] for record in batch]
+    assert [record.path for record in copy] == [record.path for record in batch]
+    # the records still share the nodes of their common prefix
+    assert copy[1].node.parent is copy[0].node
+    assert copy[0].node.parent is copy[2].node.parent
+    # and each node is written once, rather than once for each record
+    _, (rows, records) = batch.__reduce__()
+    assert len(rows) == node.depth + 1 + 6
+    assert [row[0] for row in rows] == range(len(rows))
+    assert pickle.loads(pickle.dumps(shellbags.ShellbagBatch())) == []
+
+
+def write_bagmru_hive(path, tree):
+    """
+    Write a hive with a BagMRU key structure of the given tree, and an
+    empty Bags key.
+    Arguments:
+    - `tree`: A list of tuples (shell item, list of tuples of its subtree).
+    """
+    root = synthetic_hive.Key("ROOT", synthetic_hive.filetime(datetime.datetime(2013, 1, 1)))
+    shell = root.path_subkey(SHELL_PATH)
+    shell.add_subkey(synthetic_hive.Key("Bags", root.timestamp))
+    stack = [(shell.add_subkey(synthetic_hive.Key("BagMRU", root.timestamp)), tree)]
+    while stack:
+        key, children = stack.pop()
+        for index, (item, subtree) in enumerate(children):
+            key.add_value(str(index), synthetic_hive.REG_BINARY, synthetic_hive.shitemlist([item]))
+            stack.append((key.add_subkey(synthetic_hive.Key(str(index), root.timestamp)), subtree))
+    with open(path, "wb") as f:
+        synthetic_hive.HiveWriter().write(root, f)
+
+
+def non_ascii_tree():
+    d = datetime.datetime(2013, 1, 1)
+    return [(synthetic_hive.folder_entry(synthetic_hive.MY_COMPUTER), [
+        (synthetic_hive.fileentry_fragment("CAF\xc9", d), [
+            (synthetic_hive.file_entry("NAIVE~1", u"na\xefve", 0x9, d, d, d), []),
+        ]),
+    ])]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "bodyfile", "jsonl"])
+def test_non_ascii_paths(tmpdir, fmt):
+    path = str(tmpdir.join("UsrClass.dat"))
+    write_bagmru_hive(path, non_ascii_tree())
+    output = str(tmpdir.join("out"))
+    shellbags.main(["shellbags.py", "-o", fmt, "--scope", "bagmru", "-w", output, path])
+    with open(output, "rb") as f:
+        text = f.read().decode("utf-8")
+    if fmt == "jsonl":
+        text = u"\n".join(json.loads(line)["path"] for line in text.splitlines())
+    assert u"\\{My Computer}\\CAF\ufffd\\na\xefve" in text
+
+
+def write_dated_hive(path, depth=3, fanout=3, seed=0):
+    """
+    Write a hive with a BagMRU key structure in which, as on a real
+    system, the dates of the items in each value are no later than the
+    last write time of the key holding the value.
+    """
+    rng = random.Random(seed)
+    base = datetime.datetime(2010, 1, 1)
+
+    def date(latest=None):
+        if latest is None:
+            return base + datetime.timedelta(seconds=rng.randint(0, 10 ** 8))
+        return latest - datetime.timedelta(seconds=rng.randint(0, 10 ** 7))
+
+    def key(name, d):
+        return synthetic_hive.Key(name, synthetic_hive.filetime(d))
+
+    root = key("ROOT", date())
+    shell = root.path_subkey(SHELL_PATH)
+    bags = shell.add_subkey(key("Bags", date()))
+    slots = [0]
+    stack = [(shell.add_subkey(key("BagMRU", date())), date(), 0)]
+    while stack:
+        parent, parent_date, level = stack.pop()
+        slot = slots[0]
+        slots[0] += 1
+        parent.add_value("NodeSlot", synthetic_hive.REG_DWORD, struct.pack("<I", slot))
+        bag_date = date()
+        bag = bags.add_subkey(key(str(slot), bag_date)).add_subkey(key("Shell", bag_date))
+        items = []
+        for i in range(2):
+            d = date(bag_date)
+            items.append(synthetic_hive.file_entry("FILE~%d" % i, u"File %d-%d" % (slot, i),
+                                                   0x9, d, d, d, directory=False))
+        bag.add_value("ItemPos1920x1080x96(1)", synthetic_hive.REG_BINARY,
+                      synthetic_hive.itempos_value(items))
+        if level == depth:
+            continue
+        for i in range(fanout):
+            d = date(parent_date)
+            name = [u"Folder %d" % i, u"caf\xe9 %d" % i, u"Docs %d" % i][(slot + i) % 3]
+            item = synthetic_hive.file_entry("FOLDER~%d" % i, name, 0x9, d, d, d)
+            parent.add_value(str(i), synthetic_hive.REG_BINARY, synthetic_hive.shitemlist([item]))
+            child_date = date()
+            stack.append((parent.add_subkey(key(str(i), child_date)), child_date, level + 1))
+    with open(path, "wb") as f:
+        synthetic_hive.HiveWriter().write(root, f)
+
+
+def record_fields(record):
+    return (record.path, record.raw_mtime, record.raw_atime, record.raw_crtime,
+            record.klwt, record.key_path, record.value_name, record.offset)
+
+
+FILTERS = [
+    {"since": datetime.datetime(2011, 6, 1)},
+    {"since": datetime.datetime(2012, 6, 1)},
+    {"since": datetime.datetime(2012, 6, 1), "until": datetime.datetime(2012, 9, 1)},
+    {"until": datetime.datetime(2011, 1, 1)},
+    {"path_regex": u"^\\\\Folder 0\\\\"},
+    {"path_regex": u"^\\\\caf\xe9 1\\\\"},
+    {"path_regex": u"(?i)^\\\\DOCS 2\\\\folder"},
+    {"path_regex": u"^\\\\caf\xe9 1\\\\", "since": datetime.datetime(2012, 1, 1)},
+]
+
+
+@pytest.mark.parametrize("max_depth", [None, 1])
+@pytest.mark.parametrize("options", FILTERS)
+def test_filter_pruning(tmpdir, options, max_depth):
+    path = str(tmpdir.join("UsrClass.dat"))
+    write_dated_hive(path)
+    options = dict(options)
+    if "path_regex" in options:
+        options["path_regex"] = shellbags.compile_path_regex(options["path_regex"])
+    shellbag_filter = shellbags.ShellbagFilter(**options)
+
+    with shellbags.open_hive(path) as reg:
+        shell_key = reg.open(SHELL_PATH)
+        stats = shellbags.enable_stats()
+        try:
+            everything = list(shellbags.iter_key_shellbags(shell_key, max_depth=max_depth))
+            unpruned_values = sum(stats.bagmru_values.values())
+            stats = shellbags.enable_stats()
+            pruned = list(shellbags.iter_key_shellbags(shell_key, max_depth=max_depth,
+                                                       shellbag_filter=shellbag_filter))
+            pruned_values = sum(stats.bagmru_values.values())
+        finally:
+            shellbags.enable_stats(False)
+
+    expected = [record_fields(record) for record in everything if shellbag_filter.matches(record)]
+    assert [record_fields(record) for record in pruned] == expected
+    assert expected
+    # only `since` and anchored patterns prune; `until` cannot
+    if "since" in options or "path_regex" in options:
+        assert pruned_values < unpruned_values
+
+
+def test_timestamps_max_depth(tmpdir):
+    path = str(tmpdir.join("UsrClass.dat"))
+    write_dated_hive(path)
+    with shellbags.open_hive(path) as reg:
+        bagmru_key = reg.open(SHELL_PATH + "\\BagMRU")
+        own, subtree = shellbags.bagmru_timestamps(bagmru_key, max_depth=1)
+        assert sorted(own) == sorted([bagmru_key.path().lower()] +
+                                     [key.path().lower() for key in bagmru_key.subkeys()])
+        assert subtree[bagmru_key.path().lower()] == \
+            max([bagmru_key.timestamp()] + [key.timestamp() for key in bagmru_key.subkeys()])
+
+
+def run_fields(regfiles, **options):
+    return [(regfile, [record_fields(record) for record in records])
+            for regfile, records in shellbags.iter_hive_shellbags(regfiles, **options)]
+
+
+@pytest.mark.parametrize("since", [None, datetime.datetime(2012, 6, 1)])
+@pytest.mark.parametrize("options", [{"jobs": 2}, {"jobs": 2, "split": True}, {"prefetch": 1}])
+def test_run_modes(tmpdir, options, since):
+    regfiles = []
+    for seed in range(2):
+        regfiles.append(str(tmpdir.join("UsrClass%d.dat" % seed)))
+        write_dated_hive(regfiles[-1], seed=seed)
+    shellbag_filter = shellbags.ShellbagFilter(since=since)
+    expected = run_fields(regfiles, shellbag_filter=shellbag_filter)
+    assert all(records for _, records in expected)
+    assert run_fields(regfiles, shellbag_filter=shellbag_filter, **options) == expected
+
+
+def test_worker_index_cache(tmpdir, monkeypatch):
+    path = str(tmpdir.join("UsrClass.dat"))
+    write_dated_hive(path)
+    shellbag_filter = shellbags.ShellbagFilter(since=datetime.datetime(2012, 6, 1))
+    built = []
+
+    class CountedBagsIndex(shellbags.BagsIndex):
+        def __init__(self, bags_key):
+            built.append(bags_key.path())
+            super(CountedBagsIndex, self).__init__(bags_key)
+
+    with shellbags.open_hive(path) as reg:
+        partitions = shellbags.bagmru_partitions(reg.open(SHELL_PATH))
+    assert len(partitions) > 2
+    monkeypatch.setattr(shellbags, "BagsIndex", CountedBagsIndex)
+    records = []
+    try:
+        for partition in partitions:
+            partition_records, failed, _, _ = shellbags.get_partition_shellbags(
+                (path, SHELL_PATH, partition), shellbag_filter=shellbag_filter)
+            assert not failed
+            records.extend(partition_records)
+        assert len(built) == 1
+        assert list(shellbags.g_worker_hive[3]) == [(SHELL_PATH, None, shellbags.SCOPE_ALL)]
+    finally:
+        if shellbags.g_worker_hive[2] is not None:
+            shellbags.g_worker_hive[2].close()
+        shellbags.g_worker_hive = None
+    assert [record_fields(record) for record in records] == \
+        run_fields([path], shellbag_filter=shellbag_filter)[0][1]
+
+
+@pytest.mark.parametrize("options", [["--prefetch", "-1"], ["--prefetch", "x"],
+                                     ["--prefetch", "2", "-j", "2"],
+                                     ["--prefetch", "2", "--split"]])
+def test_prefetch_options(hive, options):
+    with pytest.raises(SystemExit) as e:
+        shellbags.main(["shellbags.py"] + options + [hive])
+    assert e.value.code == 2
+
+
+ISSUE7_HIVE = os.path.join(testsdir, "Issue7", "UsrClass.dat")
+
+
+def valid_dates(record):
+    return [d for d in (record.klwt, record.mtime, record.atime, record.crtime)
+            if d != datetime.datetime.min]
+
+
+@pytest.mark.parametrize("since,until", [
+    (None, datetime.datetime(2000, 1, 1)),
+    (datetime.datetime(2014, 1, 1), None),
+    (None, datetime.datetime(2013, 12, 20, 1, 41, 0)),
+    (datetime.datetime(2013, 12, 20, 1, 41, 0), datetime.datetime(2013, 12, 20, 2, 0, 0)),
+])
+def test_time_window(since, until):
+    _, records = shellbags.get_hive_shellbags(ISSUE7_HIVE)
+    assert records
+    selected = shellbags.get_hive_shellbags(
+        ISSUE7_HIVE, shellbag_filter=shellbags.ShellbagFilter(since=since, until=until))[1]
+    expected = [record for record in records
+                if any((since is None or d >= since) and (until is None or d <= until)
+                       for d in valid_dates(record))]
+    assert [record_fields(record) for record in selected] == \
+        [record_fields(record) for record in expected]
+    # records without item dates are not selected by them
+    if since is None and until.year == 2000:
+        assert selected == []
+
+
+def test_until_cli(tmpdir):
+    output = str(tmpdir.join("out"))
+    shellbags.main(["shellbags.py", "-o", "csv", "--until", "2000-01-01", "-w", output, ISSUE7_HIVE])
+    with open(output, "rb") as f:
+        assert len(f.read().decode("utf-8").splitlines()) == 1
+
+
+def test_worker_chunks(tmpdir, monkeypatch):
+    regfiles = []
+    for seed in range(3):
+        regfiles.append(str(tmpdir.join("UsrClass%d.dat" % seed)))
+        write_dated_hive(regfiles[-1], seed=seed)
+    expected = run_fields(regfiles)
+    # the workers are forked with the smaller chunks
+    monkeypatch.setattr(shellbags, "SHELLBAG_CHUNK_SIZE", 5)
+    assert run_fields(regfiles, jobs=2) == expected
+    # the items of a hive that are not consumed are skipped
+    results = shellbags.iter_hive_shellbags(regfiles, jobs=2)
+    assert next(results)[0] == regfiles[0]
+    assert [(regfile, [record_fields(record) for record in records])
+            for regfile, records in results] == expected[1:]
+    with pytest.raises(EnvironmentError):
+        run_fields(regfiles + [str(tmpdir.join("missing.dat"))], jobs=2)
+
+
+@pytest.mark.parametrize("options", [{}, {"jobs": 2, "split": True}])
+def test_split_orphan_slots(tmpdir, options):
+    path = str(tmpdir.join("UsrClass.dat"))
+    write_orphan_hive(path)
+    with shellbags.open_hive(path) as reg:
+        orphan_path = reg.open(SHELL_PATH + "\\Bags\\99").path()
+    for run_options, expected in [({}, [orphan_path, orphan_path]),
+                                  ({"max_depth": 1}, []),
+                                  ({"shellbag_filter": shellbags.ShellbagFilter(
+                                      since=datetime.datetime(2100, 1, 1))}, [])]:
+        run_options.update(options)
+        stats = shellbags.enable_stats()
+        try:
+            for _, records in shellbags.iter_hive_shellbags([path, path], **run_options):
+                list(records)
+        finally:
+            shellbags.enable_stats(False)
+        assert stats.orphan_slots == expected
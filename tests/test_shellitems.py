@@ -0,0 +1,366 @@
+#!/usr/bin/python
+
+#    This file is part of shellbags.py
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Tests of the shell item parsers, over items from synthetic_hive.py.
+"""
+
+import os
+import sys
+import struct
+import datetime
+
+import pytest
+
+testsdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(testsdir))
+sys.path.append(os.path.join(testsdir, "benchmark"))
+import ShellItems
+import BinaryParser
+from ShellItems import SHITEM
+from ShellItems import SHITEMLIST
+from ShellItems import SHITEMTYPE
+from ShellItems import SHITEM_CONSTRUCTORS
+from ShellItems import ITEM_CACHE
+from ShellItems import cached_items
+from ShellItems import register_item_type
+from BinaryParser import Block
+from BinaryParser import cached_dosdatetime
+from known_guids import known_guids
+import synthetic_hive
+
+
+def chained_constructor(_type):
+    """
+    The constructor that the if/elif chain of earlier versions of
+    `SHITEMLIST.get_item` chose for a type byte.
+    """
+    if _type & 0x70 == SHITEMTYPE.FILE_ENTRY:
+        return ShellItems.parse_fileentry
+    elif _type == SHITEMTYPE.FOLDER_ENTRY:
+        return ShellItems.SHITEM_FOLDERENTRY
+    elif _type == SHITEMTYPE.UNKNOWN2:
+        return ShellItems.SHITEM_UNKNOWNENTRY2
+    elif _type & 0x70 == SHITEMTYPE.VOLUME_NAME:
+        return ShellItems.SHITEM_VOLUMEENTRY
+    elif _type & 0x70 == SHITEMTYPE.NETWORK_LOCATION:
+        return ShellItems.SHITEM_NETWORKLOCATIONENTRY
+    elif _type == SHITEMTYPE.URI:
+        return ShellItems.SHITEM_URIENTRY
+    elif _type == SHITEMTYPE.CONTROL_PANEL:
+        return ShellItems.SHITEM_CONTROLPANELENTRY
+    elif _type == SHITEMTYPE.UNKNOWN0:
+        return ShellItems.SHITEM_UNKNOWNENTRY0
+    elif _type == SHITEMTYPE.DELEGATE_ITEM:
+        return ShellItems.SHITEM_DELEGATE
+    return SHITEM
+
+
+def test_constructor_table_matches_type_chain():
+    for _type in range(0x100):
+        assert SHITEM_CONSTRUCTORS[_type] is chained_constructor(_type), hex(_type)
+
+
+def test_items_dispatch():
+    d = datetime.datetime(2013, 1, 1)
+    factories = synthetic_hive.item_factories()
+    expected = ["SHITEM_FOLDERENTRY", "SHITEM_FOLDERENTRY", "SHITEM_VOLUMEENTRY",
+                "SHITEM_NETWORKLOCATIONENTRY", "SHITEM_NETWORKLOCATIONENTRY",
+                "SHITEM_URIENTRY", "SHITEM_CONTROLPANELENTRY", "SHITEM_UNKNOWNENTRY0",
+                "SHITEM", "SHITEM_UNKNOWNENTRY2", "FILEENTRY_FRAGMENT", "SHITEM_DELEGATE"]
+    expected += ["SHITEM_FILEENTRY"] * (len(factories) - len(expected))
+    for index, (factory, name) in enumerate(zip(factories, expected)):
+        items = list(SHITEMLIST(synthetic_hive.shitemlist([factory(index, d)]), 0, False).items())
+        assert [item.__class__.__name__ for item in items] == [name]
+
+
+def test_register_item_type_precedence():
+    saved = list(SHITEM_CONSTRUCTORS)
+    try:
+        register_item_type(ShellItems.SHITEM_URIENTRY, 0x60, 0xF0)
+        register_item_type(ShellItems.SHITEM_CONTROLPANELENTRY, 0x61)
+        assert SHITEM_CONSTRUCTORS[0x61] is ShellItems.SHITEM_CONTROLPANELENTRY
+        assert SHITEM_CONSTRUCTORS[0x6F] is ShellItems.SHITEM_URIENTRY
+        assert SHITEM_CONSTRUCTORS[0x70] is SHITEM
+    finally:
+        SHITEM_CONSTRUCTORS[:] = saved
+
+
+def test_item_dates():
+    m = datetime.datetime(2013, 1, 2, 3, 4, 6)
+    cr = datetime.datetime(2012, 5, 6, 7, 8, 10)
+    a = datetime.datetime(2013, 2, 3, 4, 5, 8)
+    blob = synthetic_hive.shitemlist([synthetic_hive.file_entry("FOLDER~1", u"Folder", 0x9, m, cr, a)])
+    item = next(SHITEMLIST(blob, 0, False).items())
+    assert item.m_date() == m
+    assert item.extension_block.cr_date() == cr
+    assert item.extension_block.a_date() == a
+    assert cached_dosdatetime(item.raw_m_date()) == m
+    # items without dates have the invalid date
+    item = next(SHITEMLIST(synthetic_hive.shitemlist([synthetic_hive.unknown1_entry()]), 0, False).items())
+    assert item.raw_m_date() == 0
+    assert item.m_date() == datetime.datetime.min
+
+
+def test_cached_items():
+    d = datetime.datetime(2013, 1, 1)
+    blob = synthetic_hive.shitemlist([factory(index, d) for index, factory
+                                      in enumerate(synthetic_hive.item_factories())])
+    ITEM_CACHE.clear()
+    parsed = list(cached_items(blob))
+    assert (ITEM_CACHE.hits, ITEM_CACHE.misses) == (0, 1)
+    cached = list(cached_items(blob))
+    assert (ITEM_CACHE.hits, ITEM_CACHE.misses) == (1, 1)
+    assert cached == parsed
+    items = list(SHITEMLIST(blob, 0, False).items())
+    assert [(summary.name, summary.raw_m_date) for summary in cached] == \
+        [(item.name(), item.raw_m_date()) for item in items]
+
+
+def test_cached_items_disabled(monkeypatch):
+    d = datetime.datetime(2013, 1, 1)
+    blob = synthetic_hive.shitemlist([factory(index, d) for index, factory
+                                      in enumerate(synthetic_hive.item_factories())])
+    ITEM_CACHE.clear()
+    parsed = list(cached_items(blob))
+    maxsize = ITEM_CACHE.maxsize
+    ITEM_CACHE.resize(0)
+    try:
+        # a disabled cache neither hashes the value nor looks it up
+        def sha256(data):
+            raise AssertionError("hashed with the cache disabled")
+        monkeypatch.setattr(ShellItems.hashlib, "sha256", sha256)
+        assert list(cached_items(blob)) == parsed
+        assert (len(ITEM_CACHE), ITEM_CACHE.hits, ITEM_CACHE.misses) == (0, 0, 1)
+    finally:
+        ITEM_CACHE.resize(maxsize)
+
+
+def test_truncated_extension_block():
+    d = datetime.datetime(2013, 1, 1)
+    item = synthetic_hive.file_entry("FOLDER~1", u"Long folder name", 0x3, d, d, d,
+                                     localized_name="@shell32.dll,-21770")
+    items = list(SHITEMLIST(synthetic_hive.shitemlist([item]), 0, False).items())
+    assert [(parsed.__class__.__name__, parsed.name()) for parsed in items] == \
+        [("SHITEM_FILEENTRY", u"Long folder name")]
+    # end the item within the long name, keeping its extension offset,
+    # so that the localized name starts beyond the end of the buffer
+    cut = item.index(u"Long folder name".encode("utf-16-le")) + 8
+    truncated = struct.pack("<H", cut + 2) + item[2:cut] + item[-2:]
+    items = list(SHITEMLIST(synthetic_hive.shitemlist([truncated]), 0, False).items())
+    assert [(parsed.__class__.__name__, parsed.name()) for parsed in items] == \
+        [("FILEENTRY_FRAGMENT", "FOLDER~1")]
+
+
+def sliced_wstring(buf, offset, ilength=False):
+    """
+    The slice-and-decode implementation of `Block.unpack_wstring` that
+    the scanning one replaced, to compare them.
+    """
+    raw_bytes = buf[offset:]
+    if ilength:
+        raw_bytes = raw_bytes[:ilength]
+    if len(raw_bytes) % 2:
+        raw_bytes = raw_bytes[:-1]
+    try:
+        index = [raw_bytes[i:i + 2] for i in range(0, len(raw_bytes), 2)].index("\x00\x00")
+        raw_bytes = raw_bytes[:index * 2]
+    except ValueError:
+        pass
+    return raw_bytes.decode("utf-16-le")
+
+
+WSTRINGS = [
+    # terminated
+    "A\x00B\x00\x00\x00C\x00",
+    # a double NULL that is not aligned to a wchar, then one that is
+    "\x00A\x00\x00B\x00\x00\x00",
+    # no terminator before the end of the buffer, of odd length
+    "A\x00B\x00C\x00D",
+    "\x41\x00\xe9\x00",
+    "",
+    # an unpaired surrogate
+    "A\x00\x00\xd8",
+]
+
+
+@pytest.mark.parametrize("data", WSTRINGS)
+def test_unpack_wstring(data):
+    buf = "\xff\xff\xff" + data
+    for base in range(4):
+        block = Block(buf, base, None)
+        for offset in range(len(buf) - base + 1):
+            for ilength in [False, 0, 1, 2, 3, 4, 5, len(buf), len(buf) + 7, -1, -2]:
+                try:
+                    expected = sliced_wstring(buf, base + offset, ilength)
+                except UnicodeDecodeError:
+                    with pytest.raises(UnicodeDecodeError):
+                        block.unpack_wstring(offset, ilength)
+                    continue
+                assert block.unpack_wstring(offset, ilength) == expected, \
+                    (base, offset, ilength)
+
+
+class RunBlock(Block):
+    _fields = (
+        ("word", "a", 0x0),
+        ("dword", "b", 0x2),
+        # a gap of at most MAX_RUN_GAP bytes is skipped within the run
+        ("byte", "c", 0x8),
+        ("dosdate", "d", 0x9),
+        # beyond MAX_RUN_GAP, so the start of a second run
+        ("qword", "e", 0x20),
+        ("wstring", "f", 0x28),
+    )
+
+
+def test_compile_fields():
+    assert [RunBlock.a.run, RunBlock.b.run, RunBlock.c.run] == [RunBlock.d.run] * 3
+    assert RunBlock.a.run.struct.format == "<HI2xBI"
+    assert [RunBlock.a.index, RunBlock.b.index, RunBlock.c.index, RunBlock.d.index] == \
+        [0, 1, 2, 3]
+    assert RunBlock.e.run is not RunBlock.a.run
+    assert (RunBlock.e.run.offset, RunBlock.e.run.struct.format) == (0x20, "<Q")
+    assert type(RunBlock.f) is BinaryParser.Field
+    assert [RunBlock._off_a, RunBlock._off_d, RunBlock._off_e, RunBlock._off_f] == \
+        [0x0, 0x9, 0x20, 0x28]
+
+
+def run_block_data():
+    d = datetime.datetime(2013, 1, 1, 12, 30, 10)
+    return (struct.pack("<HIxxB", 0x1234, 0xdeadbeef, 0x7f) +
+            synthetic_hive.dosdate_bytes(d) + "\xff" * 0x13 +
+            struct.pack("<Q", 0x0102030405060708) + u"name".encode("utf-16-le") + "\x00\x00")
+
+
+def test_struct_run():
+    data = run_block_data()
+    block = RunBlock("\xff" * 3 + data, 3, None)
+    assert [block.a(), block.b(), block.c(), block.e(), block.f()] == \
+        [0x1234, 0xdeadbeef, 0x7f, 0x0102030405060708, u"name"]
+    assert block.d() == datetime.datetime(2013, 1, 1, 12, 30, 10)
+    # the run is decoded once, and agrees with the unpack_* methods
+    assert block.__dict__[RunBlock.a.run.key] == (0x1234, 0xdeadbeef, 0x7f, block.unpack_dword(0x9))
+    assert [block.a(), block.b(), block.c(), block.d()] == \
+        [block.unpack_word(0x0), block.unpack_dword(0x2), block.unpack_byte(0x8),
+         block.unpack_dosdate(0x9)]
+
+
+def test_struct_run_overrun():
+    data = run_block_data()
+    # the buffer ends after `c`, within the run, so the fields that are in
+    # bounds fall back to the unpack_* methods
+    block = RunBlock("\xff" + data[:0x9], 1, None)
+    with pytest.raises(BinaryParser.OverrunBufferException):
+        RunBlock.a.run.unpack(block)
+    assert [block.a(), block.b(), block.c()] == [0x1234, 0xdeadbeef, 0x7f]
+    assert RunBlock.a.run.key not in block.__dict__
+    # `d` is cut off, and unpack_dosdate returns datetime.min for that
+    assert block.d() == datetime.datetime.min
+    with pytest.raises(BinaryParser.OverrunBufferException):
+        block.e()
+    # the buffer ends within `b`, which straddles the end
+    block = RunBlock(data[:0x4], 0, None)
+    assert block.a() == 0x1234
+    with pytest.raises(BinaryParser.OverrunBufferException):
+        block.b()
+    with pytest.raises(BinaryParser.OverrunBufferException):
+        block.c()
+
+
+# the names of GUID shell items, as formatted before GUIDs were looked up
+#   in known_guids_raw, by item class name
+GUID_ITEM_NAMES = {
+    "SHITEM_FOLDERENTRY": lambda item: "{%s}" % known_guids[item.guid()]
+        if item.guid() in known_guids else "{%s: %s}" % (item.folder_id(), item.guid()),
+    "SHITEM_UNKNOWNENTRY0": lambda item: "{%s}" % known_guids.get(item.guid(), item.guid()),
+    "SHITEM_UNKNOWNENTRY2": lambda item: "{%s}" % known_guids.get(item.guid(), item.guid()),
+    "SHITEM_CONTROLPANELENTRY":
+        lambda item: "{CONTROL PANEL: %s}" % known_guids.get(item.guid(), item.guid()),
+    "SHITEM_NETWORKLOCATIONENTRY":
+        lambda item: "{%s}" % known_guids.get(item.guid(), item.guid()),
+}
+
+
+def test_known_guid_names():
+    factories = [synthetic_hive.folder_entry, synthetic_hive.unknown0_entry,
+                 synthetic_hive.unknown2_entry, synthetic_hive.control_panel_entry,
+                 synthetic_hive.network_guid_entry]
+    unknown = "01234567-89ab-cdef-0123-456789abcdef"
+    assert unknown not in known_guids
+    for g in sorted(known_guids) + [unknown]:
+        buf = synthetic_hive.shitemlist([factory(g) for factory in factories])
+        items = list(SHITEMLIST(buf, 0, False).items())
+        assert sorted(parsed.__class__.__name__ for parsed in items) == sorted(GUID_ITEM_NAMES)
+        for parsed in items:
+            assert parsed.guid() == g
+            assert parsed.guid_name() == known_guids.get(g, g)
+            assert parsed.name() == GUID_ITEM_NAMES[parsed.__class__.__name__](parsed)
+
+
+class ItemObserver(object):
+    def __init__(self):
+        self.items = []
+
+    def add_item(self, item_class, _type, seconds):
+        self.items.append((item_class, _type, seconds is None))
+
+    def add_item_cache_lookup(self, hit):
+        pass
+
+
+def test_observe_item_classes():
+    d = datetime.datetime(2013, 1, 1)
+    buf = synthetic_hive.shitemlist([
+        synthetic_hive.file_entry("FOLDER~1", u"Long folder name", 0x3, d, d, d),
+        synthetic_hive.fileentry_fragment("FRAG~1", d),
+        synthetic_hive.volume_entry("C:\\"),
+    ])
+    ITEM_CACHE.clear()
+    observer = ItemObserver()
+    ShellItems.observe_items(observer)
+    try:
+        for cached in [False, True]:
+            del observer.items[:]
+            summaries = list(cached_items(buf))
+            # the class of the item, not the parse_fileentry dispatch function
+            assert observer.items == [(ShellItems.SHITEM_FILEENTRY, 0x31, cached),
+                                      (ShellItems.FILEENTRY_FRAGMENT, 0x32, cached),
+                                      (ShellItems.SHITEM_VOLUMEENTRY, 0x2F, cached)]
+            assert [summary.item_class for summary in summaries] == \
+                [item_class for item_class, _, _ in observer.items]
+    finally:
+        ShellItems.observe_items(None)
+
+
+def test_generation_cache():
+    cache = BinaryParser.GenerationCache(4)
+    for key in range(4):
+        cache.put(key, str(key))
+    # filling the young generation makes it the old one
+    cache.put(4, "4")
+    assert cache.get(0) == "0"
+    for key in range(5, 8):
+        cache.put(key, str(key))
+    # 0 was used again, so moved to the young generation and survives,
+    #   while the old entries that were not used are evicted
+    assert [cache.get(key) for key in [1, 2, 3]] == [None] * 3
+    assert [cache.get(key) for key in [0, 4, 5, 6, 7]] == ["0", "4", "5", "6", "7"]
+    for key in range(100):
+        cache.put(key, str(key))
+        assert len(cache) <= 2 * cache.maxsize
+    cache.resize(0)
+    cache.put(9, "9")
+    assert (len(cache), cache.get(9)) == (0, None)